@@ -11,6 +11,9 @@ with self;
       , repository
       , digest
       , hash
+      # If non-null, only the layers of these platforms (e.g. [ "linux/amd64" ])
+      # are extracted into `diffs`.
+      , platforms ? null
       , passthru ? {}
       }:
       let
@@ -25,7 +28,7 @@ with self;
           passthru = passthru';
         };
         diffs = stamp.internal.tool.extractDiffs {
-          inherit oci;
+          inherit oci platforms;
           name = "${name}-diffs";
           passthru = passthru';
         };
@@ -47,13 +50,23 @@ with self;
       , workingDir ? null
       , vmDiskSize ? 2048 # MB
       , vmMemory ? 512    # MB
+      # Directory in which to keep base image layers, extracted for
+      # runInContainer, between builds (see tool.layerDiff for its
+      # requirements). null means they are extracted anew every build.
+      , extractCacheDir ? null
+      , extractCacheMaxSize ? 20 * 1024 * 1024 * 1024 # bytes
+      # Whether files with identical content and metadata in different cached
+      # layers share one inode.
+      , extractCacheShareFiles ? true
       , layerHash ? null
+      , compression ? "gzip" # or "zstd"
+      , compressionLevel ? null
       , passthru ? {}
       }:
       let
         implicitLayer = if copy != [] || runOnHost != "" || runInContainer != ""
           then stamp.internal.layer {
-            inherit copy runOnHost runOnHostUID runOnHostGID runInContainer vmDiskSize vmMemory;
+            inherit copy runOnHost runOnHostUID runOnHostGID runInContainer vmDiskSize vmMemory extractCacheDir extractCacheMaxSize extractCacheShareFiles compression compressionLevel;
             name = "${name}-layer";
             runInContainerBase = if runInContainer != "" then base else null;
             hash = layerHash;
@@ -76,6 +89,8 @@ with self;
 
     fromNix =
       { name ? "stamp-img-nix"
+      # Store paths already present in this image aren't added again.
+      , base ? null
       , runOnHost ? ""
       , runInContainer ? ""
       , cmd ? null
@@ -88,6 +103,22 @@ with self;
       , withConveniences ? true
       , vmDiskSize ? 2048 # MB
       , vmMemory ? 512    # MB
+      , extractCacheDir ? null # see stamp.patch
+      , extractCacheMaxSize ? 20 * 1024 * 1024 * 1024 # bytes
+      , extractCacheShareFiles ? true
+      , compression ? "gzip" # or "zstd"
+      , compressionLevel ? null
+      # A packingPlan from an earlier build of this image (e.g.
+      # `oldImage.packingPlan`). Layers from it are reused where possible.
+      , previousPackingPlan ? null
+      # How store paths are grouped into layers; see nix_packing_plan.STRATEGIES.
+      , packingStrategy ? "closest-subtree"
+      # Hard limit on the number of Nix store layers (not counting the layer
+      # holding runOnHost/copy results).
+      , maxLayers ? null
+      # If true, store paths bigger than targetLayerSize are split file-wise
+      # across several layers, so they can be pulled in parallel.
+      , splitLargePaths ? false
       , passthru ? {}
       }:
       let
@@ -114,23 +145,33 @@ with self;
         );
         closureInfo' = closureInfo { rootPaths = storeRoots; };
         packingPlan = stamp.internal.tool.nixPackingPlan {
-          inherit targetLayerSize;
+          inherit targetLayerSize maxLayers splitLargePaths;
+          baseImage = base;
+          previousPlan = previousPackingPlan;
+          strategy = packingStrategy;
           name = "${name}-packing-plan";
           closureInfo = closureInfo';
         };
-        mkStoreLayer = fileName: _: let
-          pathsFile = "${packingPlan}/${fileName}";
-        in stamp.internal.nixStoreLayer {
-          paths = builtins.filter (x: x != "") (lib.splitString "\n" (builtins.readFile pathsFile));
-          passthru = { inherit pathsFile; };
+        # The whole plan is loaded with a single readFile. Its context (which
+        # names every store path in the closure) is discarded, and each layer
+        # is given the context of just its own store paths instead, so that a
+        # layer only depends on the paths it contains.
+        plan = builtins.fromJSON (builtins.unsafeDiscardStringContext (builtins.readFile packingPlan.plan));
+        withStorePathContext = p: let
+          storePath = builtins.head (builtins.match "(${builtins.storeDir}/[^/]+).*" p);
+        in builtins.appendContext p { ${storePath} = { path = true; }; };
+        mkStoreLayer = planLayer: stamp.internal.nixStoreLayer {
+          inherit compression compressionLevel;
+          paths = builtins.map withStorePathContext planLayer.paths;
+          passthru = { inherit planLayer; };
         };
-        storeLayers = lib.mapAttrsToList mkStoreLayer (builtins.readDir packingPlan);
+        storeLayers = builtins.map mkStoreLayer plan.layers;
         copy = lib.optional withRegistration {
           src = "${closureInfo'}/registration";
           dest = "/nix-path-registration";
         };
       in stamp.patch {
-        inherit name copy runInContainer cmd entrypoint user workingDir vmDiskSize vmMemory;
+        inherit name base copy runInContainer cmd entrypoint user workingDir vmDiskSize vmMemory extractCacheDir extractCacheMaxSize extractCacheShareFiles compression compressionLevel;
         appendLayers = storeLayers;
         runOnHost = runOnHost';
         env = env';
@@ -143,11 +184,14 @@ with self;
       , pkgs
       , vmDiskSize ? 2048 # MB
       , vmMemory ? 512    # MB
+      , extractCacheDir ? null # see stamp.patch
+      , extractCacheMaxSize ? 20 * 1024 * 1024 * 1024 # bytes
+      , extractCacheShareFiles ? true
       , layerHash ? null
       , passthru ? {}
       }:
       stamp.patch {
-        inherit name base vmDiskSize vmMemory layerHash passthru;
+        inherit name base vmDiskSize vmMemory extractCacheDir extractCacheMaxSize extractCacheShareFiles layerHash passthru;
         copy = builtins.map (src: { inherit src; dest = "/imgbuild/${src.name}"; }) pkgs;
         runInContainer = ''
           apt install -y /imgbuild/*
@@ -172,41 +216,27 @@ with self;
         paths = builtins.map (groups: builtins.elemAt groups 0) (builtins.filter builtins.isList split);
       in builtins.map (path: builtins.appendContext path ctx) paths;
 
-      digest =
-        { name ? "${src.name}-digest"
-        , src
-        , passthru ? {}
-        }:
-        stdenvNoCC.mkDerivation {
-          inherit name src passthru;
-          buildCommand = ''( echo -n sha256: && sha256sum "$src" | cut -d ' ' -f 1 ) > "$out"'';
-          preferLocalBuild = true;
-        };
-
       layerFromDiffTarball =
         { name ? lib.strings.removeSuffix "-diff.tar" diffTarball.name
         , src
+        , compression ? "gzip" # or "zstd"
+        , compressionLevel ? null
         , passthru ? {}
         }:
         let
-          passthru' = { inherit diffTarball blobTarball diffDigest blobDigest; } // passthru;
           diffTarball = if src ? overrideAttrs
-            then src.overrideAttrs (oldAttrs: { passthru = passthru' // (oldAttrs.passthru or {}); })
+            then src.overrideAttrs (oldAttrs: {
+              passthru = {
+                inherit blobTarball compression;
+                inherit (blobTarball) diffDigest blobDigest;
+              } // passthru // (oldAttrs.passthru or {});
+            })
             else src;
-          blobTarball = stdenvNoCC.mkDerivation {
-            inherit diffTarball;
-            name = "${name}-blob.tar.gz";
-            nativeBuildInputs = [ pigz ];
-            buildCommand = ''pigz --stdout --processes ''${NIX_BUILD_CORES:-1} --no-name --no-time "$diffTarball" > "$out"'';
-            passthru = passthru';
-          };
-          diffDigest = stamp.internal.digest {
-            src = diffTarball;
-            passthru = passthru';
-          };
-          blobDigest = stamp.internal.digest {
-            src = blobTarball;
-            passthru = passthru';
+          # The blob and both digests are produced by a single derivation,
+          # which reads the diff tarball only once.
+          blobTarball = stamp.internal.tool.makeLayer {
+            inherit diffTarball compression compressionLevel passthru;
+            name = "${name}-blob.tar.${{ gzip = "gz"; zstd = "zst"; }.${compression}}";
           };
         in blobTarball;
 
@@ -220,13 +250,18 @@ with self;
         , runInContainerBase ? null
         , vmDiskSize ? 2048 # MB
         , vmMemory ? 512    # MB
+        , extractCacheDir ? null
+        , extractCacheMaxSize ? 20 * 1024 * 1024 * 1024 # bytes
+        , extractCacheShareFiles ? true
         , hash ? null
+        , compression ? "gzip"
+        , compressionLevel ? null
         , passthru ? {}
         }:
         stamp.internal.layerFromDiffTarball {
-          inherit name passthru;
+          inherit name compression compressionLevel passthru;
           src = stamp.internal.tool.layerDiff {
-            inherit copy runOnHost runOnHostUID runOnHostGID runInContainer runInContainerBase vmDiskSize vmMemory hash;
+            inherit copy runOnHost runOnHostUID runOnHostGID runInContainer runInContainerBase vmDiskSize vmMemory extractCacheDir extractCacheMaxSize extractCacheShareFiles hash;
             name = "${name}-diff.tar";
           };
         };
@@ -234,21 +269,30 @@ with self;
       nixStoreLayer =
         { name ? "stamp-layer-nix-store"
         , paths
+        , compression ? "gzip"
+        , compressionLevel ? null
         , passthru ? {}
         }:
-        stamp.internal.layerFromDiffTarball {
-          inherit name;
-          src = stdenvNoCC.mkDerivation {
-            inherit paths;
-            name = "${name}-diff.tar";
-            buildCommand = ''tar --create --directory=/ --file="$out" --owner=0 --group=0 --numeric-owner --mtime="@$SOURCE_DATE_EPOCH" --sort=name "''${paths[@]#/}"'';
-            preferLocalBuild = true;
-            # diffs may contain Nix store paths, but they refer to the image's
-            # Nix store, not the host system's.
-            unsafeDiscardReferences.out = true;
-            # required by unsafeDiscardReferences
-            __structuredAttrs = true;
-          };
+        let
+          # A packing plan may list files/directories inside a store path
+          # (when a large store path has been split across layers) rather
+          # than whole store paths. Those, and the store path itself, are
+          # archived without recursing into them, since their contents are
+          # listed separately.
+          topLevel = p: builtins.match "(${builtins.storeDir}/[^/]+)(/.*)?" p;
+          splitStorePaths = builtins.listToAttrs (builtins.map
+            (p: { name = builtins.head (topLevel p); value = true; })
+            (builtins.filter (p: let m = topLevel p; in m != null && builtins.elemAt m 1 != null) paths));
+          isWholeStorePath = p: let m = topLevel p; in
+            m != null && builtins.elemAt m 1 == null && !(splitStorePaths ? ${p});
+        in
+        # The store paths are archived, compressed and digested in one pass,
+        # without writing the diff tarball out and reading it back in again.
+        stamp.internal.tool.makeLayer {
+          inherit compression compressionLevel;
+          name = "${name}-blob.tar.${{ gzip = "gz"; zstd = "zst"; }.${compression}}";
+          wholePaths = builtins.filter isWholeStorePath paths;
+          partialPaths = builtins.filter (p: !isWholeStorePath p) paths;
           passthru = { inherit paths; } // passthru;
         };
     };
@@ -1,8 +1,6 @@
 { e2fsprogs
 , lib
-, pigz
 , python3
-, rsync
 , stdenvNoCC
 , util-linux
 , vmTools
@@ -15,18 +13,20 @@ let
     pyproject = true;
     src = builtins.filterSource (path: type: baseNameOf path != "default.nix") ./.;
     build-system = with python3.pkgs; [ setuptools ];
-    nativeCheckInputs = with python3.pkgs; [ pigz pytestCheckHook rsync testfixtures ];
+    dependencies = with python3.pkgs; [ zstandard ];
+    nativeCheckInputs = with python3.pkgs; [ pytestCheckHook testfixtures ];
 
     passthru = {
       extractDiffs =
         { name ? "stamp-extract-diffs"
         , oci
+        , platforms ? null # e.g. [ "linux/amd64" "linux/arm/v7" ]; null means all platforms
         , passthru ? {}
         }:
         stdenvNoCC.mkDerivation {
-          inherit name oci passthru;
+          inherit name oci platforms passthru;
           __structuredAttrs = true;
-          nativeBuildInputs = [ self pigz ];
+          nativeBuildInputs = [ self ];
           buildCommand = "stamptool extract-diffs";
           # diffs may contain Nix store paths, but they refer to the image's
           # Nix store, not the host system's.
@@ -44,16 +44,35 @@ let
         , vmDiskSize ? 2048 # MB
         , vmMemory ? 512    # MB
         , hash ? null
+        # Directory in which to keep extracted base image layers between
+        # builds. It must exist, be writable by the builder (e.g. listed in
+        # extra-sandbox-paths; to share it between build users, make it
+        # group-owned by their group and setgid), and be on a filesystem that
+        # supports user extended attributes, in which ownership and device
+        # files created in the VM are recorded. Its path may only contain
+        # letters, digits and "-_./+@%:=,".
+        , extractCacheDir ? null
+        , extractCacheMaxSize ? 20 * 1024 * 1024 * 1024 # bytes
+        # Whether files with identical content and metadata in different
+        # layers in the extract cache share one inode.
+        , extractCacheShareFiles ? true
         , passthru ? {}
         }:
         let
-          allUIDsEqual = lib.all (x: (x.uid or 0) == runOnHostUID) copy;
-          allGIDsEqual = lib.all (x: (x.gid or (x.uid or 0)) == runOnHostGID) copy;
-          needVM = runInContainer != "" || !allUIDsEqual || !allGIDsEqual;
+          # Ownership requested by copy elements is applied as the layer is
+          # packed, so only running a container needs root.
+          needVM = runInContainer != "";
+          cacheDir = toString extractCacheDir;
+          # The path ends up unquoted in the script that starts QEMU, so only
+          # allow characters that need no quoting there.
+          checkedCacheDir =
+            if builtins.match "[-A-Za-z0-9_./+@%:=,]+" cacheDir != null
+            then cacheDir
+            else throw "extractCacheDir ${builtins.toJSON cacheDir} contains characters other than letters, digits and \"-_./+@%:=,\"";
           drv = stdenvNoCC.mkDerivation ({
-            inherit name copy runOnHost runOnHostUID runOnHostGID runInContainer runInContainerBase passthru;
+            inherit name copy runOnHost runOnHostUID runOnHostGID runInContainer runInContainerBase extractCacheDir extractCacheMaxSize extractCacheShareFiles passthru;
             __structuredAttrs = true;
-            nativeBuildInputs = [ self rsync ];
+            nativeBuildInputs = [ self ];
             buildCommand = "stamptool layer-diff";
             runInContainerBaseDiffs = if runInContainerBase != null then runInContainerBase.diffs else null;
             # diffs may contain Nix store paths, but they refer to the image's
@@ -70,27 +89,89 @@ let
               size = vmDiskSize;
               fullName = "disk";
               destination = "disk";
-            };
+            } + lib.optionalString (extractCacheDir != null) ''
+              # Only the Nix store and xchg are shared into the VM otherwise.
+              # QEMU doesn't pass the guest's locks on to the host, so layers
+              # are only evicted after the VM has exited, when no other VM is
+              # using the cache (see postVM). Until then, hold a shared lock
+              # to show that this one is.
+              exec 9>${checkedCacheDir}/vm.lock
+              ${util-linux}/bin/flock --shared 9
+              # Keep what QEMU creates in the cache writable by the group.
+              umask 0002
+              # Commas in -virtfs option values are written as two commas.
+              QEMU_OPTS="$QEMU_OPTS -virtfs local,path=${lib.replaceStrings [ "," ] [ ",," ] checkedCacheDir},security_model=mapped-xattr,fmode=0664,dmode=0775,mount_tag=extract-cache"
+            '';
+            postVM = lib.optionalString (extractCacheDir != null) ''
+              exec 9>&-
+              ${util-linux}/bin/flock --exclusive --nonblock --conflict-exit-code 0 ${checkedCacheDir}/vm.lock ${self}/bin/stamptool layer-diff-evict
+            '';
             memSize = vmMemory;
             nativeBuildInputs = oldAttrs.nativeBuildInputs ++ [ e2fsprogs util-linux ];
             buildCommand = ''
               mkdir mnt
               mkfs /dev/${vmTools.hd}
               mount /dev/${vmTools.hd} mnt
+            '' + lib.optionalString (extractCacheDir != null) ''
+              mkdir -p ${checkedCacheDir}
+              mount -t 9p -o trans=virtio,version=9p2000.L,msize=131072 extract-cache ${checkedCacheDir}
+            '' + ''
               cd mnt
             '' + oldAttrs.buildCommand;
           }))
           else drv;
 
+      makeLayer =
+        { name ? "stamp-layer.tar.${{ gzip = "gz"; zstd = "zst"; }.${compression}}"
+        # Either an existing diff tarball to compress...
+        , diffTarball ? null
+        # ...or absolute paths to archive into a new one. wholePaths are
+        # archived recursively, partialPaths are not.
+        , wholePaths ? []
+        , partialPaths ? []
+        , compression ? "gzip" # or "zstd"
+        , compressionLevel ? null
+        , passthru ? {}
+        }:
+        let
+          # out is the compressed blob; diff is the uncompressed tarball,
+          # only built if diffTarball is not given. diffDigest and blobDigest
+          # contain the digests of each, as "sha256:<hex>".
+          drv = stdenvNoCC.mkDerivation {
+            inherit name diffTarball wholePaths partialPaths compression compressionLevel;
+            __structuredAttrs = true;
+            outputs = [ "out" ] ++ lib.optional (diffTarball == null) "diff" ++ [ "diffDigest" "blobDigest" ];
+            nativeBuildInputs = [ self ];
+            buildCommand = "stamptool make-layer";
+            # diffs may contain Nix store paths, but they refer to the image's
+            # Nix store, not the host system's.
+            unsafeDiscardReferences = { out = true; } // lib.optionalAttrs (diffTarball == null) { diff = true; };
+            passthru = {
+              inherit compression;
+              diffTarball = if diffTarball != null then diffTarball else drv.diff;
+              blobTarball = drv;
+            } // passthru;
+          };
+        in drv;
+
       nixPackingPlan =
         { name ? "stamp-nix-packing-plan"
         , closureInfo
         , targetLayerSize
+        , previousPlan ? null
+        , strategy ? "closest-subtree" # or "dominator", "popularity", "size-bin"
+        , maxLayers ? null # hard limit on the number of layers in the plan
+        , splitLargePaths ? false # spread store paths bigger than targetLayerSize over several layers
+        , baseImage ? null # store paths already present in this image are left out of the plan
         , passthru ? {}
         }:
         stdenvNoCC.mkDerivation {
-          inherit name closureInfo targetLayerSize passthru;
+          inherit name closureInfo targetLayerSize previousPlan strategy maxLayers splitLargePaths baseImage passthru;
+          baseDiffs = if baseImage != null then baseImage.diffs else null;
           __structuredAttrs = true;
+          # out is a directory with one file per layer; plan is the same plan
+          # as a single JSON document.
+          outputs = [ "out" "plan" ];
           nativeBuildInputs = [ self ];
           buildCommand = "stamptool nix-packing-plan";
           preferLocalBuild = true;
@@ -129,7 +210,7 @@ let
           outputs = [ "out" "manifest" "config" ];
           nativeBuildInputs = [ self ];
           buildCommand = "stamptool patch-oci";
-          appendLayers = builtins.map (lay: { inherit (lay) blobTarball blobDigest diffDigest; }) appendLayers;
+          appendLayers = builtins.map (lay: { inherit (lay) blobTarball blobDigest diffDigest; compression = lay.compression or "gzip"; }) appendLayers;
           preferLocalBuild = true;
           # Env/Entrypoint/Cmd etc may contain Nix store paths, but they refer
           # to the image's Nix store, not the host system's.
@@ -1,12 +1,18 @@
+import errno
+import fcntl
 import json
+import os
 import platform
+import shutil
 from dataclasses import dataclass
+from typing import Optional
 
 
 @dataclass(frozen=True)
 class Platform:
   arch: str
   os: str
+  variant: Optional[str] = None
 
   @classmethod
   def current(cls):
@@ -19,6 +25,60 @@ class Platform:
       }[platform.system()],
     )
 
+  @classmethod
+  def parse(cls, s):
+    """
+    Parse a platform specifier of the form "os/arch" or "os/arch/variant",
+    e.g. "linux/amd64" or "linux/arm/v7".
+    """
+    parts = s.split("/")
+    if len(parts) not in (2, 3) or not all(parts):
+      raise ValueError(f"invalid platform specifier {s!r} (expected 'os/arch' or 'os/arch/variant')")
+    return cls(arch=parts[1], os=parts[0], variant=parts[2] if len(parts) == 3 else None)
+
+  def __str__(self):
+    return "/".join([self.os, self.arch] + ([self.variant] if self.variant is not None else []))
+
+
+def build_cores():
+  """
+  Return the number of CPU cores this build is permitted to use, as specified
+  by Nix's NIX_BUILD_CORES environment variable (where 0 means "all of them").
+  """
+  n = int(os.environ.get("NIX_BUILD_CORES", "1"))
+  if n <= 0:
+    n = os.cpu_count() or 1
+  return n
+
+
+def copy_file(src, dest, size):
+  """
+  Copy the content of the regular file `src` (of `size` bytes) to a new file
+  `dest`, by reflinking it if the filesystem supports that, otherwise with
+  `copy_file_range` or, failing that, by reading and writing it.
+  """
+  with open(src, "rb") as src_f, open(dest, "wb") as dest_f:
+    try:
+      fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+      return
+    except OSError:
+      pass # not supported here; fall back to copying the data
+    copied = 0
+    try:
+      while copied < size:
+        n = os.copy_file_range(src_f.fileno(), dest_f.fileno(), size - copied)
+        if n == 0:
+          break
+        copied += n
+    except OSError as e:
+      if copied or e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP, errno.EPERM):
+        raise
+      shutil.copyfileobj(src_f, dest_f)
+
+
+# From <linux/fs.h>.
+FICLONE = 0x40049409
+
 
 class InvalidImageError(Exception):
   pass
@@ -54,7 +114,21 @@ def manifest_matches_platform(manifest_ref, desired_plat):
   arch_ok = arch is None or arch == desired_plat.arch
   os = manifest_ref.get("platform", {}).get("os")
   os_ok = os is None or os == desired_plat.os
-  return arch_ok and os_ok
+  variant = manifest_ref.get("platform", {}).get("variant")
+  variant_ok = variant is None or desired_plat.variant is None or variant == desired_plat.variant
+  return arch_ok and os_ok and variant_ok
+
+
+def manifest_platform_str(manifest_ref):
+  """
+  Describe the platform of a manifest in the same form as `Platform.parse`
+  accepts, with "*" for any part it doesn't specify.
+  """
+  plat = manifest_ref.get("platform", {})
+  parts = [plat.get("os", "*"), plat.get("architecture", "*")]
+  if "variant" in plat:
+    parts.append(plat["variant"])
+  return "/".join(parts)
 
 
 def load_manifest_and_config(oci_dir, desired_plat=Platform.current()):
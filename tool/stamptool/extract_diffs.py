@@ -1,26 +1,81 @@
+import hashlib
 import json
-import os
 import pathlib
-import subprocess
-from .common import iter_index_recursive, InvalidImageError
+import zlib
+import zstandard
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from . import parallel_gzip
+from .common import build_cores, iter_index_recursive, manifest_matches_platform, manifest_platform_str, InvalidImageError, Platform, PlatformMismatch
+
+
+# Size of the buffer used to read compressed blobs, and the maximum size of
+# each chunk of decompressed output that is held in memory at once.
+CHUNK_SIZE = 1024 * 1024
 
 
 def main(deriv_attrs):
   oci_dir = pathlib.Path(deriv_attrs["oci"])
   out_dir = pathlib.Path(deriv_attrs["outputs"]["out"])
 
+  # If a list of platforms is given, only unpack the layers of manifests that
+  # are suitable for at least one of them. Otherwise, unpack everything.
+  if deriv_attrs.get("platforms") is not None:
+    desired_plats = [Platform.parse(s) for s in deriv_attrs["platforms"]]
+    all_manifest_refs = list(iter_index_recursive(oci_dir))
+    manifest_refs = [
+      ref for ref in all_manifest_refs
+      if any(manifest_matches_platform(ref, plat) for plat in desired_plats)
+    ]
+    if not manifest_refs:
+      available = ", ".join(manifest_platform_str(ref) for ref in all_manifest_refs) or "none"
+      raise PlatformMismatch(f"no manifest is suitable for any of the platforms {', '.join(map(str, desired_plats))} (available: {available})")
+  else:
+    manifest_refs = list(iter_index_recursive(oci_dir))
+
   layers_to_unpack = {
     blob_digest: compression_algo
-    for manifest_ref in iter_index_recursive(oci_dir)
+    for manifest_ref in manifest_refs
     for blob_digest, compression_algo in iter_manifest_layers(oci_dir, manifest_ref)
   }
 
   (out_dir / "sha256").mkdir(parents=True, exist_ok=True)
-  for blob_digest, compression_algo in layers_to_unpack.items():
-    blob_path = oci_dir / "blobs" / blob_digest.replace(":", "/")
-    diff_staging_path = out_dir / "staging"
-    diff_digest = decompress_and_digest(blob_path, diff_staging_path, compression_algo)
-    diff_staging_path.rename(out_dir / diff_digest.replace(":", "/"))
+
+  # Start the largest layers first, so that a big layer doesn't end up being
+  # decompressed on its own after all the small ones have finished.
+  blob_digests = sorted(
+    layers_to_unpack,
+    key=lambda blob_digest: blob_path(oci_dir, blob_digest).stat().st_size,
+    reverse=True,
+  )
+
+  # zlib and hashlib release the GIL while working on large buffers, so threads
+  # are enough to spread the work across cores. The cores are split between
+  # unpacking several layers at once and decompressing each layer's gzip
+  # members in parallel, so that no more than NIX_BUILD_CORES threads
+  # decompress at once.
+  cores = build_cores()
+  layer_workers = max(1, min(cores, len(blob_digests)))
+  threads_per_layer = max(1, cores // layer_workers)
+  with ThreadPoolExecutor(max_workers=layer_workers) as executor:
+    futures = [
+      executor.submit(unpack_layer, oci_dir, out_dir, blob_digest, layers_to_unpack[blob_digest], threads_per_layer)
+      for blob_digest in blob_digests
+    ]
+    for future in futures:
+      future.result()
+
+
+def unpack_layer(oci_dir, out_dir, blob_digest, compression_algo, threads=1):
+  # Each layer gets its own staging file so that concurrent unpacks don't
+  # collide. It's only renamed into place once it's complete.
+  diff_staging_path = out_dir / f"staging-{blob_digest.replace(':', '-')}"
+  diff_digest = decompress_and_digest(blob_path(oci_dir, blob_digest), diff_staging_path, compression_algo, expected_blob_digest=blob_digest, threads=threads)
+  diff_staging_path.rename(out_dir / diff_digest.replace(":", "/"))
+
+
+def blob_path(oci_dir, digest):
+  return oci_dir / "blobs" / digest.replace(":", "/")
 
 
 def iter_manifest_layers(oci_dir, manifest_ref):
@@ -32,32 +87,208 @@ def iter_manifest_layers(oci_dir, manifest_ref):
   for layer_ref in manifest["layers"]:
     if layer_ref["mediaType"] in ("application/vnd.oci.image.layer.v1.tar+gzip", "application/vnd.docker.image.rootfs.diff.tar.gzip"):
       yield layer_ref["digest"], "gzip"
+    elif layer_ref["mediaType"] in ("application/vnd.oci.image.layer.v1.tar+zstd",):
+      yield layer_ref["digest"], "zstd"
     elif layer_ref["mediaType"] in ("application/vnd.in-toto+json",):
       pass # This "layer" is some kind of metadata, not a diff. Do nothing.
     else:
       raise InvalidImageError(f"blob {layer_ref['digest']} referenced by manifest at {manifest_path} has unrecognised mediaType {layer_ref['mediaType']!r}")
 
 
-def decompress_and_digest(in_path, out_path, compression_algo):
-  n_cores = os.environ.get("NIX_BUILD_CORES", "1")
-  decompress_proc = subprocess.Popen(
-    {
-      "gzip": ["unpigz", "--stdout", "--processes", n_cores, str(in_path)],
-    }[compression_algo],
-    stdin=subprocess.DEVNULL,
-    stdout=subprocess.PIPE,
-  )
-  tee_proc = subprocess.Popen(
-    ["tee", str(out_path)],
-    stdin=decompress_proc.stdout,
-    stdout=subprocess.PIPE,
-  )
-  sha256sum_proc = subprocess.Popen(
-    ["sha256sum"],
-    stdin=tee_proc.stdout,
-    stdout=subprocess.PIPE,
-  )
-  for proc in [decompress_proc, tee_proc, sha256sum_proc]:
-    if proc.wait() != 0:
-      raise subprocess.CalledProcessError(returncode=proc.returncode, cmd=repr(proc.args))
-  return "sha256:" + sha256sum_proc.stdout.read().decode("ascii").split()[0]
+def decompress_and_digest(in_path, out_path, compression_algo, expected_blob_digest=None, threads=1):
+  """
+  Decompress the blob at `in_path` into `out_path`, returning the digest of
+  the decompressed data.
+
+  This is done in a single pass over the data: each chunk read from `in_path`
+  is hashed, decompressed, and the decompressed output is hashed and written
+  out before the next chunk is read. If `expected_blob_digest` is given, the
+  digest of the compressed data is checked against it once the whole blob has
+  been read.
+  """
+
+  decompressor = DECOMPRESSORS[compression_algo](threads)
+  blob_hash = hashlib.sha256()
+  diff_hash = hashlib.sha256()
+  buf = bytearray(CHUNK_SIZE)
+  buf_view = memoryview(buf)
+  with open(in_path, "rb") as in_f, open(out_path, "wb") as out_f:
+    while True:
+      n = in_f.readinto(buf)
+      if not n:
+        break
+      chunk = buf_view[:n]
+      blob_hash.update(chunk)
+      for data in decompressor.decompress(chunk):
+        diff_hash.update(data)
+        out_f.write(data)
+    for data in decompressor.flush():
+      diff_hash.update(data)
+      out_f.write(data)
+    decompressor.finish()
+
+  if expected_blob_digest is not None:
+    blob_digest = "sha256:" + blob_hash.hexdigest()
+    if blob_digest != expected_blob_digest:
+      raise InvalidImageError(f"blob {in_path} has digest {blob_digest}, but {expected_blob_digest} was expected")
+  return "sha256:" + diff_hash.hexdigest()
+
+
+class GzipDecompressor:
+  """
+  Incremental decompressor for gzip streams, including streams formed of
+  multiple concatenated gzip members.
+  """
+
+  def __init__(self):
+    self._new_member()
+
+  def _new_member(self):
+    self._obj = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    self._member_started = False
+
+  def decompress(self, data):
+    """
+    Feed `data` to the decompressor, yielding chunks of decompressed output no
+    larger than `CHUNK_SIZE`.
+    """
+    if data:
+      self._member_started = True
+    while True:
+      out = self._obj.decompress(data, CHUNK_SIZE)
+      if out:
+        yield out
+      if self._obj.eof:
+        data = self._obj.unused_data
+        self._new_member()
+        if not data:
+          break
+        self._member_started = True
+      else:
+        data = self._obj.unconsumed_tail
+        # A full chunk of output may mean zlib is still holding more.
+        if not data and len(out) < CHUNK_SIZE:
+          break
+
+  def flush(self):
+    """
+    Yield any decompressed output that is still being held back.
+    """
+    return iter(())
+
+  def finish(self):
+    if self._member_started and not self._obj.eof:
+      raise InvalidImageError("gzip stream is truncated")
+
+
+class ZstdDecompressor:
+  """
+  Incremental decompressor for zstd streams, including streams formed of
+  multiple concatenated zstd frames.
+  """
+
+  def __init__(self):
+    self._dctx = zstandard.ZstdDecompressor()
+    self._new_frame()
+
+  def _new_frame(self):
+    self._obj = self._dctx.decompressobj(write_size=CHUNK_SIZE)
+    self._frame_started = False
+
+  def decompress(self, data):
+    """
+    Feed `data` to the decompressor, yielding chunks of decompressed output.
+    """
+    while data:
+      self._frame_started = True
+      out = self._obj.decompress(data)
+      if out:
+        yield out
+      if not self._obj.eof:
+        break
+      data = self._obj.unused_data
+      self._new_frame()
+
+  def flush(self):
+    """
+    Yield any decompressed output that is still being held back.
+    """
+    return iter(())
+
+  def finish(self):
+    if self._frame_started and not self._obj.eof:
+      raise InvalidImageError("zstd stream is truncated")
+
+
+class ParallelGzipDecompressor:
+  """
+  Incremental decompressor for gzip streams which decompresses members on a
+  pool of `threads` worker threads, when their headers record where they end (as
+  written by `parallel_gzip.ParallelGzipCompressor`).
+
+  As soon as a member without that information is encountered, the rest of
+  the stream is handed to an ordinary `GzipDecompressor`.
+  """
+
+  def __init__(self, threads=1):
+    self._buf = bytearray()
+    self._pending = deque()
+    self._executor = None
+    self._threads = threads
+    self._max_pending = 2 * threads
+    self._fallback = None
+
+  def decompress(self, data):
+    """
+    Feed `data` to the decompressor, yielding chunks of decompressed output no
+    larger than `parallel_gzip.MAX_MEMBER_SIZE`.
+    """
+    if self._fallback is not None:
+      yield from self._fallback.decompress(data)
+      return
+
+    self._buf += data
+    while self._buf:
+      try:
+        size = parallel_gzip.member_size(self._buf)
+      except IndexError:
+        break # wait for the rest of the header
+      if size is None:
+        yield from self.flush()
+        self._fallback = GzipDecompressor()
+        yield from self._fallback.decompress(bytes(self._buf))
+        self._buf.clear()
+        return
+      if len(self._buf) < size:
+        break # wait for the rest of the member
+      if self._executor is None:
+        self._executor = ThreadPoolExecutor(max_workers=self._threads)
+      self._pending.append(self._executor.submit(parallel_gzip.decompress_member, bytes(self._buf[:size])))
+      del self._buf[:size]
+
+    while self._pending and (len(self._pending) > self._max_pending or self._pending[0].done()):
+      yield self._pending.popleft().result()
+
+  def flush(self):
+    """
+    Yield any decompressed output that is still being held back.
+    """
+    while self._pending:
+      yield self._pending.popleft().result()
+    if self._fallback is not None:
+      yield from self._fallback.flush()
+
+  def finish(self):
+    if self._executor is not None:
+      self._executor.shutdown()
+    if self._fallback is not None:
+      self._fallback.finish()
+    elif self._buf:
+      raise InvalidImageError("gzip stream is truncated")
+
+
+# Each is called with the number of threads it may use.
+DECOMPRESSORS = {
+  "gzip": ParallelGzipDecompressor,
+  "zstd": lambda threads: ZstdDecompressor(),
+}
@@ -0,0 +1,187 @@
+import errno
+import hashlib
+import os
+import pathlib
+import stat
+import sys
+import tarfile
+import tempfile
+from .common import InvalidImageError, copy_file
+from .layer_cache import remove_path
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class FilePool:
+  """
+  Directory of regular files named by a hash of their content and metadata,
+  which extracted layers hardlink to, so that a file which appears in several
+  layers only takes up space (and page cache) once.
+
+  The directory is laid out as follows:
+
+    objects/<xx>/<hash>     a file, where <xx> is the first two characters of
+                            <hash>
+    tmp/                    files being written
+
+  Files are never modified once they are in `objects`, and a file whose only
+  link is the one in `objects` isn't used by any layer, so can be removed.
+  """
+
+  def __init__(self, root):
+    self.root = pathlib.Path(root)
+    for subdir in ["objects", "tmp"]:
+      (self.root / subdir).mkdir(parents=True, exist_ok=True)
+
+  def link(self, src_f, size, dest, *, mode, uid, gid, mtime):
+    """
+    Read `size` bytes from `src_f` and create `dest` as a file with that
+    content and the given metadata, hardlinked to an identical file in the
+    pool if there is one.
+    """
+    h = hashlib.sha256(f"{stat.S_IMODE(mode):o} {uid} {gid} {mtime}\0".encode())
+    fd, tmp_path = tempfile.mkstemp(dir=self.root / "tmp")
+    try:
+      with open(fd, "wb") as tmp_f:
+        remaining = size
+        while remaining:
+          data = src_f.read(min(remaining, CHUNK_SIZE))
+          if not data:
+            raise InvalidImageError(f"tarball ended in the middle of {dest}")
+          h.update(data)
+          tmp_f.write(data)
+          remaining -= len(data)
+      apply_metadata(tmp_path, mode=mode, uid=uid, gid=gid, mtime=mtime)
+
+      digest = h.hexdigest()
+      obj_path = self.root / "objects" / digest[:2] / digest
+      obj_path.parent.mkdir(exist_ok=True)
+      # The object may be removed by `collect_garbage` at any point while it
+      # has no other links, in which case it is published again.
+      while True:
+        try:
+          os.link(tmp_path, obj_path)
+        except FileExistsError:
+          pass
+        try:
+          os.link(obj_path, dest)
+          return
+        except FileNotFoundError:
+          continue
+        except OSError as e:
+          if e.errno != errno.EMLINK:
+            raise
+          break
+      # The object has as many links as the filesystem allows, so give this
+      # file its own copy.
+      copy_file(tmp_path, dest, size)
+      apply_metadata(dest, mode=mode, uid=uid, gid=gid, mtime=mtime)
+    finally:
+      os.unlink(tmp_path)
+
+  def collect_garbage(self):
+    """
+    Remove files that are no longer linked into any layer.
+    """
+    removed = 0
+    for obj_dir in (self.root / "objects").iterdir():
+      for obj_path in obj_dir.iterdir():
+        st = obj_path.lstat()
+        if st.st_nlink == 1:
+          obj_path.unlink()
+          removed += st.st_size
+    if removed:
+      print(f"removed {removed} bytes of unused files from {self.root}", file=sys.stderr)
+
+
+def extract_pooled(tarball_path, dest, pool):
+  """
+  Extract the tarball at `tarball_path` into the existing directory `dest`,
+  in the same way as `tar --extract`, except that regular files are
+  hardlinked into `pool`.
+  """
+  print(f"extracting {tarball_path} to {dest} (sharing files through {pool.root})...", file=sys.stderr)
+  dest = pathlib.Path(dest)
+  if os.geteuid() == 0:
+    owner = lambda info: (info.uid, info.gid)
+  else:
+    # Only root can give files away.
+    owner = lambda info: (os.geteuid(), os.getegid())
+  dirs = {}
+  # Parent directories already known not to lead outside `dest` through a
+  # symlink.
+  safe_parents = set()
+  with tarfile.open(tarball_path, "r|") as tar:
+    for info in tar:
+      name = member_name(info.name)
+      path = dest / name
+      if name != ".":
+        if path.parent not in safe_parents:
+          check_inside(path.parent, dest)
+          safe_parents.add(path.parent)
+        path.parent.mkdir(parents=True, exist_ok=True)
+      if info.isdir():
+        if not path.is_dir() or path.is_symlink():
+          remove_path(path)
+          path.mkdir(mode=0o700)
+        # Directories are kept writable until everything has been extracted.
+        dirs[name] = info
+        continue
+
+      remove_path(path)
+      uid, gid = owner(info)
+      if info.isreg():
+        pool.link(tar.extractfile(info), info.size, path, mode=info.mode, uid=uid, gid=gid, mtime=info.mtime)
+        continue
+      if info.islnk():
+        # The target is looked up through its parent directories, which the
+        # tarball may have made into symlinks that lead outside of `dest`.
+        target = dest / member_name(info.linkname)
+        check_inside(target.parent, dest)
+        os.link(target, path, follow_symlinks=False)
+        continue
+      if info.issym():
+        os.symlink(info.linkname, path)
+        safe_parents.clear()
+      elif info.isfifo():
+        os.mkfifo(path)
+      elif info.ischr() or info.isblk():
+        os.mknod(path, info.mode | (stat.S_IFCHR if info.ischr() else stat.S_IFBLK), os.makedev(info.devmajor, info.devminor))
+      else:
+        raise InvalidImageError(f"{tarball_path} contains {info.name}, which is of unsupported type {info.type!r}")
+      apply_metadata(path, mode=None if info.issym() else info.mode, uid=uid, gid=gid, mtime=info.mtime)
+
+  # Sorting in reverse puts every directory before its parent.
+  for name in sorted(dirs, reverse=True):
+    path = dest / name
+    if path.is_dir() and not path.is_symlink():
+      uid, gid = owner(dirs[name])
+      apply_metadata(path, mode=dirs[name].mode, uid=uid, gid=gid, mtime=dirs[name].mtime)
+
+
+def member_name(name):
+  """
+  Return the path of a tarball member relative to the extraction directory,
+  refusing to extract anything outside it.
+  """
+  name = os.path.normpath(name.lstrip("/"))
+  if name == ".." or name.startswith("../"):
+    raise InvalidImageError(f"tarball member {name!r} is outside of the extraction directory")
+  return name
+
+
+def check_inside(path, dest):
+  real_path = os.path.realpath(path)
+  real_dest = os.path.realpath(dest)
+  if real_path != real_dest and not real_path.startswith(real_dest + "/"):
+    raise InvalidImageError(f"{path} is outside of the extraction directory, because of a symlink")
+
+
+def apply_metadata(path, *, mode, uid, gid, mtime):
+  # Ownership first, since chown clears setuid/setgid bits.
+  if (uid, gid) != (os.geteuid(), os.getegid()):
+    os.chown(path, uid, gid, follow_symlinks=False)
+  if mode is not None:
+    os.chmod(path, stat.S_IMODE(mode))
+  os.utime(path, (mtime, mtime), follow_symlinks=False)
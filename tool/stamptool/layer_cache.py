@@ -0,0 +1,211 @@
+import contextlib
+import fcntl
+import os
+import pathlib
+import shutil
+import stat
+import sys
+import tempfile
+
+
+class LayerCache:
+  """
+  Directory of extracted layers shared between builds, keyed by diff digest,
+  and kept under a budget of `max_bytes` by evicting the least recently used
+  layers. Flattened snapshots of several layers (see `snapshot.py`) are kept
+  here too, under their own keys.
+
+  The directory is laid out as follows:
+
+    lock                    held exclusively while looking up, publishing or
+                            evicting layers
+    layers/<key>/           a fully extracted layer
+    layers/<key>.size       disk usage of that layer, in bytes
+    locks/<key>.use         held shared by every build using the layer, so that
+                            it isn't evicted from under them; its mtime is
+                            the time the layer was last used
+    locks/<key>.populate    held exclusively while extracting the layer, so that
+                            concurrent builds don't extract it twice
+    staging/<key>.<random>/ a layer being extracted
+    pool/                   a `FilePool` of files shared between layers, if
+                            layers are extracted into one
+
+  Layers are extracted into `staging` and renamed into `layers` once they are
+  complete, so a layer in `layers` is never partially populated.
+
+  Builds that run containers use the cache from inside a VM, where the
+  directory is shared over 9p. QEMU doesn't pass the guest's locks on to the
+  host, so the locks only keep builds within one VM apart: builds in
+  different VMs may extract the same layer at once, each into its own staging
+  directory, and only one copy is published. Layers are only evicted by
+  `evict`, which the host runs once no VM is using the cache.
+
+  A file shared through the pool counts towards the size of every layer it is
+  in, so the cache may use less space than it accounts for, but never more.
+  """
+
+  def __init__(self, root, max_bytes, file_pool=None):
+    self.root = pathlib.Path(root)
+    self.max_bytes = max_bytes
+    self.file_pool = file_pool
+    for subdir in ["layers", "locks", "staging"]:
+      (self.root / subdir).mkdir(parents=True, exist_ok=True)
+    # Shared locks on the layers this process is using; released when the
+    # cache is closed (or the process exits).
+    self._use_fds = {}
+
+  def close(self):
+    for fd in self._use_fds.values():
+      os.close(fd)
+    self._use_fds.clear()
+
+  def lookup(self, digest):
+    """
+    Return the path of the extracted layer with the given diff digest if it is
+    cached, or None if it isn't. The layer stays in the cache at least until
+    this cache object is closed.
+    """
+    key = digest.replace(":", "-")
+    layer_dir = self.root / "layers" / key
+    with self._locked():
+      if not layer_dir.exists():
+        return None
+      self._use(key)
+      return layer_dir
+
+  def get(self, digest, populate):
+    """
+    Return the path of the extracted layer with the given diff digest,
+    calling `populate(path)` to extract it into an empty directory at `path`
+    if it isn't already cached. The layer stays in the cache at least until
+    this cache object is closed.
+    """
+    key = digest.replace(":", "-")
+    layer_dir = self.root / "layers" / key
+    with self._locked():
+      self._use(key)
+      if layer_dir.exists():
+        print(f"using cached layer {layer_dir}", file=sys.stderr)
+        return layer_dir
+
+    with locked_file(self.root / "locks" / f"{key}.populate", fcntl.LOCK_EX):
+      # Another build may have extracted the layer while we were waiting.
+      if not layer_dir.exists():
+        staging_dir = pathlib.Path(tempfile.mkdtemp(prefix=f"{key}.", dir=self.root / "staging"))
+        populate(staging_dir)
+        size = disk_usage(staging_dir)
+        with self._locked():
+          try:
+            staging_dir.rename(layer_dir)
+          except OSError:
+            if not layer_dir.exists():
+              raise
+            # A build in another VM published the layer first.
+            remove_tree(staging_dir)
+          else:
+            (self.root / "layers" / f"{key}.size").write_text(str(size))
+    return layer_dir
+
+  def evict(self):
+    """
+    Remove least recently used layers until the cache is within budget,
+    skipping layers that are in use, along with anything left in `staging` by
+    builds that crashed. Only safe to call while no VM is using the cache.
+    """
+    with self._locked():
+      for staging_dir in (self.root / "staging").iterdir():
+        remove_tree(staging_dir)
+      self._evict()
+
+  def _use(self, key):
+    use_path = self.root / "locks" / f"{key}.use"
+    if key not in self._use_fds:
+      fd = os.open(use_path, os.O_RDWR | os.O_CREAT, 0o644)
+      fcntl.flock(fd, fcntl.LOCK_SH)
+      self._use_fds[key] = fd
+    os.utime(use_path)
+
+  def _evict(self):
+    """
+    Must be called with the cache locked.
+    """
+    entries = []
+    for layer_dir in (self.root / "layers").iterdir():
+      if not layer_dir.is_dir():
+        continue
+      key = layer_dir.name
+      size_path = self.root / "layers" / f"{key}.size"
+      if not size_path.exists():
+        # A build crashed after publishing the layer but before recording its
+        # size.
+        size_path.write_text(str(disk_usage(layer_dir)))
+      try:
+        last_used = (self.root / "locks" / f"{key}.use").stat().st_mtime
+      except FileNotFoundError:
+        last_used = 0
+      entries.append((last_used, key, int(size_path.read_text())))
+    total = sum(size for _, _, size in entries)
+
+    evicted = False
+    for _, key, size in sorted(entries):
+      if total <= self.max_bytes:
+        break
+      if key in self._use_fds:
+        continue
+      with contextlib.ExitStack() as ctx:
+        fd = os.open(self.root / "locks" / f"{key}.use", os.O_RDWR | os.O_CREAT, 0o644)
+        ctx.callback(os.close, fd)
+        try:
+          fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+          continue # in use by another build
+        print(f"evicting cached layer {key} ({size} bytes)", file=sys.stderr)
+        remove_tree(self.root / "layers" / key)
+        (self.root / "layers" / f"{key}.size").unlink()
+        total -= size
+        evicted = True
+
+    if evicted and self.file_pool is not None:
+      self.file_pool.collect_garbage()
+
+  @contextlib.contextmanager
+  def _locked(self):
+    with locked_file(self.root / "lock", fcntl.LOCK_EX):
+      yield
+
+
+@contextlib.contextmanager
+def locked_file(path, operation):
+  fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+  try:
+    fcntl.flock(fd, operation)
+    yield
+  finally:
+    os.close(fd)
+
+
+def disk_usage(path):
+  total = 0
+  for dir_path, dir_names, file_names in os.walk(path):
+    for name in [".", *file_names]:
+      total += os.lstat(os.path.join(dir_path, name)).st_blocks * 512
+  return total
+
+
+def remove_tree(path):
+  # Extracted layers may contain read-only directories.
+  def make_writable_and_retry(func, path, exc_info):
+    os.chmod(os.path.dirname(path), 0o700)
+    func(path)
+  shutil.rmtree(path, onerror=make_writable_and_retry)
+
+
+def remove_path(path):
+  try:
+    st = os.lstat(path)
+  except FileNotFoundError:
+    return
+  if stat.S_ISDIR(st.st_mode):
+    remove_tree(path)
+  else:
+    os.unlink(path)
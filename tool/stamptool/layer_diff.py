@@ -1,46 +1,231 @@
+import filecmp
 import os
 import pathlib
-import shutil
+import stat
 import subprocess
-from .common import StampInternalError, load_manifest_and_config
+import sys
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from .common import build_cores, copy_file, load_manifest_and_config
+from .file_pool import FilePool
+from .layer_cache import LayerCache
 from .runtime import Runtime
+from .tar_writer import Member, scan_member, scan_trees, write_tar
 
 
 def main(deriv_attrs):
   if os.getuid() == 0:
     uid_handling = FullUIDHandling()
   else:
-    uid_handling = HomogeneousUIDHandling(deriv_attrs)
-  rt = Runtime()
+    uid_handling = RemappingUIDHandling(deriv_attrs)
+  out_path = pathlib.Path(deriv_attrs["outputs"]["out"])
+
+  if not deriv_attrs.get("runOnHost") and not deriv_attrs.get("runInContainer"):
+    # Nothing is going to modify the copied files, so there's no need to
+    # stage them: archive them straight from their sources.
+    pack_copy(deriv_attrs.get("copy", []), out_path, uid_handling)
+    return
 
+  if deriv_attrs.get("extractCacheDir"):
+    cache_dir = pathlib.Path(deriv_attrs["extractCacheDir"])
+    if deriv_attrs.get("runInContainer") and not os.path.ismount(cache_dir):
+      # The container runs in a VM, which has its own filesystem: anything
+      # extracted into a directory that isn't shared from the host would be
+      # lost when it shuts down.
+      raise ValueError(f"extractCacheDir {cache_dir} is not mounted from the host")
+    layer_cache = open_layer_cache(deriv_attrs)
+  else:
+    layer_cache = None
+  rt = Runtime(layer_cache=layer_cache)
   content_dir = pathlib.Path("content")
   content_dir.mkdir()
-  do_copy(deriv_attrs.get("copy", []), content_dir, uid_handling)
+  link_groups = do_copy(deriv_attrs.get("copy", []), content_dir, uid_handling)
   if deriv_attrs.get("runOnHost"):
     do_run_on_host(deriv_attrs["runOnHost"], content_dir)
   if deriv_attrs.get("runInContainer"):
     do_run_in_container(deriv_attrs, content_dir, rt)
-
-  out_path = pathlib.Path(deriv_attrs["outputs"]["out"])
+  relink_copies(link_groups, content_dir)
   pack(content_dir, out_path, uid_handling)
 
 
+def evict_main(deriv_attrs):
+  """
+  Evict layers from the extract cache until it is within extractCacheMaxSize.
+  Run on the host once the VM that ran the container has exited.
+  """
+  layer_cache = open_layer_cache(deriv_attrs)
+  layer_cache.evict()
+  layer_cache.close()
+
+
+def open_layer_cache(deriv_attrs):
+  cache_dir = pathlib.Path(deriv_attrs["extractCacheDir"])
+  file_pool = FilePool(cache_dir / "pool") if deriv_attrs.get("extractCacheShareFiles") else None
+  return LayerCache(cache_dir, deriv_attrs["extractCacheMaxSize"], file_pool=file_pool)
+
+
 def do_copy(elems, content_dir, uid_handling):
+  """
+  Copy the sources of `elems` into `content_dir`, with the same results as
+  `rsync --archive --mkpath src/ dest/` for directories and `shutil.copy2`
+  for anything else, applied in order.
+
+  All of the elements are planned into a single tree up front, and then files
+  are copied concurrently, using reflinks or `copy_file_range` where the
+  filesystem supports them.
+
+  Every path gets its own copy, even where the sources are hardlinked to each
+  other (as in an optimised Nix store), since a script may then modify one of
+  them in place. Returns the names of each group of copies whose sources were
+  hardlinked, for `relink_copies`.
+  """
+  threads = build_cores()
+  tree = plan_copy(elems, threads=threads)
+  entries = sorted(tree.values(), key=lambda m: os.fsencode(m.name))
+  dirs = [m for m in entries if stat.S_ISDIR(m.stat.st_mode)]
+
+  # Directories are kept writable until everything has been copied into them.
+  for m in dirs:
+    (content_dir / m.name).mkdir(mode=0o700)
+
+  link_groups = defaultdict(list)
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    futures = []
+    for m in entries:
+      if stat.S_ISDIR(m.stat.st_mode):
+        continue
+      if stat.S_ISREG(m.stat.st_mode) and m.stat.st_nlink > 1:
+        link_groups[(m.stat.st_dev, m.stat.st_ino, m.uid, m.gid)].append(m.name)
+      futures.append(executor.submit(copy_entry, m, content_dir, uid_handling))
+    for future in futures:
+      future.result()
+
+  for m in reversed(dirs):
+    apply_metadata(content_dir / m.name, m, uid_handling)
+  return [names for names in link_groups.values() if len(names) > 1]
+
+
+def relink_copies(link_groups, content_dir):
+  """
+  Hardlink together the copies in each of `link_groups` (as returned by
+  `do_copy`) that are still identical to the first one, so that files which
+  weren't modified are archived as hardlinks, as `pack_copy` would.
+  """
+  for first, *others in link_groups:
+    first_path = content_dir / first
+    for name in others:
+      path = content_dir / name
+      try:
+        if os.path.samefile(first_path, path) or not same_file(first_path, path):
+          continue
+        parent_mode = path.parent.stat().st_mode
+        # The directory may be read-only.
+        os.chmod(path.parent, parent_mode | stat.S_IWUSR)
+        try:
+          os.unlink(path)
+          os.link(first_path, path)
+        finally:
+          os.chmod(path.parent, stat.S_IMODE(parent_mode))
+      except (FileNotFoundError, PermissionError):
+        continue # removed or made unreadable by the script
+
+
+def same_file(a, b):
+  st_a, st_b = os.lstat(a), os.lstat(b)
+  if not stat.S_ISREG(st_a.st_mode) or (st_a.st_mode, st_a.st_uid, st_a.st_gid, st_a.st_size) != (st_b.st_mode, st_b.st_uid, st_b.st_gid, st_b.st_size):
+    return False
+  return filecmp.cmp(a, b, shallow=False)
+
+
+def plan_copy(elems, threads=1):
+  """
+  Return a dict mapping each path to be created (relative to the content
+  directory) to a `tar_writer.Member` describing where it is copied from and
+  who should own it. Directories implied by an element's destination have a
+  `path` of None.
+  """
+  tree = {}
   for elem in elems:
-    src = pathlib.Path(elem["src"])
-    dest = pathlib.PurePath(elem["dest"])
+    src = elem["src"]
+    dest = pathlib.PurePosixPath(elem["dest"])
     assert dest.is_absolute()
-    dest = content_dir / dest.relative_to("/")
+    name = dest.relative_to("/").as_posix()
     uid = elem.get("uid", 0)
     gid = elem.get("gid", uid)
 
-    if src.is_dir() and not src.is_symlink():
-      cmd = ["rsync", "--archive", "--mkpath"] + uid_handling.rsync_chown_opts(uid, gid) + [f"{src}/", f"{dest}/"]
-      subprocess.run(cmd, check=True)
+    root = scan_member(src, name)
+    if stat.S_ISDIR(root.stat.st_mode):
+      if name == ".":
+        # Copying to "/" merges the source's contents into the content
+        # directory itself.
+        roots = [(os.path.join(src, child), child) for child in sorted(os.listdir(src), key=os.fsencode)]
+      else:
+        roots = [(src, name)]
+      members = scan_trees(roots, threads=threads)
     else:
-      dest.parent.mkdir(parents=True, exist_ok=True)
-      shutil.copy2(src, dest, follow_symlinks=False)
-      uid_handling.chown(dest, uid, gid)
+      existing = tree.get(name)
+      if existing is not None and stat.S_ISDIR(existing.stat.st_mode):
+        root = scan_member(src, f"{name}/{os.path.basename(src)}")
+      members = [root]
+
+    add_implied_dirs(tree, name)
+    for m in members:
+      m.uid, m.gid = uid, gid
+      add_to_tree(tree, m)
+  return tree
+
+
+def add_implied_dirs(tree, name):
+  parent = pathlib.PurePosixPath(name).parent
+  for ancestor in reversed([parent, *parent.parents][:-1]):
+    ancestor = ancestor.as_posix()
+    existing = tree.get(ancestor)
+    if existing is None:
+      tree[ancestor] = Member(ancestor, None, IMPLIED_DIR_STAT)
+    elif not stat.S_ISDIR(existing.stat.st_mode):
+      raise NotADirectoryError(f"cannot copy to /{name}, because /{ancestor} is not a directory")
+
+
+# Directories implied by a copy destination are created as `mkdir -p` would.
+IMPLIED_DIR_STAT = os.stat_result((stat.S_IFDIR | 0o755, 0, 0, 1, 0, 0, 0, 0, 0, 0))
+
+
+def add_to_tree(tree, m):
+  existing = tree.get(m.name)
+  if existing is not None and stat.S_ISDIR(existing.stat.st_mode) and not stat.S_ISDIR(m.stat.st_mode):
+    # A non-directory replaces a directory, along with everything in it.
+    prefix = m.name + "/"
+    for name in [name for name in tree if name.startswith(prefix)]:
+      del tree[name]
+  tree[m.name] = m
+
+
+def copy_entry(m, content_dir, uid_handling):
+  dest = content_dir / m.name
+  mode = m.stat.st_mode
+  if stat.S_ISREG(mode):
+    copy_file(m.path, dest, m.stat.st_size)
+  elif stat.S_ISLNK(mode):
+    os.symlink(m.linkname, dest)
+  elif stat.S_ISFIFO(mode):
+    os.mkfifo(dest)
+  elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+    os.mknod(dest, mode, m.stat.st_rdev)
+  else:
+    return # sockets can't be copied
+  apply_metadata(dest, m, uid_handling)
+
+
+def apply_metadata(path, m, uid_handling):
+  if m.path is None:
+    # Implied directories just get the default permissions.
+    os.chmod(path, stat.S_IMODE(m.stat.st_mode))
+    return
+  # Ownership first, since chown clears setuid/setgid bits.
+  uid_handling.chown(path, m.uid, m.gid)
+  if not stat.S_ISLNK(m.stat.st_mode):
+    os.chmod(path, stat.S_IMODE(m.stat.st_mode))
+  os.utime(path, ns=(m.stat.st_atime_ns, m.stat.st_mtime_ns), follow_symlinks=False)
 
 
 def do_run_on_host(script, content_dir):
@@ -69,19 +254,33 @@ def do_run_in_container(deriv_attrs, content_dir, rt):
 
 
 def pack(content_dir, out_path, uid_handling):
-  tar_args = sorted(x.name for x in content_dir.iterdir())
-  subprocess.run(
-    [
-      "tar",
-      "--create",
-      f"--directory={content_dir}",
-      f"--file={out_path}",
-      "--numeric-owner",
-      f"--mtime=@{os.environ['SOURCE_DATE_EPOCH']}",
-      "--sort=name",
-    ] + uid_handling.pack_opts + tar_args,
-    stdout=subprocess.PIPE,
-  )
+  threads = build_cores()
+  roots = [(str(content_dir / name), name) for name in sorted(os.listdir(content_dir), key=os.fsencode)]
+  members = scan_trees(roots, threads=threads)
+  for m in members:
+    m.uid, m.gid = uid_handling.pack_owner(m.path, m.uid, m.gid)
+  write_layer(members, out_path, threads=threads)
+
+
+def pack_copy(elems, out_path, uid_handling):
+  """
+  Archive the result of copying `elems` into an empty directory, without
+  actually copying anything. The archive is the same as `do_copy` followed by
+  `pack` would produce.
+  """
+  threads = build_cores()
+  tree = plan_copy(elems, threads=threads)
+  members = sorted(tree.values(), key=lambda m: [os.fsencode(part) for part in m.name.split("/")])
+  for m in members:
+    if m.path is None:
+      m.uid, m.gid = uid_handling.default_owner
+  write_layer(members, out_path, threads=threads)
+
+
+def write_layer(members, out_path, threads=1):
+  with open(out_path, "wb") as f:
+    stats = write_tar(f, members, mtime=int(os.environ["SOURCE_DATE_EPOCH"]), threads=threads)
+  print(stats.describe(), file=sys.stderr)
 
 
 def is_root():
@@ -93,47 +292,38 @@ class UIDHandling:
 
 
 class FullUIDHandling(UIDHandling):
-  def rsync_chown_opts(self, uid, gid):
-    return [f"--chown={uid}:{gid}"]
+  """
+  Used when running as root: files are really chowned, and archived with
+  whatever ownership they end up with.
+  """
+
+  # Owner of directories implied by copy destinations.
+  default_owner = (0, 0)
 
   def chown(self, path, uid, gid):
     os.chown(path, uid, gid, follow_symlinks=False)
 
-  @property
-  def pack_opts(self):
-    return []
+  def pack_owner(self, path, uid, gid):
+    return uid, gid
+
 
+class RemappingUIDHandling(UIDHandling):
+  """
+  Used when not running as root, so files can't be chowned. Instead, the
+  ownership requested for each copied path is recorded, and applied to the
+  tar headers when packing. Anything else (created by the runOnHost script,
+  or directories implied by copy destinations) is owned by
+  runOnHostUID/runOnHostGID.
+  """
 
-class HomogeneousUIDHandling(UIDHandling):
   def __init__(self, deriv_attrs):
-    uids_requested = set()
-    gids_requested = set()
-    for copy_elem in deriv_attrs.get("copy", []):
-      uid = copy_elem.get("uid", 0)
-      gid = copy_elem.get("gid", uid)
-      uids_requested.add(uid)
-      gids_requested.add(gid)
-    if deriv_attrs.get("runOnHost"):
-      uid = deriv_attrs.get("runOnHostUID", 0)
-      gid = deriv_attrs.get("runOnHostGID", uid)
-      uids_requested.add(uid)
-      gids_requested.add(gid)
-    if len(uids_requested) > 1:
-      raise StampInternalError(f"Multiple UIDs referenced in copy/runOnHost arguments ({uids_requested!r}), but I am not running as root. This is an error in Stamp's Nix logic.")
-    if len(gids_requested) > 1:
-      raise StampInternalError(f"Multiple GIDs referenced in copy/runOnHost arguments ({gids_requested!r}), but I am not running as root. This is an error in Stamp's Nix logic.")
-    [self.uid] = list(uids_requested)
-    [self.gid] = list(gids_requested)
-
-  def rsync_chown_opts(self, uid, gid):
-    assert uid == self.uid
-    assert gid == self.gid
-    return []
+    uid = deriv_attrs.get("runOnHostUID", 0)
+    gid = deriv_attrs.get("runOnHostGID", uid)
+    self.default_owner = (uid, gid)
+    self._owners = {}
 
   def chown(self, path, uid, gid):
-    assert uid == self.uid
-    assert gid == self.gid
+    self._owners[os.fspath(path)] = (uid, gid)
 
-  @property
-  def pack_opts(self):
-    return [f"--owner={self.uid}", f"--group={self.gid}"]
+  def pack_owner(self, path, uid, gid):
+    return self._owners.get(os.fspath(path), self.default_owner)
@@ -1,12 +1,14 @@
 import json
 import os
 import sys
-from . import extract_diffs, layer_diff, nix_packing_plan, patch
+from . import extract_diffs, layer_diff, make_layer, nix_packing_plan, patch
 
 
 CMD_FUNCS = {
   "extract-diffs": extract_diffs.main,
   "layer-diff": layer_diff.main,
+  "layer-diff-evict": layer_diff.evict_main,
+  "make-layer": make_layer.main,
   "nix-packing-plan": nix_packing_plan.main,
   "patch-diffs": patch.diffs_main,
   "patch-oci": patch.oci_main,
@@ -0,0 +1,136 @@
+import contextlib
+import hashlib
+import os
+import pathlib
+import shutil
+import sys
+import zstandard
+from .common import build_cores
+from .parallel_gzip import ParallelGzipCompressor
+from .tar_writer import scan_trees, write_tar
+
+
+def main(deriv_attrs):
+  """
+  Produce a layer's diff tarball (if it isn't given to us), its compressed
+  blob, and the digests of both, in a single pass over the data.
+
+  The diff is either read from `diffTarball`, or archived directly from
+  `wholePaths` (each archived recursively) and `partialPaths` (each archived
+  without descending into it), in the same way as
+  `tar --create --sort=name --owner=0 --group=0 --numeric-owner --mtime=@$SOURCE_DATE_EPOCH`,
+  except that identical files are archived as hardlinks (see
+  `tar_writer.write_tar`).
+  """
+
+  outputs = deriv_attrs["outputs"]
+  diff_tarball = deriv_attrs.get("diffTarball")
+  with contextlib.ExitStack() as ctx:
+    sink = LayerSink(
+      diff_f=ctx.enter_context(open(outputs["diff"], "wb")) if diff_tarball is None else None,
+      blob_f=ctx.enter_context(open(outputs["out"], "wb")),
+      compression=deriv_attrs.get("compression", "gzip"),
+      compression_level=deriv_attrs.get("compressionLevel"),
+    )
+    if diff_tarball is not None:
+      with open(diff_tarball, "rb") as f:
+        shutil.copyfileobj(f, sink, CHUNK_SIZE)
+    else:
+      threads = build_cores()
+      members = store_path_members(
+        whole_paths=deriv_attrs.get("wholePaths", []),
+        partial_paths=deriv_attrs.get("partialPaths", []),
+        threads=threads,
+      )
+      stats = write_tar(sink, members, mtime=int(os.environ["SOURCE_DATE_EPOCH"]), threads=threads)
+      print(stats.describe(), file=sys.stderr)
+    sink.finish()
+
+  pathlib.Path(outputs["diffDigest"]).write_text(sink.diff_digest)
+  pathlib.Path(outputs["blobDigest"]).write_text(sink.blob_digest)
+  print(f"diff: {sink.diff_digest}, {sink.diff_size} bytes", file=sys.stderr)
+  print(f"blob: {sink.blob_digest}, {sink.blob_size} bytes", file=sys.stderr)
+
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class LayerSink:
+  """
+  Writable file-like object that hashes everything written to it as the
+  layer's diff (optionally also writing it to `diff_f`), and writes a
+  compressed copy of it to `blob_f`, hashing that too.
+  """
+
+  def __init__(self, *, diff_f, blob_f, compression="gzip", compression_level=None):
+    self._diff_f = diff_f
+    self._blob_f = blob_f
+    self._diff_hash = hashlib.sha256()
+    self._blob_hash = hashlib.sha256()
+    self._compressor = COMPRESSORS[compression](compression_level)
+    self.diff_size = 0
+    self.blob_size = 0
+
+  def write(self, data):
+    self._diff_hash.update(data)
+    self.diff_size += len(data)
+    if self._diff_f is not None:
+      self._diff_f.write(data)
+    self._write_blob(self._compressor.compress(data))
+    return len(data)
+
+  def tell(self):
+    return self.diff_size
+
+  def _write_blob(self, data):
+    if data:
+      self._blob_hash.update(data)
+      self.blob_size += len(data)
+      self._blob_f.write(data)
+
+  def finish(self):
+    self._write_blob(self._compressor.flush())
+
+  @property
+  def diff_digest(self):
+    return "sha256:" + self._diff_hash.hexdigest()
+
+  @property
+  def blob_digest(self):
+    return "sha256:" + self._blob_hash.hexdigest()
+
+
+def gzip_compressor(level):
+  # The output of this only depends on the input, not the number of threads.
+  return ParallelGzipCompressor(level=level, threads=build_cores())
+
+
+def zstd_compressor(level):
+  # zstd's output is the same for any number of worker threads >= 1, so this
+  # is reproducible regardless of how many cores the build gets.
+  return zstandard.ZstdCompressor(
+    level=3 if level is None else level,
+    threads=build_cores(),
+  ).compressobj()
+
+
+COMPRESSORS = {
+  "gzip": gzip_compressor,
+  "zstd": zstd_compressor,
+}
+
+
+def store_path_members(*, whole_paths=[], partial_paths=[], threads=1):
+  """
+  Return the members of a layer containing the given absolute paths, named
+  relative to `/` and owned by 0:0.
+  """
+  def roots(paths):
+    return [(path, path.lstrip("/")) for path in sorted(paths, key=os.fsencode)]
+  members = scan_trees(roots(whole_paths), threads=threads) + scan_trees(roots(partial_paths), recursive=False, threads=threads)
+  # Interleave the two lists by path components, in the order the scanner
+  # produces within each of them, so that the layer is sorted by name overall.
+  members.sort(key=lambda m: [os.fsencode(part) for part in m.name.split("/")])
+  for m in members:
+    m.uid = m.gid = 0
+  return members
@@ -1,25 +1,95 @@
+import array
+import bisect
 import graphlib
+import hashlib
+import heapq
+import json
+import math
+import os
 import pathlib
+import stat
+import statistics
+import sys
+import tarfile
+import time
 from dataclasses import dataclass, field
+from .common import load_manifest_and_config
 
 
 def main(deriv_attrs):
   dep_graph = DepGraph(deriv_attrs["closureInfo"])
 
+  # Paths that the base image already provides don't need to go in any layer.
+  if deriv_attrs.get("baseImage") is not None and not dep_graph.is_empty:
+    base_paths = base_image_store_paths(
+      pathlib.Path(deriv_attrs["baseImage"]),
+      pathlib.Path(deriv_attrs["baseDiffs"]),
+      store_dir=os.path.dirname(dep_graph.path(0)),
+    )
+    path_to_id = dep_graph.path_to_id()
+    node_ids = [path_to_id[p] for p in base_paths if p in path_to_id]
+    dep_graph.pop(*node_ids)
+    print(f"omitted {len(node_ids)} store paths ({sum(dep_graph.size(i) for i in node_ids)} bytes) already present in base image", file=sys.stderr)
+
+  # If we're given a previous plan, carry over as many of its layers as
+  # possible unchanged, so that they keep the same digests. Only the remaining
+  # paths are packed into new layers.
+  kept_layers = []
+  if deriv_attrs.get("previousPlan") is not None:
+    prev_layers = read_plan(deriv_attrs["previousPlan"])
+    kept_layers = keep_previous_layers(dep_graph, prev_layers)
+    print(f"kept {len(kept_layers)} of {len(prev_layers)} layers from previous plan", file=sys.stderr)
+
+  strategy_name = deriv_attrs.get("strategy", "closest-subtree")
+  strategy = STRATEGIES[strategy_name]
+  start_time = time.monotonic()
+  new_layers = strategy(dep_graph, deriv_attrs)
+  if deriv_attrs.get("splitLargePaths"):
+    new_layers = split_large_paths(new_layers, dep_graph, deriv_attrs["targetLayerSize"])
+
+  # Enforce the layer count limit, if any. Merging newly planned layers is
+  # preferred, since merging layers carried over from a previous plan would
+  # change their digests.
+  max_layers = deriv_attrs.get("maxLayers")
+  if max_layers is not None:
+    if max_layers < 1:
+      raise ValueError(f"maxLayers must be at least 1 (got {max_layers})")
+    new_layers = merge_smallest_layers(new_layers, max(1, max_layers - len(kept_layers)))
+    layers = merge_smallest_layers(kept_layers + new_layers, max_layers)
+  else:
+    layers = kept_layers + new_layers
+  print_plan_summary(strategy_name, layers, deriv_attrs["targetLayerSize"], time.monotonic() - start_time)
+
+  out_dir = pathlib.Path(deriv_attrs["outputs"]["out"])
+  out_dir.mkdir(parents=True, exist_ok=True)
+  for i, layer in enumerate(layers):
+    with open(out_dir / f"{i:04d}", "w") as f:
+      for p in sorted(layer.paths):
+        print(p, file=f)
+
+  # The same plan as a single JSON document, which Nix can load with one
+  # readFile instead of one per layer.
+  if "plan" in deriv_attrs["outputs"]:
+    with open(deriv_attrs["outputs"]["plan"], "w") as f:
+      json.dump(plan_to_json(layers), f, separators=(",", ":"), sort_keys=True)
+
+
+def pack_closest_subtree(dep_graph, deriv_attrs):
   # The overall approach is to iteratively remove subtrees from the dependency
   # graph, assigning each one to a layer.
+  target_layer_size = deriv_attrs["targetLayerSize"]
   layers = []
   layer = Layer()
-  target_layer_size = deriv_attrs["targetLayerSize"]
   while not dep_graph.is_empty:
 
     # Select the subtree that would best satisfy the available space in the current layer.
     avail_space = target_layer_size - layer.size
     assert avail_space > 0
-    subtree_root_id = dep_graph.best_node(minimise=lambda m: abs(m.closure_size - avail_space))
+    subtree_root_id = dep_graph.closest_node(avail_space)
 
     # Remove it from the dependency graph and add it to the layer.
-    layer.path_metas += dep_graph.pop_subtree(subtree_root_id)
+    node_ids = dep_graph.pop_subtree(subtree_root_id)
+    layer.add([dep_graph.path(i) for i in node_ids], sum(dep_graph.size(i) for i in node_ids))
 
     # If the layer is over half full (w.r.t. targetLayerSize), it's done.
     if layer.size >= target_layer_size // 2:
@@ -28,38 +98,369 @@ def main(deriv_attrs):
 
   if not layer.is_empty:
     layers.append(layer)
+  return layers
 
-  out_dir = pathlib.Path(deriv_attrs["outputs"]["out"])
-  out_dir.mkdir(parents=True, exist_ok=True)
-  for i, layer in enumerate(layers):
-    with open(out_dir / f"{i:04d}", "w") as f:
-      for p in sorted(layer.paths):
-        print(p, file=f)
 
+def pack_popularity(dep_graph, deriv_attrs):
+  # Order paths by how many other paths refer to them, most popular first, and
+  # fill layers in that order. Widely shared paths (glibc etc.) therefore end
+  # up together in the first layers, which rarely change between images.
+  target_layer_size = deriv_attrs["targetLayerSize"]
+  node_ids = sorted(
+    dep_graph.remaining_ids(),
+    key=lambda i: (-sum(1 for _ in dep_graph.referrers(i)), -dep_graph.closure_size(i), dep_graph.path(i)),
+  )
+  layers = []
+  layer = Layer()
+  for i in node_ids:
+    if not layer.is_empty and layer.size + dep_graph.size(i) > target_layer_size:
+      layers.append(layer)
+      layer = Layer()
+    layer.add([dep_graph.path(i)], dep_graph.size(i))
+  if not layer.is_empty:
+    layers.append(layer)
+  return layers
+
+
+def pack_dominator_groups(dep_graph, deriv_attrs):
+  # A path's dominator is the nearest path through which every chain of
+  # references to it must pass. Everything a path dominates is only in the
+  # closure because of that path, so keeping each dominator subtree within one
+  # layer means a change to one package only touches that package's layer.
+  target_layer_size = deriv_attrs["targetLayerSize"]
+  root = -1
+  idom = {}
+  depth = {root: 0}
+
+  def common_dominator(a, b):
+    while a != b:
+      if depth[a] < depth[b]:
+        b = idom[b]
+      elif depth[a] > depth[b]:
+        a = idom[a]
+      else:
+        a, b = idom[a], idom[b]
+    return a
+
+  # Referrers come before the paths they refer to in this order, so each
+  # path's referrers already have dominators assigned when it's visited.
+  dominated = {root: []}
+  for i in reversed(dep_graph.remaining_ids_depth_first()):
+    d = None
+    for ii in dep_graph.referrers(i):
+      d = ii if d is None else common_dominator(d, ii)
+    idom[i] = root if d is None else d
+    depth[i] = depth[idom[i]] + 1
+    dominated[idom[i]].append(i)
+    dominated[i] = []
+
+  subtree_sizes = {}
+  for i in dep_graph.remaining_ids_depth_first():
+    subtree_sizes[i] = dep_graph.size(i) + sum(subtree_sizes[ii] for ii in dominated[i])
+
+  def subtree(i):
+    node_ids = [i]
+    for ii in node_ids:
+      node_ids += dominated[ii]
+    return node_ids
+
+  # Split the dominator tree into groups no bigger than the target layer size
+  # (where possible), then pack the groups into layers, biggest first.
+  groups = []
+  stack = list(dominated[root])
+  while stack:
+    i = stack.pop()
+    if subtree_sizes[i] <= target_layer_size:
+      groups.append((subtree_sizes[i], subtree(i)))
+    else:
+      groups.append((dep_graph.size(i), [i]))
+      stack += dominated[i]
+  groups.sort(key=lambda g: (-g[0], min(dep_graph.path(i) for i in g[1])))
+
+  layers = []
+  for size, node_ids in groups:
+    for layer in layers:
+      if layer.size + size <= target_layer_size:
+        break
+    else:
+      layer = Layer()
+      layers.append(layer)
+    layer.add([dep_graph.path(i) for i in node_ids], size)
+  return layers
+
+
+def pack_size_bins(dep_graph, deriv_attrs):
+  # Strict bin-packing of individual paths, ignoring the dependency structure:
+  # use as many layers as the target size calls for (but no more than
+  # maxLayers), and always put the next-largest path into the emptiest layer.
+  # This gives evenly sized layers, which download in parallel well.
+  target_layer_size = deriv_attrs["targetLayerSize"]
+  node_ids = sorted(dep_graph.remaining_ids(), key=lambda i: (-dep_graph.size(i), dep_graph.path(i)))
+  if not node_ids:
+    return []
+  total_size = sum(dep_graph.size(i) for i in node_ids)
+  n_layers = max(1, math.ceil(total_size / target_layer_size))
+  if deriv_attrs.get("maxLayers") is not None:
+    n_layers = min(n_layers, deriv_attrs["maxLayers"])
+  n_layers = min(n_layers, len(node_ids))
+  layers = [Layer() for _ in range(n_layers)]
+  heap = [(0, j) for j in range(n_layers)]
+  for i in node_ids:
+    _, j = heapq.heappop(heap)
+    layers[j].add([dep_graph.path(i)], dep_graph.size(i))
+    heapq.heappush(heap, (layers[j].size, j))
+  return layers
+
+
+def split_large_paths(layers, dep_graph, target_layer_size):
+  """
+  Take every store path bigger than `target_layer_size` out of `layers`, and
+  instead spread its contents over as many extra layers as needed.
+
+  The extra layers list individual files and directories inside the store
+  path rather than the store path itself, which tells nixStoreLayer to archive
+  each entry without descending into it.
+  """
+  path_to_id = dep_graph.path_to_id()
+  result = []
+  extra_layers = []
+  for layer in layers:
+    new_layer = Layer()
+    for p in layer.paths:
+      size = dep_graph.size(path_to_id[p])
+      if size > target_layer_size and os.path.isdir(p) and not os.path.islink(p):
+        extra_layers += split_store_path(p, target_layer_size)
+      else:
+        new_layer.add([p], size)
+    if not new_layer.is_empty:
+      result.append(new_layer)
+  return result + extra_layers
+
+
+def split_store_path(store_path, target_layer_size):
+  entries = []
+  for dir_path, dir_names, file_names in os.walk(store_path):
+    for name in dir_names + file_names:
+      path = os.path.join(dir_path, name)
+      st = os.lstat(path)
+      is_dir = stat.S_ISDIR(st.st_mode)
+      entries.append((path, 0 if is_dir else st.st_size, is_dir))
+  # Sort by path components, as tar --sort=name does, so that everything in a
+  # directory comes straight after it.
+  entries.sort(key=lambda entry: [os.fsencode(part) for part in entry[0].split("/")])
+
+  # Fill layers with entries in that order. Each layer also gets the entries
+  # for every directory (including the store path itself) containing any of
+  # its entries, so that their metadata is preserved whichever layer they end
+  # up extracted from.
+  layers = []
+  layer = None
+  for path, size, is_dir in entries:
+    if layer is None or (layer.size > 0 and layer.size + size > target_layer_size):
+      layer = Layer()
+      layers.append(layer)
+      layer_dirs = set()
+    ancestors = []
+    parent = os.path.dirname(path)
+    while parent not in layer_dirs:
+      ancestors.append(parent)
+      layer_dirs.add(parent)
+      if parent == store_path:
+        break
+      parent = os.path.dirname(parent)
+    layer.add(ancestors[::-1], 0)
+    layer.add([path], size)
+    if is_dir:
+      layer_dirs.add(path)
+  return layers
+
+
+def merge_smallest_layers(layers, max_layers):
+  """
+  Repeatedly merge the two smallest layers until there are at most
+  `max_layers`. Always combining the two smallest keeps the resulting layers
+  as evenly sized as possible. A merged layer takes the position of the
+  earlier of its two constituents.
+  """
+  if len(layers) <= max_layers:
+    return layers
+  layers = list(layers)
+  # Heap entries are (size, position, generation). An entry is stale if the
+  # layer at that position has since been merged into another, or replaced by
+  # a merged layer (which bumps the position's generation).
+  generations = [0] * len(layers)
+  heap = [(layer.size, pos, 0) for pos, layer in enumerate(layers)]
+  heapq.heapify(heap)
+
+  def pop_smallest():
+    while True:
+      _, pos, generation = heapq.heappop(heap)
+      if layers[pos] is not None and generations[pos] == generation:
+        return pos
+
+  n_layers = len(layers)
+  while n_layers > max_layers:
+    pos_a, pos_b = sorted([pop_smallest(), pop_smallest()])
+    merged = Layer()
+    # Layers split from the same store path may both list the directories
+    # containing their entries.
+    paths = list(dict.fromkeys(layers[pos_a].paths + layers[pos_b].paths))
+    merged.add(paths, layers[pos_a].size + layers[pos_b].size)
+    layers[pos_a], layers[pos_b] = merged, None
+    generations[pos_a] += 1
+    heapq.heappush(heap, (merged.size, pos_a, generations[pos_a]))
+    n_layers -= 1
+  return [layer for layer in layers if layer is not None]
+
+
+STRATEGIES = {
+  "closest-subtree": pack_closest_subtree,
+  "dominator": pack_dominator_groups,
+  "popularity": pack_popularity,
+  "size-bin": pack_size_bins,
+}
+
+
+def print_plan_summary(strategy_name, layers, target_layer_size, elapsed):
+  sizes = [layer.size for layer in layers] or [0]
+  print(
+    f"{strategy_name} plan: {len(layers)} layers, "
+    f"{sum(len(layer.paths) for layer in layers)} paths, "
+    f"{sum(sizes)} bytes total; "
+    f"layer size min {min(sizes)}, max {max(sizes)}, mean {statistics.mean(sizes):.0f}, stdev {statistics.pstdev(sizes):.0f}; "
+    f"{sum(1 for size in sizes if size > target_layer_size)} layers over target; "
+    f"planned in {elapsed:.3f}s",
+    file=sys.stderr,
+  )
 
-@dataclass
-class PathMeta:
-  path: str
-  size: int # bytes
-  closure_size: int
-  refs: set = field(default_factory=set)
+
+def keep_previous_layers(dep_graph, prev_layers):
+  """
+  Remove from `dep_graph` the paths of every layer in `prev_layers` (a list of
+  lists of store paths) whose paths are all still present in it, returning
+  those layers. Layers containing any path no longer in the closure can't be
+  reproduced exactly, so are dropped.
+  """
+  path_to_id = dep_graph.path_to_id()
+  kept = []
+  for prev_paths in prev_layers:
+    node_ids = [path_to_id.get(p) for p in prev_paths]
+    if node_ids and all(i is not None and dep_graph.contains(i) for i in node_ids):
+      dep_graph.pop(*node_ids)
+      layer = Layer()
+      layer.add(list(prev_paths), sum(dep_graph.size(i) for i in node_ids))
+      kept.append(layer)
+  return kept
+
+
+def base_image_store_paths(oci_dir, diffs_dir, store_dir="/nix/store"):
+  """
+  Return the set of top-level Nix store paths present in the root filesystem
+  of the image at `oci_dir` (whose layer diffs are in `diffs_dir`), taking
+  whiteouts in upper layers into account, including those of the store
+  directory or any directory containing it.
+  """
+  _, config = load_manifest_and_config(oci_dir)
+  store_dir = store_dir.strip("/")
+  # The store directory and every directory containing it, "" being the root.
+  store_ancestors = [""]
+  for part in store_dir.split("/"):
+    store_ancestors.append(f"{store_ancestors[-1]}/{part}".lstrip("/"))
+  present = set()
+  for diff_digest in config["rootfs"]["diff_ids"]:
+    added = set()
+    removed = set()
+    cleared = False
+    # Opening the tarball for random access lets tarfile seek past each
+    # member's data rather than reading it.
+    with tarfile.open(diffs_dir / diff_digest.replace(":", "/"), "r:") as tar:
+      for info in tar:
+        name = info.name.lstrip("/")
+        if name.startswith("./"):
+          name = name[2:]
+        name = name.rstrip("/")
+        parent, _, base = name.rpartition("/")
+
+        # Whiteouts, in OCI form or as overlayfs character devices.
+        if parent in store_ancestors:
+          if base == ".wh..wh..opq":
+            target = parent
+          elif base.startswith(".wh."):
+            target = f"{parent}/{base[len('.wh.'):]}".lstrip("/")
+          elif info.ischr() and info.devmajor == 0 and info.devminor == 0:
+            target = name
+          else:
+            target = None
+          if target in store_ancestors:
+            cleared = True # the whole store directory is hidden
+          elif target is not None and parent == store_dir:
+            removed.add(target.rpartition("/")[2])
+          if target is not None:
+            continue
+
+        if name in store_ancestors and not info.isdir():
+          cleared = True # replaced by something that isn't a directory
+        elif parent == store_dir:
+          added.add(base)
+        elif name.startswith(store_dir + "/"):
+          added.add(name[len(store_dir) + 1:].split("/", 1)[0])
+    if cleared:
+      present.clear()
+    present -= removed
+    present |= added
+  return {f"/{store_dir}/{name}" for name in present}
+
+
+def plan_to_json(layers):
+  """
+  Return a JSON-serialisable representation of a plan. Each layer's key is
+  derived from its contents only, so it stays the same for as long as the
+  layer does.
+  """
+  json_layers = []
+  for layer in layers:
+    paths = sorted(layer.paths)
+    json_layers.append({
+      "key": hashlib.sha256("\n".join(paths).encode("utf-8")).hexdigest()[:32],
+      "paths": paths,
+      "pathCount": len(paths),
+      "size": layer.size,
+    })
+  return {
+    "version": 1,
+    "layers": json_layers,
+    "totalSize": sum(layer.size for layer in layers),
+  }
+
+
+def read_plan(plan_path):
+  """
+  Read a plan previously written by `main` (either the directory of per-layer
+  files, or the JSON document), returning a list of layers, each of which is
+  a list of store paths.
+  """
+  plan_path = pathlib.Path(plan_path)
+  if plan_path.is_file():
+    with open(plan_path) as f:
+      return [layer["paths"] for layer in json.load(f)["layers"]]
+  return [
+    [line for line in layer_path.read_text().split("\n") if line]
+    for layer_path in sorted(plan_path.iterdir())
+  ]
 
 
 @dataclass
 class Layer:
-  path_metas: list = field(default_factory=list)
+  paths: list = field(default_factory=list)
+  size: int = 0 # bytes; sum of the sizes of paths
 
   @property
   def is_empty(self):
-    return not self.path_metas
-
-  @property
-  def paths(self):
-    return (m.path for m in self.path_metas)
+    return not self.paths
 
-  @property
-  def size(self):
-    return sum(m.size for m in self.path_metas)
+  def add(self, paths, size):
+    self.paths += paths
+    self.size += size
 
 
 class DepGraph:
@@ -87,82 +488,279 @@ class DepGraph:
       /nix/store/cg9s562sa33k78m63njfn1rw47dp9z0i-glibc-2.40-66
     """
 
-    metas = []
-    with open(pathlib.Path(closure_info_path) / "registration") as f:
-      while True:
-        path = f.readline().rstrip("\n")
-        if not path:
-          break
-        f.readline()
-        size = int(f.readline().rstrip("\n"))
-        f.readline()
-        n_refs = int(f.readline().rstrip("\n"))
-        refs = {f.readline().rstrip("\n") for _ in range(n_refs)}
-        metas.append(PathMeta(path=path, size=size, closure_size=None, refs=refs))
-
+    # Closures can contain tens of thousands of store paths, so the graph is
+    # kept in flat typed arrays rather than one Python object per path.
+    #
     # For some efficiency, let's memoize the store paths by assigning a unique
     # identifying integer to each one. We'll assume that Nix will never give us
-    # two dicts for the same `path`, and simply use the path's position in the
-    # input file as the identifying integer.
-    self._id_to_meta = metas
+    # two entries for the same path, and simply use the path's position in the
+    # input file as the identifying integer. Each path string is then only
+    # held once, in `self._paths`.
+    with open(pathlib.Path(closure_info_path) / "registration") as f:
+      lines = f.read().split("\n")
+    self._paths = []
+    self._sizes = array.array("q")
+    ref_line_ranges = []
+    pos = 0
+    while pos < len(lines) and lines[pos]:
+      self._paths.append(lines[pos])
+      self._sizes.append(int(lines[pos+2]))
+      n_refs = int(lines[pos+4])
+      ref_line_ranges.append((pos + 5, pos + 5 + n_refs))
+      pos += 5 + n_refs
 
-    # Set up a mapping from path strings to their corresponding integers.
-    self._path_to_id = {m.path: i for i, m in enumerate(self._id_to_meta)}
+    path_to_id = {p: i for i, p in enumerate(self._paths)}
+    n = len(self._paths)
 
-    # Map each `refs` from a collection of path strings to a collection of
-    # identifying integers. Also, sometimes a path declares a dependency on
-    # itself - we'll go ahead and remove these self-loops from the dependency
-    # graph now.
-    for m in self._id_to_meta:
-      m.refs = {self._path_to_id[p] for p in m.refs if p != m.path}
+    # The references of node i are _ref_ids[_ref_offsets[i]:_ref_offsets[i+1]]
+    # (i.e. compressed sparse row format). Sometimes a path declares a
+    # dependency on itself - we'll go ahead and remove these self-loops from
+    # the dependency graph now.
+    self._ref_offsets = array.array("q", [0])
+    self._ref_ids = array.array("i")
+    for i, (start, end) in enumerate(ref_line_ranges):
+      refs = {path_to_id[p] for p in lines[start:end]}
+      refs.discard(i)
+      self._ref_ids.extend(sorted(refs))
+      self._ref_offsets.append(len(self._ref_ids))
+    del lines, ref_line_ranges, path_to_id
+
+    # Also keep the reverse mapping in the same format, so that when a node is
+    # removed we can find the nodes whose closure sizes are affected without
+    # scanning the whole graph.
+    self._rev_ref_offsets = array.array("q", bytes(8 * (n + 1)))
+    for ii in self._ref_ids:
+      self._rev_ref_offsets[ii+1] += 1
+    for i in range(n):
+      self._rev_ref_offsets[i+1] += self._rev_ref_offsets[i]
+    self._rev_ref_ids = array.array("i", bytes(4 * len(self._ref_ids)))
+    fill = self._rev_ref_offsets[:-1]
+    for i in range(n):
+      for ii in self._refs(i):
+        self._rev_ref_ids[fill[ii]] = i
+        fill[ii] += 1
+
+    self._alive = bytearray(b"\x01" * n)
+    self._n_remaining = n
 
     # Calculate a topological order of the dependency graph.
-    tsort = graphlib.TopologicalSorter()
-    for i, m in enumerate(self._id_to_meta):
-      tsort.add(i, *m.refs)
-    self._ids_depth_first = list(tsort.static_order())
+    self._ids_depth_first = self._topological_order()
+    self._depth_first_pos = array.array("i", bytes(4 * n))
+    for pos, i in enumerate(self._ids_depth_first):
+      self._depth_first_pos[i] = pos
 
+    self._closure_sizes = array.array("q", bytes(8 * n))
     self._recompute_closure_sizes()
 
-  @property
-  def _ids_depth_last(self):
-    return reversed(self._ids_depth_first)
+    # An ordered index containing a key for every remaining node, so that
+    # closest_node can bisect it instead of scanning every node. Each key
+    # encodes (closure_size, id) in a single int, which is much cheaper to
+    # compare than a tuple.
+    self._by_closure_size = SortedInts(self._index_key(i, self._closure_sizes[i]) for i in range(n))
+
+  def _refs(self, i):
+    return self._ref_ids[self._ref_offsets[i]:self._ref_offsets[i+1]]
+
+  def _rev_refs(self, i):
+    return self._rev_ref_ids[self._rev_ref_offsets[i]:self._rev_ref_offsets[i+1]]
+
+  def _topological_order(self):
+    """
+    Return the node IDs ordered such that each node comes after all the nodes
+    it refers to.
+    """
+    n_unvisited_refs = array.array("i", (self._ref_offsets[i+1] - self._ref_offsets[i] for i in range(len(self._paths))))
+    order = array.array("i", (i for i, count in enumerate(n_unvisited_refs) if count == 0))
+    for i in order:
+      for ii in self._rev_refs(i):
+        n_unvisited_refs[ii] -= 1
+        if n_unvisited_refs[ii] == 0:
+          order.append(ii)
+    if len(order) != len(self._paths):
+      raise graphlib.CycleError("dependency graph contains a cycle")
+    return order
 
   @property
   def is_empty(self):
-    return all(m is None for m in self._id_to_meta)
+    return self._n_remaining == 0
 
-  def best_node(self, *, minimise):
-    return min(
-      filter(
-        lambda tup: tup[1] is not None,
-        enumerate(self._id_to_meta),
-      ),
-      key=lambda tup: minimise(tup[1]),
-    )[0]
+  def contains(self, i):
+    """
+    Return whether node `i` has not yet been removed from the graph.
+    """
+    return bool(self._alive[i])
+
+  def path(self, i):
+    return self._paths[i]
+
+  def remaining_ids(self):
+    return (i for i in range(len(self._paths)) if self._alive[i])
+
+  def remaining_ids_depth_first(self):
+    """
+    Return the IDs of the remaining nodes, each after all the nodes it refers
+    to.
+    """
+    return [i for i in self._ids_depth_first if self._alive[i]]
+
+  def referrers(self, i):
+    return (ii for ii in self._rev_refs(i) if self._alive[ii])
+
+  def path_to_id(self):
+    """
+    Return a dict mapping each store path in the graph to its node ID.
+    """
+    return {p: i for i, p in enumerate(self._paths)}
+
+  def size(self, i):
+    return self._sizes[i]
+
+  def closure_size(self, i):
+    return self._closure_sizes[i]
+
+  def closest_node(self, closure_size):
+    """
+    Return the ID of the node whose closure size is closest to `closure_size`.
+    Ties are broken in favour of the lowest ID.
+    """
+    # The candidates are the lowest-ID node among those with the smallest
+    # closure size >= `closure_size`, and likewise for the largest closure
+    # size < `closure_size`.
+    n = len(self._paths)
+    candidates = []
+    above = self._by_closure_size.first_at_least(self._index_key(0, closure_size))
+    if above is not None:
+      candidates.append(divmod(above, n))
+    below = self._by_closure_size.last_below(self._index_key(0, closure_size))
+    if below is not None:
+      below = self._by_closure_size.first_at_least(self._index_key(0, below // n))
+      candidates.append(divmod(below, n))
+    return min(candidates, key=lambda tup: (abs(tup[0] - closure_size), tup[1]))[1]
 
   def pop_subtree(self, root_id):
     node_ids = {root_id}
-    for i in self._ids_depth_last:
-      if i in node_ids:
-        node_ids |= self._id_to_meta[i].refs
+    stack = [root_id]
+    while stack:
+      for i in self._refs(stack.pop()):
+        if self._alive[i] and i not in node_ids:
+          node_ids.add(i)
+          stack.append(i)
     return self.pop(*node_ids)
 
   def pop(self, *node_ids):
-    metas = [self._id_to_meta[i] for i in node_ids]
+    node_ids = set(node_ids)
+
+    # Each remaining node that depends on a removed node loses that node's
+    # closure size from its own. Those losses then propagate upwards to the
+    # nodes that depend on it, and so on. Visiting the affected nodes in
+    # topological order ensures that each one's total loss is known before it
+    # is passed on.
+    losses = {}
+    queue = []
+    def add_loss(i, amount):
+      if i not in losses:
+        losses[i] = 0
+        heapq.heappush(queue, (self._depth_first_pos[i], i))
+      losses[i] += amount
+
     for i in node_ids:
-      self._id_to_meta[i] = None
-    for m in self._id_to_meta:
-      if m is not None:
-        m.refs.difference_update(node_ids)
-    self._recompute_closure_sizes()
-    return metas
+      for ii in self._rev_refs(i):
+        if self._alive[ii] and ii not in node_ids:
+          add_loss(ii, self._closure_sizes[i])
+    for i in node_ids:
+      self._unindex(i)
+      self._alive[i] = 0
+    self._n_remaining -= len(node_ids)
+
+    while queue:
+      _, i = heapq.heappop(queue)
+      loss = losses[i]
+      if loss == 0:
+        continue
+      self._unindex(i)
+      self._closure_sizes[i] -= loss
+      self._by_closure_size.add(self._index_key(i, self._closure_sizes[i]))
+      for ii in self._rev_refs(i):
+        if self._alive[ii]:
+          add_loss(ii, loss)
+
+    return list(node_ids)
+
+  def _index_key(self, i, closure_size):
+    return closure_size * len(self._paths) + i
+
+  def _unindex(self, i):
+    self._by_closure_size.remove(self._index_key(i, self._closure_sizes[i]))
 
   def _recompute_closure_sizes(self):
     for i in self._ids_depth_first:
-      m = self._id_to_meta[i]
-      if m is not None:
-        m.closure_size = m.size + sum(
-          self._id_to_meta[ii].closure_size
-          for ii in m.refs
+      if self._alive[i]:
+        self._closure_sizes[i] = self._sizes[i] + sum(
+          self._closure_sizes[ii]
+          for ii in self._refs(i)
+          if self._alive[ii]
         )
+
+
+class SortedInts:
+  """
+  A sorted collection of distinct ints supporting fast insertion and removal.
+
+  The values are held in a list of sorted blocks (plus a list of each block's
+  largest value), so an insertion or removal only has to shift the contents of
+  one small block rather than the whole collection.
+  """
+
+  BLOCK_SIZE = 512
+
+  def __init__(self, values=()):
+    values = sorted(values)
+    self._blocks = [values[i:i+self.BLOCK_SIZE] for i in range(0, len(values), self.BLOCK_SIZE)]
+    self._maxes = [block[-1] for block in self._blocks]
+
+  def add(self, value):
+    if not self._blocks:
+      self._blocks.append([value])
+      self._maxes.append(value)
+      return
+    block_idx = min(bisect.bisect_left(self._maxes, value), len(self._blocks) - 1)
+    block = self._blocks[block_idx]
+    bisect.insort(block, value)
+    self._maxes[block_idx] = block[-1]
+    if len(block) > 2 * self.BLOCK_SIZE:
+      self._blocks[block_idx:block_idx+1] = [block[:self.BLOCK_SIZE], block[self.BLOCK_SIZE:]]
+      self._maxes[block_idx:block_idx+1] = [block[self.BLOCK_SIZE-1], block[-1]]
+
+  def remove(self, value):
+    block_idx = bisect.bisect_left(self._maxes, value)
+    block = self._blocks[block_idx]
+    del block[bisect.bisect_left(block, value)]
+    if block:
+      self._maxes[block_idx] = block[-1]
+    else:
+      del self._blocks[block_idx]
+      del self._maxes[block_idx]
+
+  def first_at_least(self, value):
+    """
+    Return the smallest element that is >= `value`, or None if there is none.
+    """
+    block_idx = bisect.bisect_left(self._maxes, value)
+    if block_idx == len(self._blocks):
+      return None
+    block = self._blocks[block_idx]
+    return block[bisect.bisect_left(block, value)]
+
+  def last_below(self, value):
+    """
+    Return the largest element that is < `value`, or None if there is none.
+    """
+    block_idx = bisect.bisect_left(self._maxes, value)
+    if block_idx < len(self._blocks):
+      block = self._blocks[block_idx]
+      pos = bisect.bisect_left(block, value)
+      if pos > 0:
+        return block[pos-1]
+    if block_idx > 0:
+      return self._blocks[block_idx-1][-1]
+    return None
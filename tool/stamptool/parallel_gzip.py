@@ -0,0 +1,134 @@
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from .common import InvalidImageError
+
+
+# Amount of uncompressed data in each gzip member.
+BLOCK_SIZE = 1024 * 1024
+
+# Members claiming to decompress to more than this are rejected, so that a
+# hostile blob can't make us hold huge buffers in memory.
+MAX_MEMBER_SIZE = 16 * 1024 * 1024
+
+# Each member's header carries an extra field (RFC 1952 section 2.3.1.1)
+# recording the total size of the member in bytes, so that a reader can find
+# where every member starts without decompressing anything. This is the same
+# idea as BGZF, but without its 64 KiB limit on member size.
+EXTRA_ID = b"ST"
+HEADER = struct.Struct("<BBBBIBBH2sHI")
+TRAILER = struct.Struct("<II")
+FEXTRA = 0x04
+OS_UNKNOWN = 255
+
+# The most that a member which decompresses to MAX_MEMBER_SIZE bytes can take
+# up, going by zlib's deflateBound. Members claiming to be bigger are rejected
+# before anything is buffered waiting for them to end.
+MAX_COMPRESSED_MEMBER_SIZE = (
+  MAX_MEMBER_SIZE + (MAX_MEMBER_SIZE >> 12) + (MAX_MEMBER_SIZE >> 14) + (MAX_MEMBER_SIZE >> 25) + 13
+  + HEADER.size + TRAILER.size
+)
+
+
+def compress_member(data, level=zlib.Z_DEFAULT_COMPRESSION):
+  """
+  Compress `data` into a single, self-contained gzip member whose header
+  records its own size.
+  """
+  obj = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+  body = obj.compress(data) + obj.flush()
+  header = HEADER.pack(
+    0x1f, 0x8b, 8, FEXTRA,
+    0, # mtime
+    0, # extra flags
+    OS_UNKNOWN,
+    4 + 4, # length of the extra field: one subfield header plus its data
+    EXTRA_ID, 4, HEADER.size + len(body) + TRAILER.size,
+  )
+  return header + body + TRAILER.pack(zlib.crc32(data), len(data) & 0xffffffff)
+
+
+def member_size(buf):
+  """
+  Given a buffer starting at the beginning of a gzip member, return the size
+  of that member as recorded in its header, or None if its header doesn't
+  record its size. Raises IndexError if `buf` is too short to tell, and
+  InvalidImageError if the recorded size is more than MAX_COMPRESSED_MEMBER_SIZE.
+  """
+  if len(buf) < HEADER.size:
+    raise IndexError("buffer too short")
+  magic1, magic2, method, flags, _, _, _, xlen, extra_id, extra_len, size = HEADER.unpack_from(buf)
+  if (magic1, magic2, method, flags, xlen, extra_id, extra_len) != (0x1f, 0x8b, 8, FEXTRA, 8, EXTRA_ID, 4):
+    return None
+  if size < HEADER.size + TRAILER.size:
+    return None
+  if size > MAX_COMPRESSED_MEMBER_SIZE:
+    raise InvalidImageError(f"gzip member claims to be {size} bytes long, which is more than the limit of {MAX_COMPRESSED_MEMBER_SIZE}")
+  return size
+
+
+def decompress_member(member):
+  """
+  Decompress a single gzip member as produced by `compress_member`,
+  checking its CRC and length.
+  """
+  _, isize = TRAILER.unpack_from(member, len(member) - TRAILER.size)
+  if isize > MAX_MEMBER_SIZE:
+    raise InvalidImageError(f"gzip member claims to decompress to {isize} bytes, which is more than the limit of {MAX_MEMBER_SIZE}")
+  obj = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+  try:
+    data = obj.decompress(member, isize + 1)
+  except zlib.error as e:
+    raise InvalidImageError(f"corrupt gzip member: {e}") from e
+  if not obj.eof or obj.unused_data or obj.unconsumed_tail or len(data) != isize:
+    raise InvalidImageError("gzip member does not match the size recorded in its header")
+  return data
+
+
+class ParallelGzipCompressor:
+  """
+  Block-parallel gzip compressor with the same interface as the objects
+  returned by `zlib.compressobj`.
+
+  The input is cut into blocks of `BLOCK_SIZE` bytes, each of which is
+  compressed into an independent gzip member on a pool of `threads` worker
+  threads. Members are written out in input order, so the output depends only
+  on the input and `level` - not on the number of threads or how they happen
+  to be scheduled. The concatenation of the members is a valid gzip stream.
+  """
+
+  def __init__(self, level=None, threads=1):
+    self._level = zlib.Z_DEFAULT_COMPRESSION if level is None else level
+    self._executor = ThreadPoolExecutor(max_workers=threads)
+    # Bound the amount of data held in memory.
+    self._max_pending = 2 * threads
+    self._pending = []
+    self._buf = bytearray()
+    self._any_members = False
+
+  def _submit(self, data):
+    self._pending.append(self._executor.submit(compress_member, data, self._level))
+    self._any_members = True
+
+  def _collect(self, wait_for_all):
+    out = []
+    while self._pending and (wait_for_all or len(self._pending) > self._max_pending or self._pending[0].done()):
+      out.append(self._pending.pop(0).result())
+    return b"".join(out)
+
+  def compress(self, data):
+    self._buf += data
+    while len(self._buf) >= BLOCK_SIZE:
+      self._submit(bytes(self._buf[:BLOCK_SIZE]))
+      del self._buf[:BLOCK_SIZE]
+    return self._collect(wait_for_all=False)
+
+  def flush(self):
+    # An empty input still produces one (empty) member, since a gzip stream
+    # must contain at least one.
+    if self._buf or not self._any_members:
+      self._submit(bytes(self._buf))
+      self._buf.clear()
+    out = self._collect(wait_for_all=True)
+    self._executor.shutdown()
+    return out
@@ -1,8 +1,9 @@
+import copy
 import json
 import hashlib
 import pathlib
 from dataclasses import dataclass
-from .common import load_manifest_and_config, Platform
+from .common import load_manifest_and_config, InvalidImageError, Platform
 
 
 def oci_main(deriv_attrs):
@@ -16,7 +17,7 @@ def oci_main(deriv_attrs):
     manifest, config = load_manifest_and_config(base)
     symlink_base_layer_blobs(base, out, manifest)
   else:
-    manifest, config = EMPTY_MANIFEST, EMPTY_CONFIG
+    manifest, config = copy.deepcopy(EMPTY_MANIFEST), copy.deepcopy(EMPTY_CONFIG)
 
   new_layers = [NewLayer.from_arg_dict(x) for x in deriv_attrs.get("appendLayers", [])]
   symlink_new_layer_blobs(new_layers, out)
@@ -79,11 +80,12 @@ def patch_config(deriv_attrs, new_layers, manifest, config):
 def append_layer(layer, manifest, config):
   config.setdefault("rootfs", []).setdefault("diff_ids", []).append(layer.diff_digest)
   config.setdefault("history", []).append({"created_by": "stamp.patch"})
+  try:
+    media_type = LAYER_MEDIA_TYPES[manifest["mediaType"], layer.compression]
+  except KeyError:
+    raise InvalidImageError(f"cannot append a {layer.compression}-compressed layer to a manifest of mediaType {manifest['mediaType']!r}")
   manifest.setdefault("layers", []).append({
-    "mediaType": {
-      "application/vnd.oci.image.manifest.v1+json": "application/vnd.oci.image.layer.v1.tar+gzip",
-      "application/vnd.docker.distribution.manifest.v2+json": "application/vnd.docker.image.rootfs.diff.tar.gzip",
-    }[manifest["mediaType"]],
+    "mediaType": media_type,
     "digest": layer.blob_digest,
     "size": layer.blob_size,
   })
@@ -128,6 +130,7 @@ class NewLayer:
   blob_tarball: pathlib.Path
   diff_digest: str
   blob_digest: str
+  compression: str = "gzip"
 
   @classmethod
   def from_arg_dict(cls, d):
@@ -136,6 +139,7 @@ class NewLayer:
       blob_tarball = pathlib.Path(d["blobTarball"]) if "blobTarball" in d else None,
       diff_digest = pathlib.Path(d["diffDigest"]).read_text().strip() if "diffDigest" in d else None,
       blob_digest = pathlib.Path(d["blobDigest"]).read_text().strip() if "blobDigest" in d else None,
+      compression = d.get("compression", "gzip"),
     )
 
   @property
@@ -143,6 +147,15 @@ class NewLayer:
     return self.blob_tarball.stat().st_size
 
 
+# Keyed by (manifest mediaType, layer compression algorithm).
+# Docker's manifest format has no zstd layer type.
+LAYER_MEDIA_TYPES = {
+  ("application/vnd.oci.image.manifest.v1+json", "gzip"): "application/vnd.oci.image.layer.v1.tar+gzip",
+  ("application/vnd.oci.image.manifest.v1+json", "zstd"): "application/vnd.oci.image.layer.v1.tar+zstd",
+  ("application/vnd.docker.distribution.manifest.v2+json", "gzip"): "application/vnd.docker.image.rootfs.diff.tar.gzip",
+}
+
+
 EMPTY_CONFIG = {
   "architecture": Platform.current().arch,
   "os": Platform.current().os,
@@ -5,50 +5,126 @@ import pathlib
 import shlex
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from . import mount_api
+from .common import build_cores
+from .file_pool import extract_pooled
+from .snapshot import chain_ids, flatten_layers, has_whiteouts, snapshot_key
 
 
 class Runtime:
-  def __init__(self):
+  def __init__(self, layer_cache=None):
     tmp_root = pathlib.Path("rt")
     tmp_root.mkdir()
     self.tmp_dirs = (tmp_root / str(i) for i in itertools.count())
     self.diff_extract_dirs = {}
+    # Guards tmp_dirs and diff_extract_dirs, since layers are extracted
+    # concurrently.
+    self._lock = threading.Lock()
+    # If given, a LayerCache in which extracted layers are kept between builds.
+    self.layer_cache = layer_cache
 
 
   def extract_diff(self, img_diffs_dir, digest):
-    try:
-      return self.diff_extract_dirs[digest]
-    except KeyError:
-      pass
+    with self._lock:
+      try:
+        return self.diff_extract_dirs[digest]
+      except KeyError:
+        pass
+      if self.layer_cache is None:
+        extract_dir = next(self.tmp_dirs)
     tarball_path = img_diffs_dir / digest.replace(":", "/")
-    self.diff_extract_dirs[digest] = extract_dir = next(self.tmp_dirs)
-    extract_dir.mkdir(parents=True, exist_ok=True)
-    print(f"extracting {tarball_path} to {extract_dir}...", file=sys.stderr)
-    subprocess.run(
-      ["tar", "--extract", f"--file={tarball_path}", f"--directory={extract_dir}"],
-      stdin=subprocess.DEVNULL,
-      stdout=sys.stderr,
-      check=True,
-    )
+    if self.layer_cache is not None and self.layer_cache.file_pool is not None:
+      extract_dir = self.layer_cache.get(digest, lambda path: extract_pooled(tarball_path, path, self.layer_cache.file_pool))
+    elif self.layer_cache is not None:
+      extract_dir = self.layer_cache.get(digest, lambda path: untar(tarball_path, path))
+    else:
+      extract_dir.mkdir(parents=True, exist_ok=True)
+      untar(tarball_path, extract_dir)
+    with self._lock:
+      self.diff_extract_dirs[digest] = extract_dir
     return extract_dir
 
 
+  def extract_diffs(self, img_diffs_dir, digests):
+    """
+    Extract each of the given diffs, returning their directories in the same
+    order. Up to NIX_BUILD_CORES diffs are extracted at once.
+    """
+    unique_digests = list(dict.fromkeys(digests))
+    with ThreadPoolExecutor(max_workers=build_cores()) as executor:
+      extract_dirs = dict(zip(
+        unique_digests,
+        executor.map(lambda digest: self.extract_diff(img_diffs_dir, digest), unique_digests),
+      ))
+    return [extract_dirs[digest] for digest in digests]
+
+
+  def image_lowerdirs(self, img_diffs_dir, diff_ids):
+    """
+    Return the directories to overlay (topmost first) to get the root
+    filesystem of an image with the given layers.
+
+    overlayfs doesn't understand OCI whiteouts, so the layers up to the
+    topmost one containing any are flattened into a single directory, with
+    the whiteouts applied. With a layer cache, an image with more than
+    MAX_UNFLATTENED_LAYERS layers is flattened too, and the flattened
+    snapshot is cached so that other images built on top of it can use it as
+    their bottom layer.
+    """
+    # Find the longest prefix of the image's layers that has been flattened.
+    chain = chain_ids(diff_ids)
+    n_base, base_dir = 0, None
+    if self.layer_cache is not None:
+      for n in range(len(diff_ids), 0, -1):
+        base_dir = self.layer_cache.lookup(snapshot_key(chain[n - 1]))
+        if base_dir is not None:
+          n_base = n
+          print(f"using snapshot {base_dir} of the bottom {n} layers", file=sys.stderr)
+          break
+
+    layer_dirs = self.extract_diffs(img_diffs_dir, diff_ids[n_base:])
+    if self.layer_cache is not None and len(layer_dirs) > MAX_UNFLATTENED_LAYERS:
+      n_flatten = len(layer_dirs)
+    else:
+      n_flatten = max((i + 1 for i, layer_dir in enumerate(layer_dirs) if has_whiteouts(layer_dir)), default=0)
+
+    if n_flatten > 0:
+      def populate(path):
+        to_flatten = layer_dirs[:n_flatten]
+        if base_dir is not None:
+          to_flatten.insert(0, base_dir)
+        print(f"flattening {len(to_flatten)} layers into {path}...", file=sys.stderr)
+        flatten_layers(to_flatten, path)
+      if self.layer_cache is not None:
+        base_dir = self.layer_cache.get(snapshot_key(chain[n_base + n_flatten - 1]), populate)
+      else:
+        with self._lock:
+          flat_dir = next(self.tmp_dirs)
+        flat_dir.mkdir(parents=True, exist_ok=True)
+        populate(flat_dir)
+        base_dir = flat_dir
+      layer_dirs = layer_dirs[n_flatten:]
+
+    return list(reversed(layer_dirs)) + ([base_dir] if base_dir is not None else [])
+
+
   @contextlib.contextmanager
   def overlay_mounted(self, *, lowerdirs, upperdir=None, options=[]):
-    all_options = [f"lowerdir={':'.join(map(str, lowerdirs))}"]
+    workdir = None
     if upperdir is not None:
       workdir = next(self.tmp_dirs)
       workdir.mkdir(parents=True, exist_ok=True)
-      all_options += [f"upperdir={upperdir}", f"workdir={workdir}"]
-    if options:
-      all_options.extend(options)
     mountpoint = next(self.tmp_dirs)
     mountpoint.mkdir(parents=True, exist_ok=True)
-    mount_cmd = ["mount", "-toverlay", "-o" + ",".join(all_options), "overlay", str(mountpoint)]
-    print(" ".join(mount_cmd), file=sys.stderr)
     try:
-      subprocess.run(mount_cmd, stdin=subprocess.DEVNULL, stdout=sys.stderr, check=True)
-    except subprocess.CalledProcessError:
+      if mount_api.supports_overlay_lowerdir_append():
+        print(f"mounting overlay of {len(lowerdirs)} layers at {mountpoint} with the new mount API", file=sys.stderr)
+        mount_api.mount_overlay(mountpoint, lowerdirs=lowerdirs, upperdir=upperdir, workdir=workdir, flags=options)
+      else:
+        self.legacy_mount_overlay(mountpoint, lowerdirs=lowerdirs, upperdir=upperdir, workdir=workdir, options=options)
+    except (OSError, subprocess.CalledProcessError):
       subprocess.run(["dmesg"], stdout=sys.stderr)
       raise
     try:
@@ -57,17 +133,33 @@ class Runtime:
       subprocess.run(["umount", str(mountpoint)], stdin=subprocess.DEVNULL, stdout=sys.stderr)
 
 
+  def legacy_mount_overlay(self, mountpoint, *, lowerdirs, upperdir, workdir, options):
+    # The lowerdir option is limited in length (see max_lowerdirs_per_overlay),
+    # so refer to the layers through short symlinks relative to the directory
+    # mount is run in.
+    links_dir = next(self.tmp_dirs).absolute()
+    links_dir.mkdir(parents=True, exist_ok=True)
+    for i, lowerdir in enumerate(lowerdirs):
+      (links_dir / str(i)).symlink_to(pathlib.Path(lowerdir).absolute())
+    all_options = [f"lowerdir={':'.join(map(str, range(len(lowerdirs))))}"]
+    if upperdir is not None:
+      all_options += [f"upperdir={pathlib.Path(upperdir).absolute()}", f"workdir={workdir.absolute()}"]
+    all_options.extend(options)
+    mount_cmd = ["mount", "-toverlay", "-o" + ",".join(all_options), "overlay", str(mountpoint.absolute())]
+    print(f"(in {links_dir}) " + " ".join(mount_cmd), file=sys.stderr)
+    subprocess.run(mount_cmd, cwd=links_dir, stdin=subprocess.DEVNULL, stdout=sys.stderr, check=True)
+
+
   def mount_image(self, *, ctx, config, diffs_dir, upperdir=None):
     # lowerdirs[0] is the topmost layer, lowerdirs[-1] is the bottommost layer - same order as required by overlayfs mount option.
-    curr_tier_lowerdirs = [
-      self.extract_diff(diffs_dir, digest)
-      for digest in reversed(config["rootfs"]["diff_ids"])
-    ]
+    curr_tier_lowerdirs = self.image_lowerdirs(diffs_dir, config["rootfs"]["diff_ids"])
 
-    max_lowerdirs_per_overlay = 28  # by experimentation
+    # Images with more layers than can be mounted in one overlay are mounted
+    # as a tree of nested overlays, which is slower to look paths up in.
+    max_lowerdirs = max_lowerdirs_per_overlay()
     next_tier_lowerdirs = []
-    while len(curr_tier_lowerdirs) + len(next_tier_lowerdirs) > max_lowerdirs_per_overlay:
-      group_size = min(max_lowerdirs_per_overlay + 1, len(curr_tier_lowerdirs))
+    while len(curr_tier_lowerdirs) + len(next_tier_lowerdirs) > max_lowerdirs:
+      group_size = min(max_lowerdirs + 1, len(curr_tier_lowerdirs))
       group_mountpoint = ctx.enter_context(self.overlay_mounted(
         lowerdirs = curr_tier_lowerdirs[-group_size+1:],
         upperdir = curr_tier_lowerdirs[-group_size],
@@ -121,6 +213,38 @@ class Runtime:
       subprocess.run(cmd, check=True)
 
 
+# Images with up to this many layers (or this many layers on top of a cached
+# snapshot) are mounted without flattening them first.
+MAX_UNFLATTENED_LAYERS = 4
+
+
+# mount(8) may pass options to the kernel with fsconfig, which limits each
+# option's value to 256 bytes (including the terminating NUL).
+MAX_MOUNT_OPTION_LENGTH = 255
+
+
+def max_lowerdirs_per_overlay():
+  """
+  Return the number of layers that can be mounted in a single overlay.
+  """
+  if mount_api.supports_overlay_lowerdir_append():
+    return mount_api.OVERLAY_MAX_STACK
+  n = 1
+  while len(":".join(map(str, range(n + 1)))) <= MAX_MOUNT_OPTION_LENGTH:
+    n += 1
+  return n
+
+
+def untar(tarball_path, extract_dir):
+  print(f"extracting {tarball_path} to {extract_dir}...", file=sys.stderr)
+  subprocess.run(
+    ["tar", "--extract", f"--file={tarball_path}", f"--directory={extract_dir}"],
+    stdin=subprocess.DEVNULL,
+    stdout=sys.stderr,
+    check=True,
+  )
+
+
 @contextlib.contextmanager
 def ephemeral_dir(path):
   path = pathlib.Path(path)
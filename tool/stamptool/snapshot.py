@@ -0,0 +1,150 @@
+import errno
+import hashlib
+import os
+import stat
+from .common import copy_file
+from .layer_cache import remove_path
+
+
+# Whiteouts as they appear in OCI layers...
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+# ...and as overlayfs represents them, which is how they appear in layers
+# packed from an overlay's upper directory.
+OPAQUE_XATTR = "trusted.overlay.opaque"
+
+
+def chain_ids(diff_ids):
+  """
+  Return the OCI ChainID of each prefix of `diff_ids`, which identifies the
+  filesystem produced by applying those layers in order.
+  """
+  ids = []
+  for diff_id in diff_ids:
+    if ids:
+      diff_id = "sha256:" + hashlib.sha256(f"{ids[-1]} {diff_id}".encode()).hexdigest()
+    ids.append(diff_id)
+  return ids
+
+
+def snapshot_key(chain_id):
+  """
+  Return the key under which the snapshot of the layers with the given ChainID
+  is kept in a `LayerCache`, alongside the layers themselves.
+  """
+  return f"snapshot:{chain_id}"
+
+
+def has_whiteouts(layer_dir):
+  """
+  Return whether the extracted layer at `layer_dir` contains any OCI
+  whiteouts, which overlayfs would treat as ordinary files.
+  """
+  for _, dir_names, file_names in os.walk(layer_dir):
+    if any(name.startswith(WHITEOUT_PREFIX) for name in dir_names + file_names):
+      return True
+  return False
+
+
+def flatten_layers(layer_dirs, dest):
+  """
+  Merge the extracted layers at `layer_dirs` (bottommost first) into the empty
+  directory `dest`, producing the same filesystem as overlaying them would,
+  with whiteouts applied and removed.
+
+  Files are hardlinked to the layers where possible (and otherwise reflinked
+  or copied), so neither the layers nor `dest` may be modified afterwards.
+  """
+  dir_stats = {}
+  for layer_dir in layer_dirs:
+    dir_stats["."] = os.lstat(layer_dir)
+    merge_dir(layer_dir, dest, ".", dir_stats)
+
+  # Directories are kept writable until everything has been merged into them.
+  # Sorting in reverse puts every directory before its parent.
+  for name in sorted(dir_stats, reverse=True):
+    path = os.path.join(dest, name)
+    if os.path.isdir(path) and not os.path.islink(path):
+      apply_metadata(path, dir_stats[name])
+
+
+def merge_dir(src_dir, dest_dir, name, dir_stats):
+  entries = sorted(os.scandir(src_dir), key=lambda entry: entry.name)
+  if any(entry.name == OPAQUE_WHITEOUT for entry in entries) or is_opaque(src_dir):
+    # Nothing from the layers below shows through an opaque directory.
+    for child in os.listdir(dest_dir):
+      remove_path(os.path.join(dest_dir, child))
+
+  # Whiteouts only hide what is in the layers below, so they are applied
+  # before anything from this layer is added, whatever order they sort in.
+  for entry in entries:
+    if entry.name.startswith(WHITEOUT_PREFIX) and entry.name != OPAQUE_WHITEOUT:
+      target = entry.name[len(WHITEOUT_PREFIX):]
+      # A corrupt or hostile layer mustn't be able to remove the directory
+      # being merged into, or anything outside of it.
+      if target in ("", ".", "..") or "/" in target:
+        continue
+      remove_path(os.path.join(dest_dir, target))
+
+  for entry in entries:
+    if entry.name.startswith(WHITEOUT_PREFIX):
+      continue
+    dest = os.path.join(dest_dir, entry.name)
+    st = entry.stat(follow_symlinks=False)
+    if stat.S_ISCHR(st.st_mode) and st.st_rdev == 0:
+      remove_path(dest) # an overlayfs whiteout
+    elif stat.S_ISDIR(st.st_mode):
+      # Directories are merged with those in the layers below.
+      if not is_dir(dest):
+        remove_path(dest)
+        os.mkdir(dest, 0o700)
+      child_name = os.path.join(name, entry.name)
+      dir_stats[child_name] = st
+      merge_dir(entry.path, dest, child_name, dir_stats)
+    else:
+      remove_path(dest)
+      link_entry(entry.path, dest, st)
+
+
+def is_opaque(path):
+  try:
+    return os.getxattr(path, OPAQUE_XATTR, follow_symlinks=False) == b"y"
+  except OSError:
+    return False
+
+
+def is_dir(path):
+  try:
+    return stat.S_ISDIR(os.lstat(path).st_mode)
+  except FileNotFoundError:
+    return False
+
+
+def link_entry(src, dest, st):
+  mode = st.st_mode
+  if stat.S_ISREG(mode):
+    try:
+      os.link(src, dest)
+      return
+    except OSError as e:
+      # EPERM: we aren't allowed to hardlink files we don't own.
+      if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+        raise
+    copy_file(src, dest, st.st_size)
+  elif stat.S_ISLNK(mode):
+    os.symlink(os.readlink(src), dest)
+  elif stat.S_ISFIFO(mode):
+    os.mkfifo(dest)
+  elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+    os.mknod(dest, mode, st.st_rdev)
+  else:
+    return # sockets can't be copied
+  apply_metadata(dest, st)
+
+
+def apply_metadata(path, st):
+  if os.geteuid() == 0:
+    os.chown(path, st.st_uid, st.st_gid, follow_symlinks=False)
+  if not stat.S_ISLNK(st.st_mode):
+    os.chmod(path, stat.S_IMODE(st.st_mode))
+  os.utime(path, ns=(st.st_atime_ns, st.st_mtime_ns), follow_symlinks=False)
@@ -0,0 +1,385 @@
+import errno
+import hashlib
+import io
+import os
+import stat
+import tarfile
+from collections import defaultdict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from .common import StampInternalError
+
+
+# Regular files up to this size are read by worker threads ahead of being
+# written to the archive; bigger ones are streamed in by the writer itself.
+READ_AHEAD_MAX_SIZE = 1024 * 1024
+
+# Number of files per thread that may be read ahead of the writer. Together
+# with READ_AHEAD_MAX_SIZE this bounds the memory used by read-ahead.
+READ_AHEAD_FACTOR = 8
+
+
+@dataclass
+class Member:
+  """
+  A file, directory etc at `path` on disk, to be archived under `name`.
+  """
+  name: str
+  path: str
+  stat: os.stat_result
+  linkname: str = ""
+  uid: int = 0
+  gid: int = 0
+
+
+@dataclass
+class TarStats:
+  # Bytes of file content not written because the file was archived as a
+  # hardlink to an earlier member instead.
+  hardlinked_bytes: int = 0
+  # Bytes of sparse files' holes that were not written out.
+  sparse_bytes: int = 0
+
+  def describe(self):
+    return f"saved {self.hardlinked_bytes} bytes by hardlinking identical files, {self.sparse_bytes} bytes by storing sparse files compactly"
+
+
+def scan_member(path, name):
+  st = os.lstat(path)
+  linkname = os.readlink(path) if stat.S_ISLNK(st.st_mode) else ""
+  return Member(name, path, st, linkname, st.st_uid, st.st_gid)
+
+
+def scan_dir(path, name):
+  """
+  Return a `Member` for each entry of the directory at `path`, in byte order
+  of their names (as `tar --sort=name` does).
+  """
+  return [
+    scan_member(os.path.join(path, child), f"{name}/{child}")
+    for child in sorted(os.listdir(path), key=os.fsencode)
+  ]
+
+
+def scan_trees(roots, *, recursive=True, threads=1):
+  """
+  Return a `Member` for each of `roots` (a list of `(path, name)` pairs) and,
+  if `recursive`, everything beneath each of them, in archive order.
+
+  Directories are listed concurrently on a pool of `threads` worker threads.
+  """
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    roots = list(executor.map(lambda root: scan_member(*root), roots))
+    if not recursive:
+      return roots
+
+    # Submit subdirectories as soon as their parent has been listed.
+    children = {}
+    pending = {executor.submit(scan_dir, m.path, m.name): m.path for m in roots if stat.S_ISDIR(m.stat.st_mode)}
+    while pending:
+      done, _ = wait(pending, return_when=FIRST_COMPLETED)
+      for future in done:
+        path = pending.pop(future)
+        children[path] = future.result()
+        for m in children[path]:
+          if stat.S_ISDIR(m.stat.st_mode):
+            pending[executor.submit(scan_dir, m.path, m.name)] = m.path
+
+  members = []
+  stack = roots[::-1]
+  while stack:
+    m = stack.pop()
+    members.append(m)
+    if stat.S_ISDIR(m.stat.st_mode):
+      stack.extend(reversed(children[m.path]))
+  return members
+
+
+def write_tar(fileobj, members, *, mtime=0, threads=1):
+  """
+  Write a deterministic tar archive of `members` (in the given order) to
+  `fileobj`, with every member having the given modification time. Returns a
+  `TarStats`.
+
+  A regular file is archived as a hardlink to an earlier member if it is the
+  same inode, or if neither is writable and they have the same content, mode
+  and owner. Sparse files are archived in GNU sparse format, without their
+  holes.
+
+  Small files are read (and candidates for deduplication are hashed) on a pool
+  of `threads` worker threads, but the archive doesn't depend on the number of
+  threads.
+  """
+  stats = TarStats()
+  with ThreadPoolExecutor(max_workers=threads) as executor:
+    candidates = dedup_candidates(executor, members)
+    entries = iter_tarinfos(members, mtime, stats)
+    entries = read_ahead(executor, entries, candidates, window=READ_AHEAD_FACTOR * threads)
+    with tarfile.open(fileobj=fileobj, mode="w", format=tarfile.GNU_FORMAT) as tar:
+      for member, info, sparse_map, data in link_duplicates(entries, stats):
+        if sparse_map is not None:
+          add_sparse_member(tar, info, member.path, sparse_map)
+        elif data is not None:
+          tar.addfile(info, io.BytesIO(data))
+        elif info.isreg():
+          with open(member.path, "rb") as f:
+            tar.addfile(info, f)
+        else:
+          tar.addfile(info)
+  return stats
+
+
+def is_dedup_candidate(m):
+  mode = m.stat.st_mode
+  return stat.S_ISREG(mode) and m.stat.st_size > 0 and not mode & 0o222
+
+
+def dedup_candidates(executor, members):
+  """
+  Return the `(st_dev, st_ino)` of each regular file which might be identical
+  to another member, and so needs its content hashed.
+
+  Small files are hashed as they are read ahead, so cost nothing extra, but
+  bigger ones would have to be read once to hash them and again to archive
+  them. These are only candidates if the first READ_AHEAD_MAX_SIZE bytes of
+  another one match too, which is checked here.
+  """
+  by_key = defaultdict(dict)
+  for m in members:
+    if is_dedup_candidate(m):
+      key = (m.stat.st_size, stat.S_IMODE(m.stat.st_mode), m.uid, m.gid)
+      by_key[key][(m.stat.st_dev, m.stat.st_ino)] = m.path
+
+  big = {
+    inode: path
+    for (size, *_), group in by_key.items()
+    if len(group) > 1 and size > READ_AHEAD_MAX_SIZE
+    for inode, path in group.items()
+  }
+  prefix_digests = dict(zip(big, executor.map(hash_prefix, big.values())))
+
+  candidates = set()
+  for (size, *_), group in by_key.items():
+    if len(group) < 2:
+      continue
+    if size <= READ_AHEAD_MAX_SIZE:
+      candidates.update(group)
+      continue
+    by_prefix = defaultdict(list)
+    for inode in group:
+      by_prefix[prefix_digests[inode]].append(inode)
+    candidates.update(inode for inodes in by_prefix.values() if len(inodes) > 1 for inode in inodes)
+  return candidates
+
+
+def hash_file(path):
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    while data := f.read(READ_AHEAD_MAX_SIZE):
+      h.update(data)
+  return h.digest()
+
+
+def hash_prefix(path):
+  with open(path, "rb") as f:
+    return hashlib.sha256(f.read(READ_AHEAD_MAX_SIZE)).digest()
+
+
+def iter_tarinfos(members, mtime, stats):
+  """
+  Yield `(member, tarinfo, sparse_map)` for each member, in order, in the same
+  way that `TarFile.gettarinfo` would. `sparse_map` is the list of data
+  segments of a sparse file, or None.
+
+  Hardlinks between files with identical content are made afterwards, by
+  `link_duplicates`.
+  """
+  inodes = {}
+  for m in members:
+    mode = m.stat.st_mode
+    info = tarfile.TarInfo(m.name)
+    sparse_map = None
+    if stat.S_ISREG(mode):
+      inode = (m.stat.st_dev, m.stat.st_ino)
+      # Members can be given owners other than those on disk, so only link
+      # to the same inode when it has the same owner.
+      owned_inode = (*inode, m.uid, m.gid)
+      if m.stat.st_nlink > 1 and owned_inode in inodes and info.name != inodes[owned_inode]:
+        info.type = tarfile.LNKTYPE
+        info.linkname = inodes[owned_inode]
+        stats.hardlinked_bytes += m.stat.st_size
+      else:
+        info.type = tarfile.REGTYPE
+        info.size = m.stat.st_size
+        inodes[owned_inode] = info.name
+        if m.stat.st_blocks * 512 < m.stat.st_size:
+          sparse_map = data_segments(m.path, m.stat.st_size)
+          if sparse_map is not None:
+            stats.sparse_bytes += m.stat.st_size - sum(n for _, n in sparse_map)
+    elif stat.S_ISDIR(mode):
+      info.type = tarfile.DIRTYPE
+    elif stat.S_ISFIFO(mode):
+      info.type = tarfile.FIFOTYPE
+    elif stat.S_ISLNK(mode):
+      info.type = tarfile.SYMTYPE
+      info.linkname = m.linkname
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+      info.type = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+      info.devmajor = os.major(m.stat.st_rdev)
+      info.devminor = os.minor(m.stat.st_rdev)
+    else:
+      continue # sockets can't be archived
+    info.mode = mode
+    info.uid = m.uid
+    info.gid = m.gid
+    info.uname = info.gname = ""
+    info.mtime = mtime
+    yield m, info, sparse_map
+
+
+def data_segments(path, size):
+  """
+  Return the `(offset, length)` of each region of the file at `path` that
+  contains data, followed by a zero-length segment at the end of the file if
+  the file ends in a hole (as GNU tar does). Returns None if the file has no
+  holes or the filesystem can't tell us where they are.
+  """
+  segments = []
+  with open(path, "rb") as f:
+    pos = 0
+    while pos < size:
+      try:
+        start = os.lseek(f.fileno(), pos, os.SEEK_DATA)
+      except OSError as e:
+        if e.errno == errno.ENXIO:
+          break # the rest of the file is a hole
+        if e.errno == errno.EINVAL:
+          return None
+        raise
+      end = min(os.lseek(f.fileno(), start, os.SEEK_HOLE), size)
+      segments.append((start, end - start))
+      pos = end
+  if segments == [(0, size)]:
+    return None
+  if not segments or sum(segments[-1]) != size:
+    segments.append((size, 0))
+  return segments
+
+
+# Layout of the sparse-file fields of an old-style GNU tar header.
+SPARSE_OFFSET = 386
+SPARSE_IN_HEADER = 4
+SPARSE_IN_EXTENSION = 21
+IS_EXTENDED_OFFSET = 482
+REAL_SIZE_OFFSET = 483
+
+
+def add_sparse_member(tar, info, path, segments):
+  """
+  Write a GNU sparse member (type "S") for the file at `path` to `tar`,
+  containing only the given data segments.
+  """
+  real_size = info.size
+  info.type = tarfile.GNUTYPE_SPARSE
+  info.size = sum(n for _, n in segments)
+  buf = bytearray(info.tobuf(tar.format, tar.encoding, tar.errors))
+
+  # Patch the sparse map into the (last) header block, then fix its checksum.
+  header = len(buf) - tarfile.BLOCKSIZE
+  pack_sparse_entries(buf, header + SPARSE_OFFSET, segments[:SPARSE_IN_HEADER])
+  buf[header + IS_EXTENDED_OFFSET] = len(segments) > SPARSE_IN_HEADER
+  buf[header + REAL_SIZE_OFFSET:header + REAL_SIZE_OFFSET + 12] = tarfile.itn(real_size, 12, tarfile.GNU_FORMAT)
+  chksum = tarfile.calc_chksums(buf[header:])[0]
+  buf[header + 148:header + 155] = b"%06o\0" % chksum
+
+  # Any further entries go in extension blocks following the header.
+  rest = segments[SPARSE_IN_HEADER:]
+  for i in range(0, len(rest), SPARSE_IN_EXTENSION):
+    block = bytearray(tarfile.BLOCKSIZE)
+    pack_sparse_entries(block, 0, rest[i:i + SPARSE_IN_EXTENSION])
+    block[SPARSE_IN_EXTENSION * 24] = i + SPARSE_IN_EXTENSION < len(rest)
+    buf += block
+
+  tar.fileobj.write(buf)
+  tar.offset += len(buf)
+  with open(path, "rb") as f:
+    for offset, length in segments:
+      f.seek(offset)
+      tarfile.copyfileobj(f, tar.fileobj, length)
+  remainder = info.size % tarfile.BLOCKSIZE
+  if remainder:
+    tar.fileobj.write(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+    info.size += tarfile.BLOCKSIZE - remainder
+  tar.offset += info.size
+  tar.members.append(info)
+
+
+def pack_sparse_entries(buf, pos, segments):
+  for offset, length in segments:
+    buf[pos:pos + 24] = tarfile.itn(offset, 12, tarfile.GNU_FORMAT) + tarfile.itn(length, 12, tarfile.GNU_FORMAT)
+    pos += 24
+
+
+def read_file(path, size, digest):
+  """
+  Return the content of the file at `path` and, if `digest`, its SHA-256.
+  """
+  with open(path, "rb") as f:
+    data = f.read()
+  if len(data) != size:
+    raise StampInternalError(f"{path} changed size while being archived")
+  return data, hashlib.sha256(data).digest() if digest else None
+
+
+def read_ahead(executor, entries, candidates, window):
+  """
+  Yield `(member, tarinfo, sparse_map, data, digest)` for each of `entries`,
+  in order, where `data` is the content of small regular files and None
+  otherwise, and `digest` is the SHA-256 of the content of files in
+  `candidates` and None otherwise. Both are produced on `executor`, up to
+  `window` entries ahead.
+  """
+  queue = deque()
+  for member, info, sparse_map in entries:
+    future = None
+    if info.isreg():
+      digest = (member.stat.st_dev, member.stat.st_ino) in candidates
+      if sparse_map is None and info.size <= READ_AHEAD_MAX_SIZE:
+        future = executor.submit(read_file, member.path, info.size, digest)
+      elif digest:
+        future = executor.submit(lambda path: (None, hash_file(path)), member.path)
+    queue.append((member, info, sparse_map, future))
+    if len(queue) > window:
+      yield resolve_read_ahead(*queue.popleft())
+  while queue:
+    yield resolve_read_ahead(*queue.popleft())
+
+
+def resolve_read_ahead(member, info, sparse_map, future):
+  data, digest = future.result() if future is not None else (None, None)
+  return member, info, sparse_map, data, digest
+
+
+def link_duplicates(entries, stats):
+  """
+  Yield `(member, tarinfo, sparse_map, data)` for each of `entries` (as
+  produced by `read_ahead`), in order, turning each regular file whose content,
+  mode and owner are identical to an earlier one's into a hardlink to it.
+  """
+  contents = {}
+  # Names of files turned into hardlinks, and the member each now links to.
+  link_targets = {}
+  for member, info, sparse_map, data, digest in entries:
+    if info.islnk():
+      info.linkname = link_targets.get(info.linkname, info.linkname)
+    elif digest is not None:
+      content = (info.size, stat.S_IMODE(info.mode), info.uid, info.gid, digest)
+      if content in contents:
+        info.type = tarfile.LNKTYPE
+        info.linkname = link_targets[info.name] = contents[content]
+        info.size = 0
+        stats.hardlinked_bytes += member.stat.st_size
+        sparse_map = data = None
+      else:
+        contents[content] = info.name
+    yield member, info, sparse_map, data
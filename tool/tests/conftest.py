@@ -1,4 +1,6 @@
 import copy
+import hashlib
+import json
 import os
 import pathlib
 import pytest
@@ -115,3 +117,41 @@ class environment:
     for name, value in self._saved.items():
       os.environ[name] = value
     self._saved = None
+
+
+def write_oci_image(oci_path, manifests):
+  """
+  Write a minimal OCI image directory containing an index that refers to the
+  given manifests. Each element of `manifests` should be a dict with a
+  "layers" key (a list of compressed layer blobs) and optionally "platform",
+  "mediaType" (applied to all layers) and "diff_ids" keys.
+  """
+
+  blobs_path = oci_path / "blobs/sha256"
+  blobs_path.mkdir(parents=True)
+
+  def write_blob(data):
+    digest = hashlib.sha256(data).hexdigest()
+    (blobs_path / digest).write_bytes(data)
+    return {"digest": f"sha256:{digest}", "size": len(data)}
+
+  manifest_refs = []
+  for m in manifests:
+    manifest = {
+      "schemaVersion": 2,
+      "mediaType": "application/vnd.oci.image.manifest.v1+json",
+      "config": {
+        "mediaType": "application/vnd.oci.image.config.v1+json",
+        **write_blob(json.dumps({"rootfs": {"type": "layers", "diff_ids": m.get("diff_ids", [])}}).encode("utf-8")),
+      },
+      "layers": [
+        {"mediaType": m.get("mediaType", "application/vnd.oci.image.layer.v1.tar+gzip"), **write_blob(layer)}
+        for layer in m["layers"]
+      ],
+    }
+    manifest_ref = {"mediaType": manifest["mediaType"], **write_blob(json.dumps(manifest).encode("utf-8"))}
+    if "platform" in m:
+      manifest_ref["platform"] = m["platform"]
+    manifest_refs.append(manifest_ref)
+
+  (oci_path / "index.json").write_text(json.dumps({"schemaVersion": 2, "manifests": manifest_refs}))
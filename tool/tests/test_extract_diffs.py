@@ -1,6 +1,12 @@
+import gzip
+import hashlib
+import shutil
+import zstandard
+from pytest import raises
 from stamptool import extract_diffs
+from stamptool.common import InvalidImageError, Platform, PlatformMismatch
 from testfixtures import compare
-from .conftest import compare_dir_entries
+from .conftest import compare_dir_entries, write_oci_image
 
 
 def test_extract_diffs(testdata, tmp_path):
@@ -13,3 +19,111 @@ def test_extract_diffs(testdata, tmp_path):
   [sha256_path] = compare_dir_entries(out_path, expected=["sha256"])
   [diff_path] = compare_dir_entries(sha256_path, expected=["6b40aa9e85fff948c00254614ad3e394b7232aa052d3ba7492f599bd0c01ff1b"])
   compare(diff_path.stat().st_size, expected=3072)
+
+
+def test_extract_diffs_blob_digest_mismatch(testdata, tmp_path):
+  oci_path = tmp_path / "oci"
+  shutil.copytree(testdata / "image1", oci_path)
+  blob_path = oci_path / "blobs/sha256/680548d6538925f29b19de954184c7d1f86ef3fb22b90ee3a24eb26143c093fe"
+  blob_path.write_bytes(gzip.compress(b"corrupted"))
+
+  with raises(InvalidImageError):
+    extract_diffs.main({
+      "oci": str(oci_path),
+      "outputs": {"out": str(tmp_path / "out")},
+    })
+
+
+def test_extract_diffs_concurrent(tmp_path, monkeypatch):
+  monkeypatch.setenv("NIX_BUILD_CORES", "4")
+  diffs = [bytes([i]) * (i * 100000) for i in range(1, 9)]
+  oci_path = tmp_path / "oci"
+  write_oci_image(oci_path, [{"layers": [gzip.compress(diff) for diff in diffs]}])
+
+  out_path = tmp_path / "out"
+  extract_diffs.main({
+    "oci": str(oci_path),
+    "outputs": {"out": str(out_path)},
+  })
+
+  [sha256_path] = compare_dir_entries(out_path, expected=["sha256"])
+  diff_paths = compare_dir_entries(sha256_path, expected=[hashlib.sha256(diff).hexdigest() for diff in diffs])
+  for diff_path, diff in zip(diff_paths, diffs):
+    compare(diff_path.read_bytes(), expected=diff)
+
+
+def test_extract_diffs_platforms(tmp_path):
+  amd64_diff, arm64_diff, s390x_diff = b"amd64", b"arm64", b"s390x"
+  oci_path = tmp_path / "oci"
+  write_oci_image(oci_path, [
+    {"layers": [gzip.compress(amd64_diff)], "platform": {"architecture": "amd64", "os": "linux"}},
+    {"layers": [gzip.compress(arm64_diff)], "platform": {"architecture": "arm64", "os": "linux"}},
+    {"layers": [gzip.compress(s390x_diff)], "platform": {"architecture": "s390x", "os": "linux"}},
+  ])
+
+  out_path = tmp_path / "out"
+  extract_diffs.main({
+    "oci": str(oci_path),
+    "platforms": ["linux/amd64", "linux/s390x"],
+    "outputs": {"out": str(out_path)},
+  })
+
+  [sha256_path] = compare_dir_entries(out_path, expected=["sha256"])
+  compare_dir_entries(sha256_path, expected=[
+    hashlib.sha256(amd64_diff).hexdigest(),
+    hashlib.sha256(s390x_diff).hexdigest(),
+  ])
+
+
+def test_extract_diffs_platform_variant(tmp_path):
+  v6_diff, v7_diff = b"arm/v6", b"arm/v7"
+  oci_path = tmp_path / "oci"
+  write_oci_image(oci_path, [
+    {"layers": [gzip.compress(v6_diff)], "platform": {"architecture": "arm", "os": "linux", "variant": "v6"}},
+    {"layers": [gzip.compress(v7_diff)], "platform": {"architecture": "arm", "os": "linux", "variant": "v7"}},
+  ])
+
+  out_path = tmp_path / "out"
+  extract_diffs.main({
+    "oci": str(oci_path),
+    "platforms": ["linux/arm/v7"],
+    "outputs": {"out": str(out_path)},
+  })
+
+  [sha256_path] = compare_dir_entries(out_path, expected=["sha256"])
+  compare_dir_entries(sha256_path, expected=[hashlib.sha256(v7_diff).hexdigest()])
+  compare(str(Platform.parse("linux/arm/v7")), expected="linux/arm/v7")
+  with raises(ValueError):
+    Platform.parse("linux/arm/v7/extra")
+
+
+def test_extract_diffs_no_matching_platform(tmp_path):
+  oci_path = tmp_path / "oci"
+  write_oci_image(oci_path, [
+    {"layers": [gzip.compress(b"amd64")], "platform": {"architecture": "amd64", "os": "linux"}},
+    {"layers": [gzip.compress(b"arm/v7")], "platform": {"architecture": "arm", "os": "linux", "variant": "v7"}},
+  ])
+
+  with raises(PlatformMismatch, match=r"linux/s390x, linux/arm/v6 \(available: linux/amd64, linux/arm/v7\)"):
+    extract_diffs.main({
+      "oci": str(oci_path),
+      "platforms": ["linux/s390x", "linux/arm/v6"],
+      "outputs": {"out": str(tmp_path / "out")},
+    })
+
+
+def test_extract_diffs_zstd(tmp_path):
+  diff = b"hello world" * 1000
+  blob = zstandard.ZstdCompressor(level=3).compress(diff[:5000]) + zstandard.ZstdCompressor(level=19).compress(diff[5000:])
+  oci_path = tmp_path / "oci"
+  write_oci_image(oci_path, [{"layers": [blob], "mediaType": "application/vnd.oci.image.layer.v1.tar+zstd"}])
+
+  out_path = tmp_path / "out"
+  extract_diffs.main({
+    "oci": str(oci_path),
+    "outputs": {"out": str(out_path)},
+  })
+
+  [sha256_path] = compare_dir_entries(out_path, expected=["sha256"])
+  [diff_path] = compare_dir_entries(sha256_path, expected=[hashlib.sha256(diff).hexdigest()])
+  compare(diff_path.read_bytes(), expected=diff)
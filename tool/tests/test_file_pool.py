@@ -0,0 +1,92 @@
+import io
+import os
+import pytest
+import stat
+import tarfile
+from stamptool.common import InvalidImageError
+from stamptool.file_pool import FilePool, extract_pooled
+from testfixtures import compare
+from .conftest import compare_dir_entries
+
+
+def write_tarball(path, members):
+  """
+  Write a tarball containing `members`, each a `(tarinfo, content)` pair.
+  """
+  with tarfile.open(path, "w") as tar:
+    for info, content in members:
+      info.mtime = 1000
+      if content is not None:
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+      else:
+        tar.addfile(info)
+
+
+def member(name, type=tarfile.REGTYPE, mode=0o644, linkname=""):
+  info = tarfile.TarInfo(name)
+  info.type = type
+  info.mode = mode
+  info.linkname = linkname
+  return info
+
+
+def test_file_pool_extract(tmp_path):
+  write_tarball(tmp_path / "a.tar", [
+    (member("./etc", tarfile.DIRTYPE, 0o555), None),
+    (member("./etc/hostname"), b"stamp"),
+    (member("./etc/hostname.bak", tarfile.LNKTYPE, linkname="./etc/hostname"), None),
+    (member("./etc/localtime", tarfile.SYMTYPE, 0o777, "../usr/share/zoneinfo/UTC"), None),
+    (member("./usr/share/zoneinfo/UTC"), b"TZif"),
+    (member("./usr/bin/hello", mode=0o755), b"TZif"),
+  ])
+  write_tarball(tmp_path / "b.tar", [
+    (member("UTC"), b"TZif"),
+  ])
+  pool = FilePool(tmp_path / "pool")
+  (tmp_path / "a").mkdir()
+  (tmp_path / "b").mkdir()
+  extract_pooled(tmp_path / "a.tar", tmp_path / "a", pool)
+  extract_pooled(tmp_path / "b.tar", tmp_path / "b", pool)
+
+  [etc, usr] = compare_dir_entries(tmp_path / "a", expected=["etc", "usr"])
+  [hostname, hostname_bak, localtime] = compare_dir_entries(etc, expected=["hostname", "hostname.bak", "localtime"])
+  compare(hostname.read_bytes(), expected=b"stamp")
+  compare(os.readlink(localtime), expected="../usr/share/zoneinfo/UTC")
+  compare(stat.S_IMODE(etc.stat().st_mode), expected=0o555)
+  compare(etc.stat().st_mtime, expected=1000)
+  utc = usr / "share" / "zoneinfo" / "UTC"
+  hello = usr / "bin" / "hello"
+  compare(stat.S_IMODE(hello.stat().st_mode), expected=0o755)
+
+  # Files with the same content and metadata share an inode, within and across
+  # layers, but files with different metadata don't.
+  compare(hostname_bak.stat().st_ino, expected=hostname.stat().st_ino)
+  compare((tmp_path / "b" / "UTC").stat().st_ino, expected=utc.stat().st_ino)
+  assert hello.stat().st_ino != utc.stat().st_ino
+
+  # Files are removed from the pool once no layer uses them.
+  os.chmod(etc, 0o755)
+  os.unlink(hostname)
+  os.unlink(hostname_bak)
+  pool.collect_garbage()
+  compare(sum(len(files) for _, _, files in os.walk(tmp_path / "pool" / "objects")), expected=2)
+  compare(os.listdir(tmp_path / "pool" / "tmp"), expected=[])
+
+
+def test_file_pool_extract_outside(tmp_path):
+  pool = FilePool(tmp_path / "pool")
+  (tmp_path / "secret").write_bytes(b"secret")
+  for i, members in enumerate([
+    [(member("../escape"), b"x")],
+    [(member("link", tarfile.SYMTYPE, 0o777, str(tmp_path)), None), (member("link/escape"), b"x")],
+    # A hardlink to a file outside, through a symlinked parent directory.
+    [(member("link", tarfile.SYMTYPE, 0o777, str(tmp_path)), None), (member("stolen", tarfile.LNKTYPE, linkname="link/secret"), None)],
+  ]):
+    write_tarball(tmp_path / f"{i}.tar", members)
+    (tmp_path / str(i)).mkdir()
+    with pytest.raises(InvalidImageError):
+      extract_pooled(tmp_path / f"{i}.tar", tmp_path / str(i), pool)
+  assert not (tmp_path / "escape").exists()
+  assert not (tmp_path / "2" / "stolen").exists()
+  compare((tmp_path / "secret").stat().st_nlink, expected=1)
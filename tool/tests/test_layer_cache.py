@@ -0,0 +1,74 @@
+import os
+from stamptool.layer_cache import LayerCache
+from testfixtures import compare
+
+
+def populate_with(size, calls):
+  def populate(path):
+    calls.append(path.name.split(".")[0])
+    (path / "sub").mkdir()
+    (path / "sub" / "file").write_bytes(b"x" * size)
+    (path / "sub").chmod(0o555)
+  return populate
+
+
+def test_layer_cache_reuse(tmp_path):
+  calls = []
+  cache = LayerCache(tmp_path / "cache", max_bytes=1 << 30)
+  path = cache.get("sha256:aaa", populate_with(100, calls))
+  compare((path / "sub" / "file").read_bytes(), expected=b"x" * 100)
+  compare(calls, expected=["sha256-aaa"])
+  cache.close()
+
+  # A second build finds the layer already extracted.
+  cache = LayerCache(tmp_path / "cache", max_bytes=1 << 30)
+  compare(cache.get("sha256:aaa", populate_with(100, calls)), expected=path)
+  compare(calls, expected=["sha256-aaa"])
+  cache.close()
+
+
+def test_layer_cache_eviction(tmp_path):
+  calls = []
+  size = 1 << 20
+  cache = LayerCache(tmp_path / "cache", max_bytes=int(2.5 * size))
+  a = cache.get("sha256:aaa", populate_with(size, calls))
+  b = cache.get("sha256:bbb", populate_with(size, calls))
+  cache.close()
+  os.utime(tmp_path / "cache/locks/sha256-aaa.use", (0, 0))
+  os.utime(tmp_path / "cache/locks/sha256-bbb.use", (1, 1))
+
+  # Layers in use by another build are not evicted, even if they are the
+  # least recently used.
+  other_build = LayerCache(tmp_path / "cache", max_bytes=int(2.5 * size))
+  other_build.get("sha256:aaa", populate_with(size, calls))
+  os.utime(tmp_path / "cache/locks/sha256-aaa.use", (0, 0))
+
+  cache = LayerCache(tmp_path / "cache", max_bytes=int(2.5 * size))
+  c = cache.get("sha256:ccc", populate_with(size, calls))
+  # Layers are only evicted when asked to.
+  compare((a.exists(), b.exists(), c.exists()), expected=(True, True, True))
+  (tmp_path / "cache/staging/sha256-ddd.crashed").mkdir()
+  cache.evict()
+  compare(calls, expected=["sha256-aaa", "sha256-bbb", "sha256-ccc"])
+  compare((a.exists(), b.exists(), c.exists()), expected=(True, False, True))
+  compare(sorted(os.listdir(tmp_path / "cache/staging")), expected=[])
+  other_build.close()
+  cache.close()
+
+
+def test_layer_cache_concurrent_populate(tmp_path):
+  # Builds in different VMs can't see each other's locks, so may both extract
+  # a layer. The first to finish publishes it, and the other uses that copy.
+  calls = []
+  cache = LayerCache(tmp_path / "cache", max_bytes=1 << 30)
+  def populate(path):
+    populate_with(100, calls)(path)
+    other_vm_dir = tmp_path / "cache/layers/sha256-aaa"
+    other_vm_dir.mkdir()
+    (other_vm_dir / "file").write_bytes(b"other")
+  path = cache.get("sha256:aaa", populate)
+  compare(calls, expected=["sha256-aaa"])
+  compare((path / "file").read_bytes(), expected=b"other")
+  compare(os.listdir(tmp_path / "cache/staging"), expected=[])
+  cache.close()
+
@@ -1,7 +1,7 @@
-from pytest import raises
+import pathlib
+import pytest
 from stamptool import layer_diff
-from stamptool.common import StampInternalError
-from tarfile import DIRTYPE, REGTYPE, SYMTYPE
+from tarfile import DIRTYPE, LNKTYPE, REGTYPE, SYMTYPE
 from testfixtures import compare
 from .conftest import chdir, compare_dir_entries, compare_tar_entries, environment
 
@@ -70,15 +70,181 @@ def test_layer_diff_uid_gid(testdata, tmp_path):
 
 
 def test_layer_diff_multiple_uids(testdata, tmp_path):
+  # When not running as root, the requested ownership is applied as the
+  # layer is packed, rather than by chowning files.
   out_path = tmp_path / "out"
   with chdir(tmp_path / "workdir", mkdir=True):
     with environment(SOURCE_DATE_EPOCH="1001"):
-      with raises(StampInternalError):
+      layer_diff.main({
+        "copy": [
+          {"src": str(testdata / "copysrc1"), "dest": "/copy", "uid": 52},
+          {"src": str(testdata / "copysrc1/hello.txt"), "dest": "/other/hello.txt", "uid": 54, "gid": 55},
+        ],
+        "runOnHost": "ln -sfT my/link/target runonhost",
+        "runOnHostUID": 53,
+        "outputs": {"out": str(out_path)},
+      })
+
+  compare_tar_entries(out_path, expected=[
+    dict(name="copy", size=0, mtime=1001, type=DIRTYPE, uid=52, gid=52, uname="", gname=""),
+    dict(name="copy/hello.txt", size=14, mtime=1001, mode=0o644, type=REGTYPE, uid=52, gid=52, uname="", gname=""),
+    dict(name="copy/world.txt", size=0, mtime=1001, type=SYMTYPE, linkname="hello.txt", uid=52, gid=52, uname="", gname=""),
+    dict(name="other", size=0, mtime=1001, mode=0o755, type=DIRTYPE, uid=53, gid=53, uname="", gname=""),
+    dict(name="other/hello.txt", size=14, mtime=1001, mode=0o644, type=REGTYPE, uid=54, gid=55, uname="", gname=""),
+    dict(name="runonhost", size=0, mtime=1001, type=SYMTYPE, linkname="my/link/target", uid=53, gid=53, uname="", gname=""),
+  ])
+
+
+def test_layer_diff_copy_many(tmp_path):
+  src = tmp_path / "src"
+  (src / "sub").mkdir(parents=True)
+  (src / "a").write_text("read-only\n")
+  (src / "a").chmod(0o444)
+  (src / "b").hardlink_to(src / "a")
+  (src / "c").write_text("writable\n")
+  (src / "c").chmod(0o644)
+  (src / "sub").chmod(0o555)
+  single = tmp_path / "single"
+  single.write_text("single\n")
+  single.chmod(0o600)
+
+  out_path = tmp_path / "out"
+  with chdir(tmp_path / "workdir", mkdir=True):
+    with environment(SOURCE_DATE_EPOCH="1001"):
+      layer_diff.main({
+        "copy": [
+          {"src": str(src), "dest": "/opt/x"},
+          {"src": str(single), "dest": "/opt/x/sub/extra"},
+          {"src": str(single), "dest": "/opt/x"},
+        ],
+        "outputs": {"out": str(out_path)},
+      })
+
+  compare_tar_entries(out_path, expected=[
+    dict(name="opt", mode=0o755, type=DIRTYPE, uid=0, gid=0),
+    dict(name="opt/x", type=DIRTYPE, uid=0, gid=0),
+    dict(name="opt/x/a", size=10, mode=0o444, type=REGTYPE, uid=0, gid=0),
+    dict(name="opt/x/b", size=0, mode=0o444, type=LNKTYPE, linkname="opt/x/a", uid=0, gid=0),
+    dict(name="opt/x/c", size=9, mode=0o644, type=REGTYPE, uid=0, gid=0),
+    dict(name="opt/x/single", size=7, mode=0o600, type=REGTYPE, uid=0, gid=0),
+    dict(name="opt/x/sub", mode=0o555, type=DIRTYPE, uid=0, gid=0),
+    dict(name="opt/x/sub/extra", size=7, mode=0o600, type=REGTYPE, uid=0, gid=0),
+  ])
+  (src / "sub").chmod(0o755)
+
+
+def test_layer_diff_copy_direct(testdata, tmp_path):
+  # Copy-only layers are archived straight from their sources, but the result
+  # should be the same as if they had been staged.
+  src = tmp_path / "src"
+  (src / "a-b").mkdir(parents=True)
+  (src / "a" / "b").mkdir(parents=True)
+  (src / "a" / "b" / "file").write_text("hello\n")
+  (src / "a" / "b" / "link").hardlink_to(src / "a" / "b" / "file")
+  (src / "a-b" / "file").write_text("hello\n")
+  elems = [
+    {"src": str(src), "dest": "/x"},
+    {"src": str(testdata / "copysrc1"), "dest": "/x/a"},
+    {"src": str(testdata / "copysrc1/hello.txt"), "dest": "/y/z/hello"},
+  ]
+
+  archives = []
+  for run_on_host in ["", "true"]:
+    out_path = tmp_path / f"out{len(archives)}"
+    with chdir(tmp_path / f"workdir{len(archives)}", mkdir=True):
+      with environment(SOURCE_DATE_EPOCH="1001"):
+        layer_diff.main({
+          "copy": elems,
+          "runOnHost": run_on_host,
+          "outputs": {"out": str(out_path)},
+        })
+      compare(pathlib.Path("content").exists(), expected=bool(run_on_host))
+    archives.append(out_path.read_bytes())
+  compare(archives[0], expected=archives[1])
+
+
+def test_layer_diff_copy_direct_owners(tmp_path):
+  # Ownership of hardlinked copies is the same whether the layer is staged or
+  # archived straight from its sources.
+  src = tmp_path / "src"
+  src.mkdir()
+  (src / "a").write_text("hello\n")
+  (src / "b").hardlink_to(src / "a")
+  (src / "c").write_text("read-only\n")
+  (src / "c").chmod(0o444)
+  (src / "d").hardlink_to(src / "c")
+  elems = [
+    {"src": str(src), "dest": "/x", "uid": 52, "gid": 53},
+    {"src": str(src / "a"), "dest": "/y/a", "uid": 54},
+  ]
+
+  archives = []
+  for run_on_host in ["", "true"]:
+    out_path = tmp_path / f"out{len(archives)}"
+    with chdir(tmp_path / f"workdir{len(archives)}", mkdir=True):
+      with environment(SOURCE_DATE_EPOCH="1001"):
         layer_diff.main({
-          "copy": [
-            {"src": str(testdata / "copysrc1"), "dest": "/copy", "uid": 52},
-          ],
-          "runOnHost": "ln -sfT my/link/target runonhost",
-          "runOnHostUID": 53,
+          "copy": elems,
+          "runOnHost": run_on_host,
+          "runOnHostUID": 7,
           "outputs": {"out": str(out_path)},
         })
+    archives.append(out_path.read_bytes())
+  compare(archives[1], expected=archives[0])
+  compare_tar_entries(tmp_path / "out0", expected=[
+    dict(name="x", type=DIRTYPE, uid=52, gid=53),
+    dict(name="x/a", type=REGTYPE, uid=52, gid=53),
+    dict(name="x/b", type=LNKTYPE, linkname="x/a", uid=52, gid=53),
+    dict(name="x/c", type=REGTYPE, uid=52, gid=53),
+    dict(name="x/d", type=LNKTYPE, linkname="x/c", uid=52, gid=53),
+    dict(name="y", type=DIRTYPE, uid=7, gid=7),
+    dict(name="y/a", type=REGTYPE, uid=54, gid=54),
+  ])
+
+
+def test_layer_diff_copy_hardlinks_modified(tmp_path):
+  # Copies of hardlinked sources are separate files, so that a script can
+  # modify one without affecting the others. Those it leaves alone are
+  # archived as hardlinks again.
+  src = tmp_path / "src"
+  src.mkdir()
+  (src / "a").write_text("same\n")
+  for name in ["b", "c"]:
+    (src / name).hardlink_to(src / "a")
+  (src / "d").write_text("other\n")
+  (src / "e").hardlink_to(src / "d")
+  src.chmod(0o555)
+
+  out_path = tmp_path / "out"
+  with chdir(tmp_path / "workdir", mkdir=True):
+    with environment(SOURCE_DATE_EPOCH="1001"):
+      layer_diff.main({
+        "copy": [{"src": str(src), "dest": "/x"}],
+        "runOnHost": "echo more >> x/b",
+        "outputs": {"out": str(out_path)},
+      })
+  src.chmod(0o755)
+
+  compare((src / "a").read_text(), expected="same\n")
+  compare_tar_entries(out_path, expected=[
+    dict(name="x", type=DIRTYPE),
+    dict(name="x/a", size=5, type=REGTYPE),
+    dict(name="x/b", size=10, type=REGTYPE),
+    dict(name="x/c", size=0, type=LNKTYPE, linkname="x/a"),
+    dict(name="x/d", size=6, type=REGTYPE),
+    dict(name="x/e", size=0, type=LNKTYPE, linkname="x/d"),
+  ])
+
+
+def test_layer_diff_extract_cache_not_mounted(tmp_path):
+  # Outside of a directory shared from the host, the cache wouldn't outlive
+  # the VM.
+  with chdir(tmp_path / "workdir", mkdir=True):
+    with pytest.raises(ValueError, match="not mounted"):
+      layer_diff.main({
+        "runInContainer": "true",
+        "extractCacheDir": str(tmp_path / "cache"),
+        "extractCacheMaxSize": 1 << 30,
+        "outputs": {"out": str(tmp_path / "out")},
+      })
+  assert not (tmp_path / "cache").exists()
@@ -0,0 +1,87 @@
+import gzip
+import hashlib
+import tarfile
+from stamptool import make_layer
+from tarfile import DIRTYPE, REGTYPE, SYMTYPE
+from testfixtures import compare
+from .conftest import compare_tar_entries, environment
+
+
+def test_make_layer_from_diff_tarball(testdata, tmp_path):
+  outputs = {
+    "out": str(tmp_path / "blob"),
+    "diffDigest": str(tmp_path / "diff-digest"),
+    "blobDigest": str(tmp_path / "blob-digest"),
+  }
+  make_layer.main({
+    "diffTarball": str(testdata / "layer1/diff.tar"),
+    "outputs": outputs,
+  })
+
+  blob = (tmp_path / "blob").read_bytes()
+  compare(gzip.decompress(blob), expected=(testdata / "layer1/diff.tar").read_bytes())
+  compare((tmp_path / "diff-digest").read_text(), expected=(testdata / "layer1/diff.tar.digest").read_text().strip())
+  compare((tmp_path / "blob-digest").read_text(), expected="sha256:" + hashlib.sha256(blob).hexdigest())
+
+
+def test_make_layer_from_paths(testdata, tmp_path):
+  outputs = {
+    "out": str(tmp_path / "blob"),
+    "diff": str(tmp_path / "diff"),
+    "diffDigest": str(tmp_path / "diff-digest"),
+    "blobDigest": str(tmp_path / "blob-digest"),
+  }
+  src = testdata / "copysrc1"
+  with environment(SOURCE_DATE_EPOCH="1001"):
+    make_layer.main({
+      "wholePaths": [str(src)],
+      "compression": "gzip",
+      "compressionLevel": 9,
+      "outputs": outputs,
+    })
+
+  rel = str(src).lstrip("/")
+  compare_tar_entries(tmp_path / "diff", expected=[
+    dict(name=rel, mtime=1001, type=DIRTYPE, uid=0, gid=0, uname="", gname=""),
+    dict(name=f"{rel}/hello.txt", size=14, mtime=1001, type=REGTYPE, uid=0, gid=0, uname="", gname=""),
+    dict(name=f"{rel}/world.txt", mtime=1001, type=SYMTYPE, linkname="hello.txt", uid=0, gid=0, uname="", gname=""),
+  ])
+  diff = (tmp_path / "diff").read_bytes()
+  blob = (tmp_path / "blob").read_bytes()
+  compare(gzip.decompress(blob), expected=diff)
+  compare((tmp_path / "diff-digest").read_text(), expected="sha256:" + hashlib.sha256(diff).hexdigest())
+  compare((tmp_path / "blob-digest").read_text(), expected="sha256:" + hashlib.sha256(blob).hexdigest())
+
+
+def test_make_layer_whole_and_partial_paths(tmp_path):
+  store = tmp_path / "store"
+  for name in ["aaa", "bbb", "ccc", "ddd"]:
+    (store / name / "sub").mkdir(parents=True)
+    (store / name / "sub" / "file").write_text(name)
+  outputs = {
+    "out": str(tmp_path / "blob"),
+    "diff": str(tmp_path / "diff"),
+    "diffDigest": str(tmp_path / "diff-digest"),
+    "blobDigest": str(tmp_path / "blob-digest"),
+  }
+  with environment(SOURCE_DATE_EPOCH="1001"):
+    make_layer.main({
+      "wholePaths": [str(store / "ddd"), str(store / "bbb")],
+      "partialPaths": [str(store / "ccc"), str(store / "aaa" / "sub"), str(store / "aaa")],
+      "outputs": outputs,
+    })
+
+  rel = str(store).lstrip("/")
+  with tarfile.open(tmp_path / "diff") as tar:
+    names = tar.getnames()
+  compare(names, expected=[
+    f"{rel}/aaa",
+    f"{rel}/aaa/sub",
+    f"{rel}/bbb",
+    f"{rel}/bbb/sub",
+    f"{rel}/bbb/sub/file",
+    f"{rel}/ccc",
+    f"{rel}/ddd",
+    f"{rel}/ddd/sub",
+    f"{rel}/ddd/sub/file",
+  ])
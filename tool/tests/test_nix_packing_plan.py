@@ -1,6 +1,11 @@
+import hashlib
+import io
+import json
+import pytest
+import tarfile
 from stamptool import nix_packing_plan
 from testfixtures import compare
-from .conftest import compare_dir_entries
+from .conftest import compare_dir_entries, write_oci_image
 
 
 # Rationale for the closure structure used in this test:
@@ -46,3 +51,294 @@ def test_nix_packing_plan(testdata, tmp_path):
   compare_dir_entries(out_dir, expected=expected_plan.keys())
   for filename, expected_content in expected_plan.items():
     compare((out_dir / filename).read_text(), expected=expected_content)
+
+
+def test_nix_packing_plan_json(testdata, tmp_path):
+  out_dir = tmp_path / "out"
+  plan_path = tmp_path / "plan.json"
+  nix_packing_plan.main({
+    "closureInfo": str(testdata / "closureinfo1"),
+    "targetLayerSize": 500,
+    "outputs": {"out": str(out_dir), "plan": str(plan_path)},
+  })
+
+  compare_dir_entries(out_dir, expected=expected_plan.keys())
+  plan = json.loads(plan_path.read_text())
+  compare(
+    [(layer["paths"], layer["pathCount"], layer["size"]) for layer in plan["layers"]],
+    expected=[
+      (["/mockstore/aaa", "/mockstore/bbb", "/mockstore/ccc"], 3, 405),
+      (["/mockstore/eee", "/mockstore/ggg"], 2, 309),
+      (["/mockstore/fff"], 1, 901),
+      (["/mockstore/ddd"], 1, 45),
+    ],
+  )
+  compare(plan["layers"][2]["key"], expected=hashlib.sha256(b"/mockstore/fff").hexdigest()[:32])
+  compare(plan["totalSize"], expected=1660)
+  compare(nix_packing_plan.read_plan(plan_path), expected=nix_packing_plan.read_plan(out_dir))
+
+
+def test_dep_graph_incremental_closure_sizes(testdata):
+  dep_graph = nix_packing_plan.DepGraph(testdata / "closureinfo1")
+  dep_graph.pop_subtree(dep_graph.closest_node(500))
+
+  # Recompute every remaining node's closure size from scratch: its own size
+  # plus the closure sizes of the remaining nodes it refers to.
+  expected = {}
+  from_refs = {}
+  for i in dep_graph.remaining_ids_depth_first():
+    expected[i] = dep_graph.size(i) + from_refs.get(i, 0)
+    for ii in dep_graph.referrers(i):
+      from_refs[ii] = from_refs.get(ii, 0) + expected[i]
+  got = {dep_graph.path(i): dep_graph.closure_size(i) for i in dep_graph.remaining_ids()}
+  expected = {dep_graph.path(i): size for i, size in expected.items()}
+  compare(got, expected=expected)
+  compare(sorted(got), expected=["/mockstore/ddd", "/mockstore/eee", "/mockstore/fff", "/mockstore/ggg"])
+
+
+def test_sorted_ints():
+  s = nix_packing_plan.SortedInts(range(0, 5000, 2))
+  s.add(1001)
+  s.remove(1000)
+  compare(s.first_at_least(999), expected=1001)
+  compare(s.first_at_least(1000), expected=1001)
+  compare(s.last_below(1001), expected=998)
+  compare(s.last_below(0), expected=None)
+  compare(s.first_at_least(5000), expected=None)
+
+
+def test_nix_packing_plan_previous_plan(testdata, tmp_path):
+  prev_dir = tmp_path / "prev"
+  prev_dir.mkdir()
+  (prev_dir / "0000").write_text("/mockstore/aaa\n/mockstore/bbb\n/mockstore/ccc\n")
+  (prev_dir / "0001").write_text("/mockstore/eee\n/mockstore/ggg\n/mockstore/zzz\n") # zzz is no longer in the closure
+  (prev_dir / "0002").write_text("/mockstore/fff\n")
+
+  out_dir = tmp_path / "out"
+  nix_packing_plan.main({
+    "closureInfo": str(testdata / "closureinfo1"),
+    "targetLayerSize": 500,
+    "previousPlan": str(prev_dir),
+    "outputs": {"out": str(out_dir)},
+  })
+
+  expected = {
+    "0000": "/mockstore/aaa\n/mockstore/bbb\n/mockstore/ccc\n",
+    "0001": "/mockstore/fff\n",
+    "0002": "/mockstore/eee\n/mockstore/ggg\n",
+    "0003": "/mockstore/ddd\n",
+  }
+  compare_dir_entries(out_dir, expected=expected.keys())
+  for filename, expected_content in expected.items():
+    compare((out_dir / filename).read_text(), expected=expected_content)
+
+
+@pytest.mark.parametrize("strategy,extra_attrs,expected", [
+  ("popularity", {}, {
+    "0000": "/mockstore/fff\n",
+    "0001": "/mockstore/aaa\n/mockstore/bbb\n",
+    "0002": "/mockstore/ccc\n/mockstore/ddd\n/mockstore/eee\n/mockstore/ggg\n",
+  }),
+  ("dominator", {}, {
+    "0000": "/mockstore/fff\n",
+    "0001": "/mockstore/aaa\n/mockstore/bbb\n/mockstore/ccc\n/mockstore/ggg\n",
+    "0002": "/mockstore/ddd\n/mockstore/eee\n",
+  }),
+  ("size-bin", {}, {
+    "0000": "/mockstore/fff\n",
+    "0001": "/mockstore/aaa\n",
+    "0002": "/mockstore/ccc\n/mockstore/eee\n",
+    "0003": "/mockstore/bbb\n/mockstore/ddd\n/mockstore/ggg\n",
+  }),
+  ("size-bin", {"maxLayers": 2}, {
+    "0000": "/mockstore/fff\n",
+    "0001": "/mockstore/aaa\n/mockstore/bbb\n/mockstore/ccc\n/mockstore/ddd\n/mockstore/eee\n/mockstore/ggg\n",
+  }),
+])
+def test_nix_packing_plan_strategies(testdata, tmp_path, strategy, extra_attrs, expected):
+  out_dir = tmp_path / "out"
+  nix_packing_plan.main({
+    "closureInfo": str(testdata / "closureinfo1"),
+    "targetLayerSize": 500,
+    "strategy": strategy,
+    "outputs": {"out": str(out_dir)},
+    **extra_attrs,
+  })
+
+  compare_dir_entries(out_dir, expected=expected.keys())
+  for filename, expected_content in expected.items():
+    compare((out_dir / filename).read_text(), expected=expected_content)
+
+
+def test_nix_packing_plan_max_layers(testdata, tmp_path):
+  out_dir = tmp_path / "out"
+  nix_packing_plan.main({
+    "closureInfo": str(testdata / "closureinfo1"),
+    "targetLayerSize": 500,
+    "maxLayers": 2,
+    "outputs": {"out": str(out_dir)},
+  })
+
+  # Starting from expected_plan, ddd (45) is merged with eee+ggg (309), and
+  # the result with aaa+bbb+ccc (405).
+  expected = {
+    "0000": "/mockstore/aaa\n/mockstore/bbb\n/mockstore/ccc\n/mockstore/ddd\n/mockstore/eee\n/mockstore/ggg\n",
+    "0001": "/mockstore/fff\n",
+  }
+  compare_dir_entries(out_dir, expected=expected.keys())
+  for filename, expected_content in expected.items():
+    compare((out_dir / filename).read_text(), expected=expected_content)
+
+
+def test_nix_packing_plan_split_large_paths(tmp_path):
+  store = tmp_path / "store"
+  big = store / "big"
+  (big / "a").mkdir(parents=True)
+  (big / "a/1").write_bytes(b"x" * 300)
+  (big / "a/2").write_bytes(b"x" * 300)
+  (big / "b").write_bytes(b"x" * 400)
+  (big / "c").symlink_to("b")
+  (store / "small").write_bytes(b"x" * 100)
+  closure_info = tmp_path / "closureinfo"
+  closure_info.mkdir()
+  (closure_info / "registration").write_text(
+    f"{big}\narbitrary\n1001\narbitrary\n1\n{store}/small\n"
+    f"{store}/small\narbitrary\n100\narbitrary\n0\n"
+  )
+
+  out_dir = tmp_path / "out"
+  nix_packing_plan.main({
+    "closureInfo": str(closure_info),
+    "targetLayerSize": 500,
+    "splitLargePaths": True,
+    "outputs": {"out": str(out_dir)},
+  })
+
+  expected = {
+    "0000": f"{store}/small\n",
+    "0001": f"{big}\n{big}/a\n{big}/a/1\n",
+    "0002": f"{big}\n{big}/a\n{big}/a/2\n",
+    "0003": f"{big}\n{big}/b\n{big}/c\n",
+  }
+  compare_dir_entries(out_dir, expected=expected.keys())
+  for filename, expected_content in expected.items():
+    compare((out_dir / filename).read_text(), expected=expected_content)
+
+
+def test_nix_packing_plan_split_large_paths_ancestors(tmp_path):
+  store = tmp_path / "store"
+  big = store / "big"
+  (big / "d" / "e").mkdir(parents=True)
+  (big / "d-x").write_bytes(b"x" * 300)
+  (big / "d" / "e" / "y").write_bytes(b"x" * 300)
+  (big / "d" / "z").write_bytes(b"x" * 300)
+  closure_info = tmp_path / "closureinfo"
+  closure_info.mkdir()
+  (closure_info / "registration").write_text(f"{big}\narbitrary\n900\narbitrary\n0\n")
+
+  # "d-x" sorts before "d/e/y" byte-wise, but after everything in "d" when
+  # sorted by components.
+  out_dir = tmp_path / "out"
+  nix_packing_plan.main({
+    "closureInfo": str(closure_info),
+    "targetLayerSize": 400,
+    "splitLargePaths": True,
+    "outputs": {"out": str(out_dir)},
+  })
+  expected = {
+    "0000": f"{big}\n{big}/d\n{big}/d/e\n{big}/d/e/y\n",
+    "0001": f"{big}\n{big}/d\n{big}/d/z\n",
+    "0002": f"{big}\n{big}/d-x\n",
+  }
+  compare_dir_entries(out_dir, expected=expected.keys())
+  for filename, expected_content in expected.items():
+    compare((out_dir / filename).read_text(), expected=expected_content)
+
+  # Directories listed by several split layers are only listed once when those
+  # layers are merged.
+  out_dir = tmp_path / "out-merged"
+  nix_packing_plan.main({
+    "closureInfo": str(closure_info),
+    "targetLayerSize": 400,
+    "splitLargePaths": True,
+    "maxLayers": 1,
+    "outputs": {"out": str(out_dir)},
+  })
+  compare((out_dir / "0000").read_text(), expected=f"{big}\n{big}/d\n{big}/d-x\n{big}/d/e\n{big}/d/e/y\n{big}/d/z\n")
+
+
+def make_diff(names):
+  """
+  Return a diff tarball of empty entries with the given names: directories if
+  they end in "/", overlayfs whiteouts if they end in "@", and otherwise
+  regular files.
+  """
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode="w") as tar:
+    for name in names:
+      info = tarfile.TarInfo(name)
+      if name.endswith("/"):
+        info.type = tarfile.DIRTYPE
+      elif name.endswith("@"):
+        info.name = name[:-1]
+        info.type = tarfile.CHRTYPE
+      tar.addfile(info, io.BytesIO(b""))
+  return buf.getvalue()
+
+
+def test_nix_packing_plan_base_image(testdata, tmp_path):
+  diffs = [
+    make_diff(["mockstore/", "mockstore/bbb/", "mockstore/bbb/file", "mockstore/eee", "./mockstore/zzz/", "etc/"]),
+    make_diff(["mockstore/", "mockstore/.wh.eee"]),
+  ]
+  diff_ids = [f"sha256:{hashlib.sha256(diff).hexdigest()}" for diff in diffs]
+  base_path = tmp_path / "base"
+  write_oci_image(base_path, [{"layers": [], "diff_ids": diff_ids}])
+  base_diffs_path = tmp_path / "base-diffs"
+  (base_diffs_path / "sha256").mkdir(parents=True)
+  for diff_id, diff in zip(diff_ids, diffs):
+    (base_diffs_path / diff_id.replace(":", "/")).write_bytes(diff)
+
+  compare(
+    nix_packing_plan.base_image_store_paths(base_path, base_diffs_path, store_dir="/mockstore"),
+    expected={"/mockstore/bbb", "/mockstore/zzz"},
+  )
+
+  out_dir = tmp_path / "out"
+  nix_packing_plan.main({
+    "closureInfo": str(testdata / "closureinfo1"),
+    "targetLayerSize": 500,
+    "baseImage": str(base_path),
+    "baseDiffs": str(base_diffs_path),
+    "outputs": {"out": str(out_dir)},
+  })
+
+  expected = {
+    "0000": "/mockstore/aaa\n",
+    "0001": "/mockstore/eee\n/mockstore/ggg\n",
+    "0002": "/mockstore/fff\n",
+    "0003": "/mockstore/ccc\n/mockstore/ddd\n",
+  }
+  compare_dir_entries(out_dir, expected=expected.keys())
+  for filename, expected_content in expected.items():
+    compare((out_dir / filename).read_text(), expected=expected_content)
+
+
+def test_nix_packing_plan_base_image_store_whiteouts(tmp_path):
+  def store_paths(*diffs):
+    diff_ids = [f"sha256:{hashlib.sha256(diff).hexdigest()}" for diff in diffs]
+    base_path = tmp_path / diff_ids[-1].replace(":", "-")
+    write_oci_image(base_path / "oci", [{"layers": [], "diff_ids": diff_ids}])
+    (base_path / "diffs/sha256").mkdir(parents=True, exist_ok=True)
+    for diff_id, diff in zip(diff_ids, diffs):
+      (base_path / "diffs" / diff_id.replace(":", "/")).write_bytes(diff)
+    return nix_packing_plan.base_image_store_paths(base_path / "oci", base_path / "diffs", store_dir="/nix/store")
+
+  base = make_diff(["nix/", "nix/store/", "nix/store/aaa/", "nix/store/bbb", "nix/store/ccc"])
+  compare(store_paths(base), expected={"/nix/store/aaa", "/nix/store/bbb", "/nix/store/ccc"})
+  compare(store_paths(base, make_diff(["nix/store/bbb@"])), expected={"/nix/store/aaa", "/nix/store/ccc"})
+  compare(store_paths(base, make_diff(["nix/.wh.store"])), expected=set())
+  compare(store_paths(base, make_diff([".wh.nix", "nix/", "nix/store/ddd"])), expected={"/nix/store/ddd"})
+  compare(store_paths(base, make_diff(["nix/", "nix/.wh..wh..opq", "nix/store/eee/"])), expected={"/nix/store/eee"})
+  compare(store_paths(base, make_diff(["nix/store@"])), expected=set())
+  compare(store_paths(base, make_diff(["nix/.wh.other", "nix/store/.wh.ccc"])), expected={"/nix/store/aaa", "/nix/store/bbb"})
@@ -0,0 +1,92 @@
+import gzip
+import random
+from pytest import mark, raises
+from stamptool import parallel_gzip
+from stamptool.common import InvalidImageError
+from stamptool.extract_diffs import ParallelGzipDecompressor
+from testfixtures import compare
+
+
+def compress(data, threads, chunk_size=100000):
+  compressor = parallel_gzip.ParallelGzipCompressor(level=6, threads=threads)
+  out = [compressor.compress(data[i:i+chunk_size]) for i in range(0, len(data), chunk_size)]
+  out.append(compressor.flush())
+  return b"".join(out)
+
+
+def decompress(blob, chunk_size=100000, threads=4):
+  decompressor = ParallelGzipDecompressor(threads)
+  out = []
+  for i in range(0, len(blob), chunk_size):
+    out.extend(decompressor.decompress(blob[i:i+chunk_size]))
+  out.extend(decompressor.flush())
+  decompressor.finish()
+  return b"".join(out)
+
+
+def random_data(size):
+  rng = random.Random(size)
+  words = [rng.randbytes(rng.randint(1, 12)) for _ in range(1000)]
+  out = bytearray()
+  while len(out) < size:
+    out += rng.choice(words)
+  return bytes(out[:size])
+
+
+@mark.parametrize("size", [0, 1, parallel_gzip.BLOCK_SIZE, 3 * parallel_gzip.BLOCK_SIZE + 12345])
+def test_parallel_gzip_round_trip(size):
+  data = random_data(size)
+  blob = compress(data, threads=1)
+  compare(gzip.decompress(blob), expected=data)
+  compare(decompress(blob), expected=data)
+  for threads in [2, 4, 8]:
+    compare(compress(data, threads=threads), expected=blob)
+
+
+def test_parallel_gzip_member_sizes():
+  blob = compress(random_data(2 * parallel_gzip.BLOCK_SIZE + 1), threads=2)
+  offset = 0
+  n_members = 0
+  while offset < len(blob):
+    offset += parallel_gzip.member_size(blob[offset:])
+    n_members += 1
+  compare(offset, expected=len(blob))
+  compare(n_members, expected=3)
+
+
+def test_parallel_gzip_decompress_unindexed():
+  # Ordinary gzip members (without recorded sizes) are still decompressed,
+  # including after some indexed ones.
+  data = random_data(parallel_gzip.BLOCK_SIZE + 5000)
+  blob = compress(data, threads=2) + gzip.compress(b"trailer") + gzip.compress(b"!")
+  compare(decompress(blob), expected=data + b"trailer!")
+  compare(decompress(gzip.compress(data)), expected=data)
+
+
+def test_parallel_gzip_decompress_truncated():
+  blob = compress(random_data(parallel_gzip.BLOCK_SIZE + 5000), threads=2)
+  with raises(InvalidImageError):
+    decompress(blob[:-1])
+
+
+def test_parallel_gzip_decompress_corrupt():
+  blob = bytearray(compress(random_data(5000), threads=1))
+  blob[-10] ^= 0xff
+  with raises(InvalidImageError):
+    decompress(bytes(blob))
+
+
+def test_parallel_gzip_decompress_oversized():
+  # A member claiming to be bigger than any member within the size limit could
+  # be is rejected as soon as its header is seen.
+  header = bytearray(parallel_gzip.compress_member(b"")[:parallel_gzip.HEADER.size])
+  header[-4:] = (parallel_gzip.MAX_COMPRESSED_MEMBER_SIZE + 1).to_bytes(4, "little")
+  with raises(InvalidImageError):
+    list(ParallelGzipDecompressor(2).decompress(bytes(header)))
+
+  # A member of the largest allowed size, which doesn't compress at all, is
+  # within the limit.
+  data = random.Random(0).randbytes(parallel_gzip.MAX_MEMBER_SIZE)
+  member = parallel_gzip.compress_member(data)
+  assert len(member) <= parallel_gzip.MAX_COMPRESSED_MEMBER_SIZE
+  compare(decompress(member), expected=data)
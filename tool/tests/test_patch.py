@@ -1,8 +1,11 @@
+import copy
 import hashlib
 import json
 import os
 import pytest
+from pytest import raises
 from stamptool import patch
+from stamptool.common import InvalidImageError
 from testfixtures import compare
 from .conftest import compare_dir_entries
 
@@ -271,3 +274,24 @@ def test_patch_diffs_no_base(testdata, append_layers, tmp_path):
   ])
 
   compare(os.readlink(new_layer_link_path), expected=str(testdata / "layer1/diff.tar"))
+
+
+def test_append_layer_zstd(testdata):
+  layer = patch.NewLayer(
+    diff_tarball=testdata / "layer1/diff.tar",
+    blob_tarball=testdata / "layer1/blob.tar.gz",
+    diff_digest="sha256:aaa",
+    blob_digest="sha256:bbb",
+    compression="zstd",
+  )
+  manifest, config = copy.deepcopy(patch.EMPTY_MANIFEST), copy.deepcopy(patch.EMPTY_CONFIG)
+  patch.append_layer(layer, manifest, config)
+  compare(manifest["layers"], expected=[{
+    "mediaType": "application/vnd.oci.image.layer.v1.tar+zstd",
+    "digest": "sha256:bbb",
+    "size": 135,
+  }])
+
+  manifest["mediaType"] = "application/vnd.docker.distribution.manifest.v2+json"
+  with raises(InvalidImageError):
+    patch.append_layer(layer, manifest, config)
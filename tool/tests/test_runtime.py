@@ -0,0 +1,120 @@
+import hashlib
+import io
+import os
+import pathlib
+import tarfile
+from stamptool import mount_api
+from stamptool.layer_cache import LayerCache
+from stamptool.runtime import Runtime, max_lowerdirs_per_overlay
+from stamptool.snapshot import flatten_layers, has_whiteouts
+from testfixtures import compare
+from .conftest import chdir
+
+
+def write_diffs(diffs_dir, contents):
+  return [write_diff(diffs_dir, {"file": content}) for content in contents]
+
+
+def write_diff(diffs_dir, members):
+  """
+  Write a diff tarball containing `members`, a dict mapping each name to the
+  content of a regular file or None for a directory, returning its digest.
+  """
+  (diffs_dir / "sha256").mkdir(parents=True, exist_ok=True)
+  f = io.BytesIO()
+  with tarfile.open(fileobj=f, mode="w") as tar:
+    for name, content in members.items():
+      info = tarfile.TarInfo(name)
+      if content is None:
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+      else:
+        info.size = len(content)
+        tar.addfile(info, io.BytesIO(content))
+  digest = hashlib.sha256(f.getvalue()).hexdigest()
+  (diffs_dir / "sha256" / digest).write_bytes(f.getvalue())
+  return f"sha256:{digest}"
+
+
+def overlaid_tree(lowerdirs, dest):
+  """
+  Return the files in the overlay of `lowerdirs` (topmost first), as a dict
+  mapping each path to its content, or None for a directory.
+  """
+  dest.mkdir()
+  flatten_layers(list(reversed(lowerdirs)), dest)
+  tree = {}
+  for dir_path, dir_names, file_names in os.walk(dest):
+    for name in dir_names:
+      tree[os.path.relpath(os.path.join(dir_path, name), dest)] = None
+    for name in file_names:
+      tree[os.path.relpath(os.path.join(dir_path, name), dest)] = pathlib.Path(dir_path, name).read_bytes()
+  return tree
+
+
+def test_runtime_extract_diffs(tmp_path, monkeypatch):
+  monkeypatch.setenv("NIX_BUILD_CORES", "4")
+  contents = [f"layer {i}".encode() for i in range(10)]
+  digests = write_diffs(tmp_path / "diffs", contents)
+
+  with chdir(tmp_path / "workdir", mkdir=True):
+    rt = Runtime()
+    # Order is preserved, and repeated diffs are only extracted once.
+    extract_dirs = rt.extract_diffs(tmp_path / "diffs", digests + digests[:3])
+    compare([(d / "file").read_bytes() for d in extract_dirs], expected=contents + contents[:3])
+    compare(extract_dirs[10:], expected=extract_dirs[:3])
+    compare(len(set(extract_dirs)), expected=10)
+    compare(rt.extract_diffs(tmp_path / "diffs", digests[:1]), expected=extract_dirs[:1])
+
+
+def test_runtime_max_lowerdirs_per_overlay(monkeypatch):
+  monkeypatch.setattr(mount_api, "supports_overlay_lowerdir_append", lambda: True)
+  compare(max_lowerdirs_per_overlay(), expected=500)
+  # With the legacy mount API, lowerdir=0:1:...:87 is the longest that fits in
+  # 255 bytes.
+  monkeypatch.setattr(mount_api, "supports_overlay_lowerdir_append", lambda: False)
+  compare(max_lowerdirs_per_overlay(), expected=88)
+
+
+def test_runtime_image_lowerdirs_snapshot(tmp_path, monkeypatch):
+  contents = [f"layer {i}".encode() for i in range(10)]
+  digests = write_diffs(tmp_path / "diffs", contents)
+  cache = LayerCache(tmp_path / "cache", max_bytes=1 << 30)
+
+  # The whole image is flattened into one snapshot, in which the topmost
+  # layer's file wins.
+  with chdir(tmp_path / "workdir1", mkdir=True):
+    [snapshot] = Runtime(layer_cache=cache).image_lowerdirs(tmp_path / "diffs", digests[:8])
+    compare((snapshot / "file").read_bytes(), expected=contents[7])
+
+  # An image built on top of it reuses the snapshot, with its own layers above.
+  with chdir(tmp_path / "workdir2", mkdir=True):
+    lowerdirs = Runtime(layer_cache=cache).image_lowerdirs(tmp_path / "diffs", digests)
+    compare(lowerdirs[2], expected=snapshot)
+    compare([(d / "file").read_bytes() for d in lowerdirs], expected=[contents[9], contents[8], contents[7]])
+
+  # Small images aren't flattened.
+  with chdir(tmp_path / "workdir3", mkdir=True):
+    lowerdirs = Runtime(layer_cache=cache).image_lowerdirs(tmp_path / "diffs", digests[:3])
+    compare([(d / "file").read_bytes() for d in lowerdirs], expected=contents[2::-1])
+  cache.close()
+
+
+def test_runtime_image_lowerdirs_whiteouts(tmp_path):
+  digests = [
+    write_diff(tmp_path / "diffs", {"etc": None, "etc/a": b"a", "etc/b": b"b", "opt": None, "opt/x": b"x"}),
+    write_diff(tmp_path / "diffs", {"etc": None, "etc/.wh.a": b"", "opt": None, "opt/.wh..wh..opq": b"", "opt/y": b"y"}),
+  ] + write_diffs(tmp_path / "diffs", [f"layer {i}".encode() for i in range(6)])
+  expected = {"etc": None, "etc/b": b"b", "opt": None, "opt/y": b"y"}
+
+  # Whiteouts are applied whether or not the layers are flattened into a
+  # cached snapshot, leaving none in the directories to overlay.
+  cache = LayerCache(tmp_path / "cache", max_bytes=1 << 30)
+  for i, (layer_cache, n_layers) in enumerate([(None, 8), (cache, 8), (None, 3), (cache, 3)]):
+    with chdir(tmp_path / f"workdir{i}", mkdir=True):
+      lowerdirs = Runtime(layer_cache=layer_cache).image_lowerdirs(tmp_path / "diffs", digests[:n_layers])
+      compare([d for d in lowerdirs if has_whiteouts(d)], expected=[])
+      tree = overlaid_tree(lowerdirs, tmp_path / f"tree{i}")
+      compare(tree, expected=dict(expected, file=f"layer {n_layers - 3}".encode()))
+  cache.close()
@@ -0,0 +1,101 @@
+import hashlib
+import os
+import stat
+from stamptool.snapshot import chain_ids, flatten_layers
+from testfixtures import compare
+from .conftest import compare_dir_entries
+
+
+def test_snapshot_chain_ids():
+  a, b, c = "sha256:aaa", "sha256:bbb", "sha256:ccc"
+  ab = "sha256:" + hashlib.sha256(b"sha256:aaa sha256:bbb").hexdigest()
+  abc = "sha256:" + hashlib.sha256(f"{ab} sha256:ccc".encode()).hexdigest()
+  compare(chain_ids([a, b, c]), expected=[a, ab, abc])
+
+
+def test_snapshot_flatten_layers(tmp_path):
+  bottom = tmp_path / "bottom"
+  (bottom / "etc").mkdir(parents=True)
+  (bottom / "etc" / "passwd").write_text("root")
+  (bottom / "etc" / "shadow").write_text("secret")
+  (bottom / "opt" / "app").mkdir(parents=True)
+  (bottom / "opt" / "app" / "old").write_text("old")
+  (bottom / "lib").mkdir()
+  (bottom / "lib" / "libc.so").write_text("libc")
+  (bottom / "var").mkdir()
+  (bottom / "etc").chmod(0o555)
+
+  middle = tmp_path / "middle"
+  (middle / "etc").mkdir(parents=True)
+  (middle / "etc" / "passwd").write_text("root\nnobody")
+  (middle / "etc" / ".wh.shadow").write_text("")
+  (middle / "opt" / "app").mkdir(parents=True)
+  (middle / "opt" / "app" / ".wh..wh..opq").write_text("")
+  (middle / "opt" / "app" / "new").write_text("new")
+  (middle / "var").write_text("no longer a directory")
+  (middle / "lib" / "libc.so").mkdir(parents=True)
+
+  top = tmp_path / "top"
+  (top / "lib").mkdir(parents=True)
+  (top / "lib" / ".wh.libc.so").write_text("")
+  (top / "etc").mkdir()
+  os.symlink("passwd", top / "etc" / "passwd-")
+
+  dest = tmp_path / "dest"
+  dest.mkdir()
+  flatten_layers([bottom, middle, top], dest)
+
+  [etc, lib, opt, var] = compare_dir_entries(dest, expected=["etc", "lib", "opt", "var"])
+  [passwd, passwd_] = compare_dir_entries(etc, expected=["passwd", "passwd-"])
+  compare(passwd.read_text(), expected="root\nnobody")
+  compare(os.readlink(passwd_), expected="passwd")
+  compare_dir_entries(lib, expected=[])
+  [app] = compare_dir_entries(opt, expected=["app"])
+  [new] = compare_dir_entries(app, expected=["new"])
+  compare(var.read_text(), expected="no longer a directory")
+
+  # Files are hardlinked to the layers rather than copied, and directories get
+  # the metadata of the topmost layer that has them.
+  compare(new.stat().st_ino, expected=(middle / "opt" / "app" / "new").stat().st_ino)
+  compare(stat.S_IMODE(etc.stat().st_mode), expected=stat.S_IMODE((top / "etc").stat().st_mode))
+
+
+def test_snapshot_flatten_layers_whiteout_order(tmp_path):
+  # A layer's whiteouts only hide files from the layers below, even when they
+  # sort after a file of the same name that the layer adds.
+  bottom = tmp_path / "bottom"
+  bottom.mkdir()
+  (bottom / "-foo").write_text("old")
+  top = tmp_path / "top"
+  top.mkdir()
+  (top / "-foo").write_text("new")
+  (top / ".wh.-foo").write_text("")
+
+  dest = tmp_path / "dest"
+  dest.mkdir()
+  flatten_layers([bottom, top], dest)
+
+  [foo] = compare_dir_entries(dest, expected=["-foo"])
+  compare(foo.read_text(), expected="new")
+
+
+def test_snapshot_flatten_layers_bad_whiteouts(tmp_path):
+  # Whiteouts whose names don't refer to an entry of their directory are
+  # ignored, rather than removing the directory or its parent.
+  bottom = tmp_path / "layers" / "bottom"
+  (bottom / "dir").mkdir(parents=True)
+  (bottom / "dir" / "f").write_text("f")
+  top = tmp_path / "layers" / "top"
+  (top / "dir").mkdir(parents=True)
+  for name in [".wh.", ".wh..", ".wh..."]:
+    (top / name).write_text("")
+    (top / "dir" / name).write_text("")
+  (tmp_path / "layers" / "other").write_text("other")
+
+  dest = tmp_path / "layers" / "dest"
+  dest.mkdir()
+  flatten_layers([bottom, top], dest)
+
+  [dir] = compare_dir_entries(dest, expected=["dir"])
+  [f] = compare_dir_entries(dir, expected=["f"])
+  compare((tmp_path / "layers" / "other").read_text(), expected="other")
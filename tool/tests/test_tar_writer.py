@@ -0,0 +1,129 @@
+import io
+import os
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from stamptool import tar_writer
+from tarfile import LNKTYPE, REGTYPE
+from testfixtures import compare
+
+
+def write(src, threads=1):
+  f = io.BytesIO()
+  members = tar_writer.scan_trees([(str(src), "src")], threads=threads)
+  stats = tar_writer.write_tar(f, members, mtime=1, threads=threads)
+  return f.getvalue(), stats
+
+
+def test_write_tar_threads(tmp_path):
+  src = tmp_path / "src"
+  for i in range(20):
+    d = src / f"dir{i:02}" / "sub"
+    d.mkdir(parents=True)
+    (d / "small").write_bytes(bytes([i]) * (i * 1000))
+    (d.parent / "big").write_bytes(bytes([i]) * (tar_writer.READ_AHEAD_MAX_SIZE + i))
+    (d.parent / "link").symlink_to("sub/small")
+
+  archive, _ = write(src, threads=1)
+  compare(write(src, threads=2)[0], expected=archive)
+  compare(write(src, threads=8)[0], expected=archive)
+
+  with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+    names = tar.getnames()
+    compare(names[0], expected="src")
+    compare(names, expected=sorted(names, key=os.fsencode))
+    compare(tar.extractfile("src/dir07/big").read(), expected=bytes([7]) * (tar_writer.READ_AHEAD_MAX_SIZE + 7))
+    compare(tar.extractfile("src/dir07/sub/small").read(), expected=bytes([7]) * 7000)
+
+
+def test_write_tar_hardlinks(tmp_path):
+  src = tmp_path / "src"
+  src.mkdir()
+  (src / "a").write_bytes(b"same inode" * 100)
+  (src / "b").hardlink_to(src / "a")
+  for name in ["c", "d", "e"]:
+    (src / name).write_bytes(b"same content" * 100)
+    (src / name).chmod(0o444)
+  # Writable files, or files with different permissions, are left alone.
+  (src / "f").write_bytes(b"same content" * 100)
+  (src / "g").write_bytes(b"same content" * 100)
+  (src / "g").chmod(0o555)
+  # Other links to a file that became a hardlink link to the same member.
+  (src / "h").write_bytes(b"same content" * 100)
+  (src / "h").chmod(0o444)
+  (src / "i").hardlink_to(src / "h")
+
+  archive, stats = write(src)
+  with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+    got = {info.name: (info.type, info.linkname) for info in tar.getmembers() if info.name != "src"}
+    compare(tar.extractfile("src/e").read(), expected=b"same content" * 100)
+  compare(got, expected={
+    "src/a": (REGTYPE, ""),
+    "src/b": (LNKTYPE, "src/a"),
+    "src/c": (REGTYPE, ""),
+    "src/d": (LNKTYPE, "src/c"),
+    "src/e": (LNKTYPE, "src/c"),
+    "src/f": (REGTYPE, ""),
+    "src/g": (REGTYPE, ""),
+    "src/h": (LNKTYPE, "src/c"),
+    "src/i": (LNKTYPE, "src/c"),
+  })
+  compare(stats.hardlinked_bytes, expected=1000 + 1200 * 4)
+
+
+def test_write_tar_hardlinks_big(tmp_path):
+  src = tmp_path / "src"
+  src.mkdir()
+  size = tar_writer.READ_AHEAD_MAX_SIZE + 1000
+  contents = {
+    "a": b"a" * size,
+    "b": b"a" * size,
+    "c": b"a" * (size - 1) + b"c",
+    "d": b"d" * size,
+  }
+  for name, content in contents.items():
+    (src / name).write_bytes(content)
+    (src / name).chmod(0o444)
+
+  # Big files are only hashed in full if their start matches another's.
+  members = tar_writer.scan_trees([(str(src), "src")])
+  with ThreadPoolExecutor() as executor:
+    candidates = tar_writer.dedup_candidates(executor, members)
+  compare(sorted(m.name for m in members if (m.stat.st_dev, m.stat.st_ino) in candidates), expected=["src/a", "src/b", "src/c"])
+
+  archive, stats = write(src)
+  with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+    got = {info.name: (info.type, info.linkname) for info in tar.getmembers() if info.name != "src"}
+    compare(tar.extractfile("src/c").read(), expected=contents["c"])
+  compare(got, expected={
+    "src/a": (REGTYPE, ""),
+    "src/b": (LNKTYPE, "src/a"),
+    "src/c": (REGTYPE, ""),
+    "src/d": (REGTYPE, ""),
+  })
+  compare(stats.hardlinked_bytes, expected=size)
+
+
+def test_write_tar_sparse(tmp_path):
+  src = tmp_path / "src"
+  src.mkdir()
+  segments = [(1 << 20, b"a" * 5000), (3 << 20, b"b" * 100)] + [((4 + i) << 20, b"c") for i in range(30)]
+  size = 40 << 20
+  with open(src / "sparse", "wb") as f:
+    for offset, data in segments:
+      f.seek(offset)
+      f.write(data)
+    f.truncate(size)
+  if (src / "sparse").stat().st_blocks * 512 >= size:
+    return # the filesystem doesn't support sparse files
+
+  archive, stats = write(src)
+  compare(len(archive) < 1 << 20, expected=True)
+  compare(stats.sparse_bytes > size - (1 << 20), expected=True)
+  with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+    info = tar.getmember("src/sparse")
+    compare(info.size, expected=size)
+    data = tar.extractfile(info).read()
+  expected = bytearray(size)
+  for offset, chunk in segments:
+    expected[offset:offset + len(chunk)] = chunk
+  compare(data == expected, expected=True)